@@ -222,3 +222,20 @@ class AdminTests(APITestCase):
         data = {"is_superuser": True}
         response = self.client.patch(reverse("make-superuser", args=[user_id]), data)
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    # 6. TokenBlacklistFilterView
+    def test_get_token_blacklist_filter_stats(self):
+        """Test reading the size and accuracy of the blacklist filter."""
+        self.client.cookies['access'] = self.tokens_admin['access']
+        self.client.cookies['refresh'] = self.tokens_admin['refresh']
+        response = self.client.get(reverse("token-blacklist-filter"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("size_bytes", response.data)
+        self.assertIn("false_positive_rate", response.data)
+
+    def test_get_token_blacklist_filter_stats_no_permission(self):
+        """Test reading the blacklist filter stats as a regular user."""
+        self.client.cookies['access'] = self.tokens_user1['access']
+        self.client.cookies['refresh'] = self.tokens_user1['refresh']
+        response = self.client.get(reverse("token-blacklist-filter"))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
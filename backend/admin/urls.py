@@ -4,6 +4,7 @@ from .views import (
     FileDetailView,
     FileListView,
     MakeSuperuserView,
+    TokenBlacklistFilterView,
     UserDetailView,
     UserListView,
 )
@@ -18,4 +19,9 @@ urlpatterns = [
         MakeSuperuserView.as_view(),
         name="make-superuser",
     ),
+    path(
+        "token-blacklist-filter/",
+        TokenBlacklistFilterView.as_view(),
+        name="token-blacklist-filter",
+    ),
 ]
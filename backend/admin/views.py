@@ -4,6 +4,7 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from core.blacklist import blacklist_filter
 from core.models import File, User
 from core.permissions import IsAdmin, IsSuperuser
 
@@ -51,3 +52,15 @@ class MakeSuperuserView(APIView):
                 status=status.HTTP_200_OK,
             )
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class TokenBlacklistFilterView(APIView):
+    """
+    Metrics of the blacklisted token filter of the process serving the
+    request.
+    """
+
+    permission_classes = [IsAuthenticated, IsAdmin]
+
+    def get(self, request, *args, **kwargs):
+        return Response(blacklist_filter.stats(), status=status.HTTP_200_OK)
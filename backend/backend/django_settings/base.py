@@ -91,6 +91,43 @@ MEDIA_URL = "/static/media/"
 STATIC_ROOT = "/vol/web/static"
 MEDIA_ROOT = "/vol/web/media"
 
+# Encrypted blobs live in the "blobs" storage: the local filesystem, or an
+# S3-compatible object store (needs boto3) so backend nodes need no shared
+# volume
+FILE_STORAGE_BACKEND = os.getenv("FILE_STORAGE_BACKEND", "filesystem")
+if FILE_STORAGE_BACKEND == "s3":
+    BLOB_STORAGE = {
+        "BACKEND": "core.storage.S3BlobStorage",
+        "OPTIONS": {
+            "bucket": os.getenv("FILE_STORAGE_S3_BUCKET"),
+            "prefix": os.getenv("FILE_STORAGE_S3_PREFIX", ""),
+            "endpoint_url": os.getenv("FILE_STORAGE_S3_ENDPOINT_URL") or None,
+            "region_name": os.getenv("FILE_STORAGE_S3_REGION") or None,
+            "access_key": os.getenv("AWS_ACCESS_KEY_ID"),
+            "secret_key": os.getenv("AWS_SECRET_ACCESS_KEY"),
+            "max_pool_connections": int(
+                os.getenv("FILE_STORAGE_S3_MAX_POOL_CONNECTIONS", 32)
+            ),
+        },
+    }
+else:
+    BLOB_STORAGE = {
+        "BACKEND": "core.storage.FileSystemBlobStorage",
+        "OPTIONS": {"location": MEDIA_ROOT},
+    }
+
+# Internal nginx location aliasing the blob storage, e.g. "/protected/blobs/".
+# When set, client-encrypted files are delivered with X-Accel-Redirect.
+FILE_ACCEL_REDIRECT_LOCATION = os.getenv("FILE_ACCEL_REDIRECT_LOCATION", "")
+
+STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+    "staticfiles": {
+        "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"
+    },
+    "blobs": BLOB_STORAGE,
+}
+
 # REST Framework
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
@@ -108,6 +145,13 @@ SIMPLE_JWT = {
     "ROTATE_REFRESH_TOKENS": True,
     "BLACKLIST_AFTER_ROTATION": True,
 }
+# Access tokens this close to expiry are renewed from the refresh cookie
+JWT_ACCESS_TOKEN_RENEWAL_WINDOW = timedelta(seconds=15)
+# Blacklisted refresh tokens are mirrored in a per-process Bloom filter,
+# synced from the database at most every JWT_BLACKLIST_FILTER_SYNC_SECONDS
+JWT_BLACKLIST_FILTER_ERROR_RATE = 0.001
+JWT_BLACKLIST_FILTER_SYNC_SECONDS = 2
+JWT_BLACKLIST_FILTER_REBUILD_SECONDS = 60 * 60
 
 # Email configuration
 EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
@@ -142,6 +186,74 @@ MASTER_KEY = bytes.fromhex(os.getenv("MASTER_KEY", ""))
 if not MASTER_KEY or len(MASTER_KEY) != 32:
     raise ValueError("Invalid or missing MASTER_KEY. Ensure it's a 256-bit key.")
 
+# Keyring of master keys by id. MASTER_KEY is the current key and wraps every
+# new data key; retired keys ("id:hex,id:hex") stay available to unwrap data
+# keys until `manage.py rotate_master_key` has rewrapped them.
+MASTER_KEY_ID = os.getenv("MASTER_KEY_ID", "1")
+MASTER_KEYS = {
+    key_id.strip(): bytes.fromhex(key_hex.strip())
+    for key_id, key_hex in (
+        entry.split(":", 1)
+        for entry in os.getenv("MASTER_KEYS_RETIRED", "").split(",")
+        if entry.strip()
+    )
+}
+MASTER_KEYS[MASTER_KEY_ID] = MASTER_KEY
+if any(len(key) != 32 for key in MASTER_KEYS.values()):
+    raise ValueError("Invalid MASTER_KEYS_RETIRED. Ensure all keys are 256-bit.")
+
+# File blob encryption
+# Plaintext bytes per independently authenticated segment of an encrypted blob
+FILE_ENCRYPTION_SEGMENT_SIZE = int(
+    os.getenv("FILE_ENCRYPTION_SEGMENT_SIZE", 64 * 1024)
+)
+
+# Threads sealing segments of one upload in parallel (one process-wide pool)
+FILE_ENCRYPTION_WORKERS = int(
+    os.getenv("FILE_ENCRYPTION_WORKERS", min(os.cpu_count() or 1, 32))
+)
+
+# Compression applied before encryption: "none", "zlib" or "zstd" (needs the
+# zstandard package). Only used when a trial compression of the first
+# FILE_COMPRESSION_SAMPLE_SIZE bytes shrinks them to FILE_COMPRESSION_MAX_RATIO.
+# Off by default: compressed files are served without Range support.
+FILE_COMPRESSION = os.getenv("FILE_COMPRESSION", "none")
+FILE_COMPRESSION_SAMPLE_SIZE = 64 * 1024
+FILE_COMPRESSION_MAX_RATIO = 0.9
+
+# Previews generated after upload (thumbnails need Pillow, PDF pages also
+# pypdfium2); sources larger than FILE_PREVIEW_MAX_SOURCE_SIZE are skipped
+FILE_PREVIEW_ASYNC = True
+FILE_PREVIEW_WORKERS = int(os.getenv("FILE_PREVIEW_WORKERS", 2))
+FILE_PREVIEW_SIZE = 256
+FILE_PREVIEW_TEXT_BYTES = 4 * 1024
+FILE_PREVIEW_MAX_SOURCE_SIZE = 64 * 1024 * 1024
+FILE_PREVIEW_CACHE_SECONDS = 24 * 60 * 60
+
+# Bytes each role may store unless User.storage_quota is set (None: no limit)
+FILE_STORAGE_QUOTAS = {
+    "admin": None,
+    "user": int(os.getenv("FILE_STORAGE_QUOTA_USER", 10 * 1024**3)),
+    "guest": int(os.getenv("FILE_STORAGE_QUOTA_GUEST", 1024**3)),
+}
+
+# Batch uploads: most files per request, and threads storing their blobs.
+# Every blob of a batch stays pending until the whole batch is stored.
+FILE_BATCH_UPLOAD_MAX_FILES = int(os.getenv("FILE_BATCH_UPLOAD_MAX_FILES", 100))
+FILE_BATCH_UPLOAD_WORKERS = int(os.getenv("FILE_BATCH_UPLOAD_WORKERS", 8))
+DATA_UPLOAD_MAX_NUMBER_FILES = FILE_BATCH_UPLOAD_MAX_FILES
+
+# Most files one bulk ZIP download may bundle
+FILE_ZIP_MAX_FILES = 500
+
+# Resumable uploads
+# Parts must be a multiple of the segment size and fit nginx's body limit
+FILE_UPLOAD_PART_SIZE = 8 * 1024 * 1024
+FILE_UPLOAD_MAX_PART_SIZE = 32 * 1024 * 1024
+FILE_UPLOAD_SESSION_LIFETIME = timedelta(hours=24)
+# A part whose writer made no progress for this long may be written again
+FILE_UPLOAD_PART_TIMEOUT = timedelta(minutes=5)
+
 # Logging configuration
 LOGGING = {
     "version": 1,
@@ -1,55 +1,212 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import router
 from rest_framework.authentication import BaseAuthentication
-from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken, Token
+from core.blacklist import blacklist_filter
 from core.models import User
 from rest_framework.exceptions import AuthenticationFailed
 
-class CookieJWTAuthentication(BaseAuthentication):
+# Token claim carrying User.token_version
+VERSION_CLAIM = "ver"
+
+
+def set_user_claims(token, user):
     """
-    Custom authentication class to handle cookie-based JWT authentication
-    with automatic access token refresh.
+    Copies what permission checks need into ``token``, so requests carrying
+    it are authorized without loading the user. Access tokens created from
+    a refresh token inherit its claims.
     """
+    for name in User.CLAIM_FIELDS:
+        token[name] = getattr(user, name)
+    token[VERSION_CLAIM] = user.token_version
+    return token
 
-    def authenticate(self, request):
-        # Retrieve tokens from cookies
-        access_token = request.COOKIES.get("access")
-        refresh_token = request.COOKIES.get("refresh")
 
-        if not access_token and not refresh_token:
-            return None  # No tokens provided, user remains unauthenticated
+def current_token_version(user_id):
+    """
+    Returns the token version of ``user_id`` (None for a deleted user). It
+    is cached for an access token lifetime and updated by User.save().
+    """
+    key = User.token_version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        version = (
+            User.objects.filter(pk=user_id)
+            .values_list("token_version", flat=True)
+            .first()
+        )
+        if version is not None:
+            cache.set(key, version, jwt_settings.ACCESS_TOKEN_LIFETIME.total_seconds())
+    return version
+
+
+def user_from_claims(token):
+    """
+    Returns the User of an access token, or None if its claims are missing
+    or out of date. Only the claimed fields are set: the row is loaded when
+    any other field is first accessed.
+    """
+    known = {name: token.get(name) for name in User.CLAIM_FIELDS}
+    if None in known.values() or VERSION_CLAIM not in token:
+        return None
+    if not known["is_active"]:
+        return None
+    user_id = token[jwt_settings.USER_ID_CLAIM]
+    if token[VERSION_CLAIM] != current_token_version(user_id):
+        return None
+    known.update(id=user_id, token_version=token[VERSION_CLAIM])
+    names = [f.attname for f in User._meta.concrete_fields if f.attname in known]
+    return User.from_db(
+        router.db_for_read(User), names, [known[name] for name in names]
+    )
+
+
+class FilteredRefreshToken(RefreshToken):
+    """
+    A refresh token checked against the in-process blacklist filter, which
+    only queries BlacklistedToken for jtis it holds.
+    """
+
+    def check_blacklist(self):
+        if blacklist_filter.is_blacklisted(self.payload[jwt_settings.JTI_CLAIM]):
+            raise TokenError("Token is blacklisted")
+
+
+class _RefreshToken(FilteredRefreshToken):
+    """
+    A refresh token verified without the blacklist lookup, which
+    ``renew_access_token`` runs itself before handing out any access token.
+    """
 
+    def verify(self, *args, **kwargs):
+        Token.verify(self, *args, **kwargs)
+
+
+def renewal_due(access):
+    """
+    Whether ``access`` expires within JWT_ACCESS_TOKEN_RENEWAL_WINDOW.
+    """
+    window = settings.JWT_ACCESS_TOKEN_RENEWAL_WINDOW.total_seconds()
+    return access["exp"] - time.time() <= window
+
+
+def renew_access_token(raw_refresh):
+    """
+    Returns ``(access token, user)`` for the refresh token ``raw_refresh``.
+
+    The minted token is cached under the refresh token's jti until it is due
+    for renewal itself, and handed to the requests that follow with the same
+    refresh token (e.g. the parallel requests of a page that all carry the
+    same expired cookie). Each refresh token so signs about one access token
+    per lifetime; a blacklisted refresh token gets none, even one already
+    cached. Raises TokenError, User.DoesNotExist or AuthenticationFailed.
+    """
+    refresh = _RefreshToken(raw_refresh)
+    key = f"access-token-renewal:{refresh[jwt_settings.JTI_CLAIM]}"
+    if hasattr(refresh, "check_blacklist"):
+        try:
+            refresh.check_blacklist()
+        except TokenError:
+            # Logged out: stop handing out the token minted before
+            cache.delete(key)
+            raise
+    cached = cache.get(key)
+    if cached is not None:
         try:
-            # Step 1: Validate the access token
-            if access_token:
-                token = AccessToken(access_token)
-                user_id = token["user_id"]
-                user = User.objects.get(id=user_id)
-                return (user, None)  # Valid access token, no refresh needed
+            access = AccessToken(cached)
+            user = user_from_claims(access)
+        except TokenError:
+            user = None
+        if user is not None and not renewal_due(access):
+            return cached, user
+
+    user = User.objects.get(id=refresh[jwt_settings.USER_ID_CLAIM])
+    if not user.is_active:
+        raise AuthenticationFailed("User is inactive.")
+    minted = str(set_user_claims(refresh.access_token, user))
+    timeout = (
+        jwt_settings.ACCESS_TOKEN_LIFETIME - settings.JWT_ACCESS_TOKEN_RENEWAL_WINDOW
+    ).total_seconds()
+    if cached is not None:
+        cache.set(key, minted, timeout)
+    elif not cache.add(key, minted, timeout):
+        # A concurrent request minted one first: hand out the same token
+        minted = cache.get(key, minted)
+    return minted, user
+
+
+def _authenticate_cookies(request):
+    """
+    Returns ``(user, error)`` for the JWT cookies of ``request``. An access
+    token that is expired, outdated or close to expiry is renewed from the
+    refresh token: the new token is left in ``request.new_access_token`` for
+    the middleware to set as a cookie.
+    """
+    access_token = request.COOKIES.get("access")
+    refresh_token = request.COOKIES.get("refresh")
 
+    if access_token:
+        try:
+            access = AccessToken(access_token)
+            user = user_from_claims(access)
         except Exception:
             # Access token is invalid or expired, proceed to refresh
-            pass
+            user = None
+        if user is not None:
+            # Renew ahead of expiry, so requests rarely arrive with an
+            # expired token
+            if refresh_token and renewal_due(access):
+                try:
+                    request.new_access_token, _ = renew_access_token(refresh_token)
+                except (TokenError, User.DoesNotExist, AuthenticationFailed):
+                    pass
+            return user, None
 
+    if refresh_token:
         try:
-            # Step 2: Attempt to refresh the access token
-            if refresh_token:
-                refresh = RefreshToken(refresh_token)
-                user_id = refresh["user_id"]
-                user = User.objects.get(id=user_id)
+            new_access_token, user = renew_access_token(refresh_token)
+        except AuthenticationFailed as e:
+            return None, e
+        except (TokenError, KeyError, User.DoesNotExist):
+            return None, AuthenticationFailed(
+                "Authentication credentials are invalid or expired."
+            )
+        request.new_access_token = new_access_token
+        request.refresh_token_refreshed = True
+        return user, None
 
-                # Generate a new access token
-                new_access_token = str(refresh.access_token)
+    return None, None
 
-                # Attach the new access token to the request
-                request.new_access_token = new_access_token
 
-                # Optionally, set the new access token in the response
-                # This requires response modification in the view or middleware
-                request.refresh_token_refreshed = True
+def authenticate_cookies(request):
+    """
+    Authenticates ``request`` from its JWT cookies once per request: the
+    result is kept on the underlying HttpRequest, so CookieJWTMiddleware and
+    CookieJWTAuthentication share one token decode and one user query.
+    """
+    request = getattr(request, "_request", request)
+    try:
+        return request._cookie_jwt_auth
+    except AttributeError:
+        request._cookie_jwt_auth = _authenticate_cookies(request)
+        return request._cookie_jwt_auth
 
-                return (user, None)  # User authenticated with refreshed token
 
-        except Exception as e:
-            # If refresh token is invalid or expired, raise an authentication error
-            raise AuthenticationFailed("Authentication credentials are invalid or expired.")
+class CookieJWTAuthentication(BaseAuthentication):
+    """
+    Custom authentication class to handle cookie-based JWT authentication
+    with automatic access token refresh.
+    """
 
-        return None
+    def authenticate(self, request):
+        user, error = authenticate_cookies(request)
+        if error is not None:
+            raise error
+        if user is None:
+            return None  # No tokens provided, user remains unauthenticated
+        return (user, None)
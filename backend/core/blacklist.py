@@ -0,0 +1,213 @@
+"""
+In-process filter of blacklisted refresh tokens.
+
+Verifying a refresh token used to look its jti up in BlacklistedToken on
+every use. Each process now keeps a Bloom filter of the blacklisted jtis:
+a jti the filter has never seen is known not to be blacklisted without a
+query, and only the (rare) hits are confirmed in the database.
+
+The filter is built from the table on first use and then follows it with
+a change cursor on BlacklistedToken.id, read at most every
+JWT_BLACKLIST_FILTER_SYNC_SECONDS; tokens blacklisted by this process are
+added at once. Ids skipped by the cursor, e.g. rows of a transaction that
+had not committed yet, are re-read until they appear or
+BLACKLIST_GAP_SECONDS pass. Rows deleted from the table stay in the filter
+until the next full rebuild, every JWT_BLACKLIST_FILTER_REBUILD_SECONDS or
+once it holds more jtis than it was sized for.
+"""
+
+import hashlib
+import logging
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Max, Q
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+
+logger = logging.getLogger(__name__)
+
+# How long an id skipped by the change cursor is looked for again
+BLACKLIST_GAP_SECONDS = 60
+# Larger jumps of the id sequence are not in-flight rows
+BLACKLIST_MAX_GAP = 1000
+
+MIN_CAPACITY = 1024
+
+
+class BloomFilter:
+    """
+    A Bloom filter of strings sized for ``capacity`` items at a false
+    positive rate of ``error_rate``.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.bits = max(
+            8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.array = bytearray((self.bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, item):
+        positions = self._positions(item)
+        # Counts items once when added again, e.g. by a sync after add()
+        if all(self.array[p >> 3] & (1 << (p & 7)) for p in positions):
+            return
+        for position in positions:
+            self.array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(
+            self.array[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+    def expected_error_rate(self):
+        """
+        The false positive rate expected at the current number of items.
+        """
+        return (1 - math.exp(-self.hashes * self.count / self.bits)) ** self.hashes
+
+
+class BlacklistFilter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.bloom = None
+        self.cursor = 0
+        # Ids below the cursor not seen yet: id -> time first skipped
+        self.gaps = {}
+        self.built_at = self.synced_at = 0.0
+        self.checks = self.positives = self.false_positives = 0
+
+    def _build(self):
+        """
+        Rebuilds the filter from the whole table.
+        """
+        count = BlacklistedToken.objects.count()
+        bloom = BloomFilter(
+            max(2 * count, MIN_CAPACITY), settings.JWT_BLACKLIST_FILTER_ERROR_RATE
+        )
+        cursor = BlacklistedToken.objects.aggregate(cursor=Max("id"))["cursor"] or 0
+        jtis = BlacklistedToken.objects.filter(id__lte=cursor).values_list(
+            "token__jti", flat=True
+        )
+        for jti in jtis.iterator(chunk_size=10000):
+            bloom.add(jti)
+        self.bloom, self.cursor, self.gaps = bloom, cursor, {}
+        self.built_at = self.synced_at = time.monotonic()
+        logger.info(
+            "Built blacklist filter: %d tokens, %d bytes", bloom.count, len(bloom.array)
+        )
+
+    def _sync(self):
+        """
+        Adds the rows blacklisted since the last sync.
+        """
+        changed = Q(id__gt=self.cursor)
+        if self.gaps:
+            changed |= Q(id__in=list(self.gaps))
+        rows = BlacklistedToken.objects.filter(changed).order_by("id")
+        now = time.monotonic()
+        expected = self.cursor + 1
+        for pk, jti in rows.values_list("id", "token__jti").iterator():
+            self.bloom.add(jti)
+            self.gaps.pop(pk, None)
+            if pk >= expected:
+                if pk - expected <= BLACKLIST_MAX_GAP:
+                    self.gaps.update(dict.fromkeys(range(expected, pk), now))
+                expected = pk + 1
+        self.cursor = expected - 1
+        self.gaps = {
+            pk: skipped_at
+            for pk, skipped_at in self.gaps.items()
+            if now - skipped_at < BLACKLIST_GAP_SECONDS
+        }
+        self.synced_at = now
+
+    def _due(self):
+        return (
+            self.bloom is None
+            or time.monotonic() - self.synced_at
+            >= settings.JWT_BLACKLIST_FILTER_SYNC_SECONDS
+        )
+
+    def _refresh(self):
+        if not self._due():
+            return
+        with self._lock:
+            # Another thread may have caught up while this one waited
+            if not self._due():
+                return
+            if (
+                self.bloom is None
+                or self.bloom.count > self.bloom.capacity
+                or time.monotonic() - self.built_at
+                >= settings.JWT_BLACKLIST_FILTER_REBUILD_SECONDS
+            ):
+                self._build()
+            else:
+                self._sync()
+
+    def add(self, jti):
+        """
+        Adds a jti blacklisted by this process, ahead of the next sync.
+        """
+        if self.bloom is not None:
+            self.bloom.add(jti)
+
+    def is_blacklisted(self, jti):
+        """
+        Whether the token ``jti`` is blacklisted. Only jtis the filter holds
+        are looked up in the database.
+        """
+        self._refresh()
+        self.checks += 1
+        if jti not in self.bloom:
+            return False
+        self.positives += 1
+        if BlacklistedToken.objects.filter(token__jti=jti).exists():
+            return True
+        self.false_positives += 1
+        return False
+
+    def reset(self):
+        """
+        Drops the filter, to be rebuilt on the next check.
+        """
+        with self._lock:
+            self.bloom = None
+            self.checks = self.positives = self.false_positives = 0
+
+    def stats(self):
+        """
+        Size and accuracy of the filter, and how many checks it answered
+        without a query.
+        """
+        bloom = self.bloom
+        negatives = self.checks - self.positives + self.false_positives
+        return {
+            "tokens": bloom.count if bloom else 0,
+            "capacity": bloom.capacity if bloom else 0,
+            "size_bytes": len(bloom.array) if bloom else 0,
+            "hash_functions": bloom.hashes if bloom else 0,
+            "expected_false_positive_rate": bloom.expected_error_rate() if bloom else 0,
+            "checks": self.checks,
+            "database_checks": self.positives,
+            "false_positives": self.false_positives,
+            "false_positive_rate": self.false_positives / negatives if negatives else 0,
+            "cursor": self.cursor,
+        }
+
+
+blacklist_filter = BlacklistFilter()
@@ -0,0 +1,567 @@
+"""
+Segmented AES-GCM container format for encrypted file blobs.
+
+Version 2 blobs are laid out as a fixed-size header followed by a sequence of
+independently authenticated segments (all integers are big-endian):
+
+    magic         4 bytes   b"SFSE"
+    version       1 byte    FORMAT_VERSION
+    flags         1 byte    low nibble: compression codec, rest reserved
+    segment_size  4 bytes   plaintext bytes per segment
+    nonce_prefix  7 bytes   random per blob
+    commitment   32 bytes   key commitment derived from the data key
+    segments      ...       ciphertext || 16-byte tag, one per segment
+
+Segment ``i`` is sealed with the nonce ``nonce_prefix || i || last`` and the
+whole header as associated data, so segments cannot be reordered, dropped,
+truncated or moved between blobs without failing authentication. Every
+segment holds exactly ``segment_size`` plaintext bytes except the last one,
+which holds the remainder (possibly zero bytes for an empty file).
+
+When a codec is set, the segments hold the compressed stream rather than
+the raw content; ``iter_decrypt`` decompresses it unless asked not to.
+
+Version 1 blobs (``iv || ciphertext || tag`` as a single GCM message) carry no
+header. They are told apart by the magic and version byte; a random IV starts
+with those five bytes with probability 2**-40.
+"""
+
+import hashlib
+import hmac
+import os
+import struct
+import zlib
+from dataclasses import dataclass
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+try:
+    import zstandard
+except ImportError:  # zstd compression is optional
+    zstandard = None
+
+MAGIC = b"SFSE"
+FORMAT_VERSION = 2
+LEGACY_FORMAT_VERSION = 1
+
+NONCE_PREFIX_SIZE = 7
+COMMITMENT_SIZE = 32
+TAG_SIZE = 16
+LEGACY_IV_SIZE = 12
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024
+MAX_SEGMENT_SIZE = 16 * 1024 * 1024
+
+_HEADER_PREFIX = struct.Struct(">4sBBI7s")
+HEADER_SIZE = _HEADER_PREFIX.size + COMMITMENT_SIZE
+_COUNTER = struct.Struct(">IB")
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODEC_MASK = 0x0F
+CODECS = {"none": CODEC_NONE, "zlib": CODEC_ZLIB, "zstd": CODEC_ZSTD}
+# HTTP content-coding tokens of the stored codecs ("deflate" is zlib format)
+CONTENT_ENCODINGS = {CODEC_ZLIB: "deflate", CODEC_ZSTD: "zstd"}
+
+
+class BlobIntegrityError(ValueError):
+    """Raised when an encrypted blob fails authentication or is malformed."""
+
+
+@dataclass(frozen=True)
+class Header:
+    segment_size: int
+    nonce_prefix: bytes
+    commitment: bytes
+    flags: int = 0
+    version: int = FORMAT_VERSION
+
+    @property
+    def codec(self) -> int:
+        return self.flags & CODEC_MASK
+
+    @property
+    def prefix(self) -> bytes:
+        return _HEADER_PREFIX.pack(
+            MAGIC, self.version, self.flags, self.segment_size, self.nonce_prefix
+        )
+
+    def to_bytes(self) -> bytes:
+        return self.prefix + self.commitment
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Header":
+        if len(data) < HEADER_SIZE:
+            raise BlobIntegrityError("Encrypted blob header is truncated")
+        magic, version, flags, segment_size, nonce_prefix = _HEADER_PREFIX.unpack(
+            data[: _HEADER_PREFIX.size]
+        )
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise BlobIntegrityError("Unsupported encrypted blob format")
+        if not 0 < segment_size <= MAX_SEGMENT_SIZE:
+            raise BlobIntegrityError("Invalid segment size in blob header")
+        if flags & CODEC_MASK not in CONTENT_ENCODINGS and flags & CODEC_MASK:
+            raise BlobIntegrityError("Unknown compression codec in blob header")
+        return cls(
+            segment_size=segment_size,
+            nonce_prefix=nonce_prefix,
+            commitment=bytes(data[_HEADER_PREFIX.size : HEADER_SIZE]),
+            flags=flags,
+            version=version,
+        )
+
+
+def _derive(key: bytes, header_prefix: bytes):
+    """
+    Derives the segment key and the key commitment for a blob.
+    Both are bound to the header so a blob cannot be reinterpreted under a
+    different segment size or nonce prefix.
+    """
+    okm = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32 + COMMITMENT_SIZE,
+        salt=header_prefix,
+        info=b"sfs segmented blob v2",
+    ).derive(bytes(key))
+    return okm[:32], okm[32:]
+
+
+def _nonce(header: Header, index: int, last: bool) -> bytes:
+    return header.nonce_prefix + _COUNTER.pack(index, 1 if last else 0)
+
+
+def ciphertext_segment_size(segment_size: int) -> int:
+    return segment_size + TAG_SIZE
+
+
+def is_segmented(prefix: bytes) -> bool:
+    """
+    Returns True if the leading bytes of a blob belong to a segmented blob.
+    """
+    return prefix[:5] == MAGIC + bytes([FORMAT_VERSION])
+
+
+class SegmentCipher:
+    """
+    Seals and opens individual segments of one blob.
+    """
+
+    def __init__(self, key: bytes, header: Header):
+        segment_key, commitment = _derive(key, header.prefix)
+        if not hmac.compare_digest(commitment, header.commitment):
+            raise BlobIntegrityError("Blob key commitment does not match")
+        self.header = header
+        self._aad = header.to_bytes()
+        self._aead = AESGCM(segment_key)
+
+    @classmethod
+    def create(
+        cls, key: bytes, segment_size: int = DEFAULT_SEGMENT_SIZE, codec=CODEC_NONE
+    ):
+        """
+        Builds a cipher for a new blob with a fresh random nonce prefix.
+        """
+        if not 0 < segment_size <= MAX_SEGMENT_SIZE:
+            raise ValueError("Segment size out of range")
+        header = Header(
+            segment_size=segment_size,
+            nonce_prefix=os.urandom(NONCE_PREFIX_SIZE),
+            commitment=b"",
+            flags=codec,
+        )
+        _, commitment = _derive(key, header.prefix)
+        return cls(
+            key,
+            Header(
+                segment_size=segment_size,
+                nonce_prefix=header.nonce_prefix,
+                commitment=commitment,
+                flags=codec,
+            ),
+        )
+
+    def seal(self, index: int, data: bytes, last: bool) -> bytes:
+        return self._aead.encrypt(_nonce(self.header, index, last), data, self._aad)
+
+    def open(self, index: int, data: bytes, last: bool) -> bytes:
+        try:
+            return self._aead.decrypt(
+                _nonce(self.header, index, last), bytes(data), self._aad
+            )
+        except InvalidTag:
+            raise BlobIntegrityError(f"Segment {index} failed authentication")
+
+
+class ContentDigest:
+    """
+    Keyed content hash used to find duplicate uploads.
+
+    The content is split into ``segment_size`` pieces, each piece is hashed
+    with SHA-256 and the piece hashes are fed, in order, into HMAC-SHA256.
+    Parts of a resumable upload can therefore be hashed in any order and
+    combined once every part has arrived. The digest covers the original
+    content, whatever codec the blob ends up stored with.
+    """
+
+    def __init__(self, secret: bytes, segment_size: int):
+        self._mac = hmac.new(
+            secret, struct.pack(">I", segment_size), digestmod=hashlib.sha256
+        )
+        self.segment_size = segment_size
+        self.size = 0
+        self._buffer = bytearray()
+
+    @staticmethod
+    def leaf(segment: bytes) -> bytes:
+        return hashlib.sha256(segment).digest()
+
+    def update(self, data: bytes):
+        self._buffer += data
+        while len(self._buffer) >= self.segment_size:
+            piece = bytes(self._buffer[: self.segment_size])
+            del self._buffer[: self.segment_size]
+            self.add_leaves(self.leaf(piece), len(piece))
+
+    def add_leaves(self, leaves: bytes, size: int):
+        self._mac.update(leaves)
+        self.size += size
+
+    def hexdigest(self) -> str:
+        mac = self._mac.copy()
+        size = self.size
+        if self._buffer or not size:
+            mac.update(self.leaf(bytes(self._buffer)))
+            size += len(self._buffer)
+        mac.update(struct.pack(">Q", size))
+        return mac.hexdigest()
+
+
+def codec_by_name(name: str) -> int:
+    try:
+        codec = CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unknown compression codec {name!r}")
+    if codec == CODEC_ZSTD and zstandard is None:
+        raise ValueError("zstd compression requires the zstandard package")
+    return codec
+
+
+def _compressor(codec: int, level=None):
+    if codec == CODEC_ZLIB:
+        return zlib.compressobj(6 if level is None else level)
+    return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+
+
+def _decompressor(codec: int):
+    if codec == CODEC_ZLIB:
+        return zlib.decompressobj()
+    if zstandard is None:
+        raise BlobIntegrityError("zstd compressed blob requires zstandard")
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def choose_codec(sample: bytes, codec: int, max_ratio: float = 0.9) -> int:
+    """
+    Returns ``codec`` if a fast trial compression of ``sample`` shrinks it to
+    at most ``max_ratio`` of its size, and CODEC_NONE otherwise.
+    """
+    if codec == CODEC_NONE or not sample:
+        return CODEC_NONE
+    compressor = _compressor(codec, level=1)
+    trial = compressor.compress(sample) + compressor.flush()
+    return codec if len(trial) <= len(sample) * max_ratio else CODEC_NONE
+
+
+def seal_segments(cipher: SegmentCipher, first: int, chunks, last=None, executor=None):
+    """
+    Seals ``chunks`` as the consecutive segments starting at index ``first``
+    and returns the sealed segments in order. ``last`` is the index of the
+    blob's final segment, if it is among them. Runs the chunks on
+    ``executor`` when one is given and there is more than one of them.
+    """
+
+    def seal(index, chunk):
+        return cipher.seal(index, chunk, last=index == last)
+
+    indexes = range(first, first + len(chunks))
+    if executor is None or len(chunks) < 2:
+        return list(map(seal, indexes, chunks))
+    return list(executor.map(seal, indexes, chunks))
+
+
+class SegmentEncryptor:
+    """
+    Incremental encryptor producing a segmented blob.
+
+    ``update`` returns the header (on the first call) followed by every
+    segment that can be sealed so far; ``finalize`` seals the last segment.
+    At most one segment of plaintext is buffered at any time. With a codec,
+    the content is compressed before it is cut into segments.
+
+    With an ``executor``, the full segments gathered by one ``update`` call
+    are sealed concurrently (AES-GCM releases the GIL) and written back in
+    order, so larger ``update`` chunks give more parallelism.
+    """
+
+    def __init__(
+        self,
+        key: bytes,
+        segment_size: int = DEFAULT_SEGMENT_SIZE,
+        codec=CODEC_NONE,
+        executor=None,
+    ):
+        self.cipher = SegmentCipher.create(key, segment_size, codec)
+        self.executor = executor
+        self._compressor = _compressor(codec) if codec else None
+        self.segment_size = segment_size
+        self.segments = 0
+        self._buffer = bytearray()
+        self._header_written = False
+        self._finalized = False
+
+    @property
+    def header(self) -> Header:
+        return self.cipher.header
+
+    def _take_header(self) -> bytes:
+        if self._header_written:
+            return b""
+        self._header_written = True
+        return self.cipher.header.to_bytes()
+
+    def update(self, data: bytes) -> bytes:
+        if self._finalized:
+            raise ValueError("Encryptor already finalized")
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        return self._push(data)
+
+    def _push(self, data: bytes) -> bytes:
+        self._buffer += data
+        # Hold back one full segment: it may turn out to be the last one.
+        count = (len(self._buffer) - 1) // self.segment_size
+        if count <= 0:
+            return self._take_header()
+        size = count * self.segment_size
+        view = memoryview(self._buffer)
+        chunks = [
+            bytes(view[start : start + self.segment_size])
+            for start in range(0, size, self.segment_size)
+        ]
+        view.release()
+        del self._buffer[:size]
+        first = self.segments
+        self.segments += count
+        sealed = seal_segments(self.cipher, first, chunks, None, self.executor)
+        return self._take_header() + b"".join(sealed)
+
+    def finalize(self) -> bytes:
+        if self._finalized:
+            raise ValueError("Encryptor already finalized")
+        out = b""
+        if self._compressor is not None:
+            out = self._push(self._compressor.flush())
+        self._finalized = True
+        out += self._take_header() + self.cipher.seal(
+            self.segments, bytes(self._buffer), last=True
+        )
+        self.segments += 1
+        self._buffer = bytearray()
+        return out
+
+
+def encrypt_stream(
+    key: bytes,
+    src,
+    dst,
+    segment_size: int = DEFAULT_SEGMENT_SIZE,
+    codec=CODEC_NONE,
+    executor=None,
+    batch: int = 1,
+) -> int:
+    """
+    Encrypts the readable ``src`` into the writable ``dst`` as a segmented
+    blob and returns the number of plaintext bytes consumed. ``src`` is read
+    ``batch`` segments at a time, which are sealed on ``executor`` if given.
+    """
+    encryptor = SegmentEncryptor(key, segment_size, codec, executor)
+    total = 0
+    while True:
+        chunk = src.read(segment_size * max(batch, 1))
+        if not chunk:
+            break
+        total += len(chunk)
+        dst.write(encryptor.update(chunk))
+    dst.write(encryptor.finalize())
+    return total
+
+
+def wrap_key(master_key: bytes, key: bytes) -> bytes:
+    """
+    Wraps a data key under a master key as ``iv || ciphertext || tag``.
+    """
+    iv = os.urandom(LEGACY_IV_SIZE)
+    return iv + AESGCM(bytes(master_key)).encrypt(iv, bytes(key), None)
+
+
+def unwrap_key(master_key: bytes, wrapped: bytes) -> bytes:
+    wrapped = bytes(wrapped)
+    try:
+        return AESGCM(bytes(master_key)).decrypt(
+            wrapped[:LEGACY_IV_SIZE], wrapped[LEGACY_IV_SIZE:], None
+        )
+    except InvalidTag:
+        raise BlobIntegrityError("Data key failed to unwrap")
+
+
+def plaintext_size(blob_size: int, header: Header = None) -> int:
+    """
+    Returns the plaintext length of a blob from its total size on disk.
+    A ``header`` of None means a version 1 blob.
+    """
+    if header is None:
+        return max(blob_size - LEGACY_IV_SIZE - TAG_SIZE, 0)
+    body = blob_size - HEADER_SIZE
+    full, rest = divmod(body, ciphertext_segment_size(header.segment_size))
+    return full * header.segment_size + max(rest - TAG_SIZE, 0)
+
+
+def read_header(src):
+    """
+    Reads the header of the blob open in ``src`` and rewinds it.
+    Returns None for a version 1 blob.
+    """
+    src.seek(0)
+    data = read_exact(src, HEADER_SIZE)
+    src.seek(0)
+    if not is_segmented(data):
+        return None
+    return Header.from_bytes(data)
+
+
+def read_exact(src, size: int) -> bytes:
+    parts = []
+    while size:
+        chunk = src.read(size)
+        if not chunk:
+            break
+        parts.append(chunk)
+        size -= len(chunk)
+    return b"".join(parts)
+
+
+def iter_segments(src, header: Header):
+    """
+    Yields ``(index, ciphertext, last)`` for every segment following the
+    header, reading one segment ahead so the final one can be recognised.
+    """
+    size = ciphertext_segment_size(header.segment_size)
+    index = 0
+    current = read_exact(src, size)
+    if len(current) < TAG_SIZE:
+        raise BlobIntegrityError("Encrypted blob is truncated")
+    while True:
+        following = read_exact(src, size) if len(current) == size else b""
+        if following and len(following) < TAG_SIZE:
+            raise BlobIntegrityError("Encrypted blob is truncated")
+        yield index, current, not following
+        if not following:
+            return
+        current = following
+        index += 1
+
+
+def iter_decrypt_segmented(key: bytes, src, decode: bool = True):
+    header = Header.from_bytes(read_exact(src, HEADER_SIZE))
+    cipher = SegmentCipher(key, header)
+    decompressor = _decompressor(header.codec) if header.codec and decode else None
+    for index, data, last in iter_segments(src, header):
+        plaintext = cipher.open(index, data, last)
+        if decompressor is not None:
+            plaintext = decompressor.decompress(plaintext)
+        if plaintext:
+            yield plaintext
+    if decompressor is not None:
+        tail = decompressor.flush()
+        if tail:
+            yield tail
+
+
+def segment_count(blob_size: int, header: Header) -> int:
+    body = blob_size - HEADER_SIZE
+    return -(-body // ciphertext_segment_size(header.segment_size))
+
+
+def iter_decrypt_range(key: bytes, src, header: Header, blob_size: int, start, end):
+    """
+    Yields the plaintext bytes ``start`` to ``end`` (inclusive) of a segmented
+    blob, reading and authenticating only the segments that cover them.
+    """
+    cipher = SegmentCipher(key, header)
+    size = ciphertext_segment_size(header.segment_size)
+    last_index = segment_count(blob_size, header) - 1
+    first = start // header.segment_size
+    final = min(end // header.segment_size, last_index)
+
+    src.seek(HEADER_SIZE + first * size)
+    for index in range(first, final + 1):
+        data = read_exact(src, size)
+        if len(data) < TAG_SIZE:
+            raise BlobIntegrityError("Encrypted blob is truncated")
+        plaintext = cipher.open(index, data, last=index == last_index)
+        offset = index * header.segment_size
+        lo = max(start - offset, 0)
+        hi = min(end - offset + 1, len(plaintext))
+        yield plaintext[lo:hi]
+
+
+def iter_decrypt_legacy(key: bytes, src, chunk_size: int = DEFAULT_SEGMENT_SIZE):
+    """
+    Streams a version 1 blob. The single GCM tag only covers the whole file,
+    so a corrupted legacy blob is reported after its plaintext was produced.
+    """
+    src.seek(0, os.SEEK_END)
+    length = src.tell()
+    if length < LEGACY_IV_SIZE + TAG_SIZE:
+        raise BlobIntegrityError("Encrypted blob is truncated")
+    src.seek(length - TAG_SIZE)
+    tag = read_exact(src, TAG_SIZE)
+    src.seek(0)
+    iv = read_exact(src, LEGACY_IV_SIZE)
+
+    decryptor = Cipher(
+        algorithms.AES(bytes(key)), modes.GCM(iv, tag), backend=default_backend()
+    ).decryptor()
+    remaining = length - LEGACY_IV_SIZE - TAG_SIZE
+    while remaining:
+        chunk = src.read(min(chunk_size, remaining))
+        if not chunk:
+            raise BlobIntegrityError("Encrypted blob is truncated")
+        remaining -= len(chunk)
+        yield decryptor.update(chunk)
+    try:
+        tail = decryptor.finalize()
+    except InvalidTag:
+        raise BlobIntegrityError("Blob failed authentication")
+    if tail:
+        yield tail
+
+
+def iter_decrypt(key: bytes, src, decode: bool = True):
+    """
+    Yields the plaintext of a blob of either format chunk by chunk.
+    ``src`` must be a seekable binary file positioned at the start of the blob.
+    With ``decode=False`` a compressed blob yields its compressed stream.
+    """
+    prefix = read_exact(src, 5)
+    src.seek(0)
+    if is_segmented(prefix):
+        yield from iter_decrypt_segmented(key, src, decode)
+    else:
+        yield from iter_decrypt_legacy(key, src)
@@ -0,0 +1,182 @@
+"""
+In-process stand-in for an S3 endpoint.
+
+``FakeS3Client`` implements the part of the boto3 S3 client API used by
+``core.storage.S3BlobStorage``, with S3's error codes, so the S3 backend can
+be exercised in tests and local development without a network service:
+
+    STORAGES["blobs"] = {
+        "BACKEND": "core.storage.S3BlobStorage",
+        "OPTIONS": {"bucket": "blobs", "client": FakeS3Client()},
+    }
+"""
+
+import hashlib
+import io
+import threading
+import uuid
+
+from django.utils import timezone
+
+from core.storage import MIN_PART_SIZE  # noqa: F401
+
+
+class ClientError(Exception):
+    def __init__(self, code, message=""):
+        super().__init__(f"{code}: {message}" if message else code)
+        self.response = {"Error": {"Code": code, "Message": message}}
+
+
+class _Exceptions:
+    ClientError = ClientError
+
+
+class FakeS3Client:
+    """
+    Thread-safe in-memory object store. ``min_part_size`` defaults to 0 so
+    tests can use tiny parts; set it to MIN_PART_SIZE to mirror S3.
+    """
+
+    exceptions = _Exceptions
+
+    def __init__(self, min_part_size=0):
+        self.min_part_size = min_part_size
+        self.objects = {}
+        self.uploads = {}
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def _record(self, operation, **kwargs):
+        self.requests.append((operation, kwargs))
+
+    def _object(self, bucket, key):
+        try:
+            return self.objects[(bucket, key)]
+        except KeyError:
+            raise ClientError("NoSuchKey", key)
+
+    def _upload(self, upload_id):
+        try:
+            return self.uploads[upload_id]
+        except KeyError:
+            raise ClientError("NoSuchUpload", upload_id)
+
+    @staticmethod
+    def _read_body(body):
+        if isinstance(body, (bytes, bytearray)):
+            return bytes(body)
+        return body.read()
+
+    def put_object(self, Bucket, Key, Body=b""):
+        data = self._read_body(Body)
+        with self._lock:
+            self._record("PutObject", Key=Key)
+            self.objects[(Bucket, Key)] = (data, timezone.now())
+        return {"ETag": f'"{hashlib.md5(data).hexdigest()}"'}
+
+    def head_object(self, Bucket, Key):
+        with self._lock:
+            self._record("HeadObject", Key=Key)
+            data, modified = self._object(Bucket, Key)
+        return {"ContentLength": len(data), "LastModified": modified}
+
+    def get_object(self, Bucket, Key, Range=None):
+        with self._lock:
+            self._record("GetObject", Key=Key, Range=Range)
+            data, modified = self._object(Bucket, Key)
+        start, end = 0, len(data) - 1
+        if Range is not None:
+            first, _, last = Range.removeprefix("bytes=").partition("-")
+            start = int(first)
+            if last:
+                end = min(int(last), end)
+            if start >= len(data):
+                raise ClientError("InvalidRange", Range)
+        body = data[start : end + 1]
+        return {
+            "Body": io.BytesIO(body),
+            "ContentLength": len(body),
+            "LastModified": modified,
+        }
+
+    def copy_object(self, Bucket, Key, CopySource):
+        with self._lock:
+            self._record("CopyObject", Key=Key)
+            data, _ = self._object(CopySource["Bucket"], CopySource["Key"])
+            self.objects[(Bucket, Key)] = (data, timezone.now())
+        return {}
+
+    def delete_object(self, Bucket, Key):
+        with self._lock:
+            self._record("DeleteObject", Key=Key)
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix="", ContinuationToken=None, MaxKeys=1000):
+        with self._lock:
+            self._record("ListObjectsV2", Prefix=Prefix)
+            keys = sorted(
+                key
+                for bucket, key in self.objects
+                if bucket == Bucket
+                and key.startswith(Prefix)
+                and (ContinuationToken is None or key > ContinuationToken)
+            )
+            page = keys[:MaxKeys]
+            contents = [
+                {
+                    "Key": key,
+                    "Size": len(self.objects[(Bucket, key)][0]),
+                    "LastModified": self.objects[(Bucket, key)][1],
+                }
+                for key in page
+            ]
+        response = {"Contents": contents, "IsTruncated": len(keys) > MaxKeys}
+        if response["IsTruncated"]:
+            # Real tokens are opaque; the last key works the same here
+            response["NextContinuationToken"] = page[-1]
+        return response
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._record("CreateMultipartUpload", Key=Key)
+            self.uploads[upload_id] = (Bucket, Key, {})
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if not 1 <= PartNumber <= 10000:
+            raise ClientError("InvalidArgument", "Part number out of range")
+        data = self._read_body(Body)
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        with self._lock:
+            self._record("UploadPart", Key=Key, PartNumber=PartNumber)
+            self._upload(UploadId)[2][PartNumber] = (data, etag)
+        return {"ETag": etag}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        with self._lock:
+            self._record("CompleteMultipartUpload", Key=Key)
+            bucket, key, parts = self._upload(UploadId)
+            listed = MultipartUpload["Parts"]
+            numbers = [part["PartNumber"] for part in listed]
+            if numbers != sorted(set(numbers)):
+                raise ClientError("InvalidPartOrder")
+            chunks = []
+            for i, part in enumerate(listed):
+                data, etag = parts.get(part["PartNumber"], (None, None))
+                if data is None or etag != part["ETag"]:
+                    raise ClientError("InvalidPart", str(part["PartNumber"]))
+                if i < len(listed) - 1 and len(data) < self.min_part_size:
+                    raise ClientError("EntityTooSmall", str(part["PartNumber"]))
+                chunks.append(data)
+            del self.uploads[UploadId]
+            self.objects[(bucket, key)] = (b"".join(chunks), timezone.now())
+        return {"Bucket": bucket, "Key": key}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        with self._lock:
+            self._record("AbortMultipartUpload", Key=Key)
+            self._upload(UploadId)
+            del self.uploads[UploadId]
+        return {}
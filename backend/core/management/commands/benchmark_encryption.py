@@ -0,0 +1,90 @@
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core import crypto
+
+
+class _NullWriter:
+    def write(self, data):
+        return len(data)
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure segmented encryption throughput for a range of worker counts. "
+        "Nothing is written to disk; the input is random, so no compression "
+        "is applied."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--size", type=int, default=256, help="Plaintext size in MiB."
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            nargs="+",
+            default=None,
+            help="Worker counts to try (default: powers of two up to the CPU count).",
+        )
+        parser.add_argument(
+            "--segment-size", type=int, default=settings.FILE_ENCRYPTION_SEGMENT_SIZE
+        )
+        parser.add_argument("--repeat", type=int, default=3)
+
+    def handle(self, *args, **options):
+        if options["size"] < 1:
+            raise CommandError("--size must be at least 1 MiB")
+        workers = options["workers"] or self.default_workers()
+        segment_size = options["segment_size"]
+        data = os.urandom(options["size"] * 1024 * 1024)
+        key = os.urandom(32)
+
+        self.stdout.write(
+            f"{options['size']} MiB, {segment_size} byte segments, "
+            f"best of {options['repeat']}"
+        )
+        baseline = None
+        for count in workers:
+            best = min(
+                self.run(key, data, segment_size, count)
+                for _ in range(max(options["repeat"], 1))
+            )
+            rate = len(data) / best / 1024 / 1024
+            baseline = baseline or rate
+            self.stdout.write(
+                f"{count:>3} workers: {rate:8.1f} MiB/s  ({rate / baseline:.2f}x)"
+            )
+
+    @staticmethod
+    def default_workers():
+        cpus = os.cpu_count() or 1
+        counts = [1]
+        while counts[-1] * 2 <= cpus:
+            counts.append(counts[-1] * 2)
+        if counts[-1] != cpus:
+            counts.append(cpus)
+        return counts
+
+    @staticmethod
+    def run(key, data, segment_size, workers):
+        executor = ThreadPoolExecutor(workers) if workers > 1 else None
+        try:
+            started = time.perf_counter()
+            crypto.encrypt_stream(
+                key,
+                io.BytesIO(data),
+                _NullWriter(),
+                segment_size,
+                executor=executor,
+                batch=workers * 4,
+            )
+            return time.perf_counter() - started
+        finally:
+            if executor is not None:
+                executor.shutdown()
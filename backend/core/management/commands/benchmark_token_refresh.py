@@ -0,0 +1,134 @@
+import statistics
+import time
+import uuid
+from datetime import timedelta
+from io import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework_simplejwt.token_blacklist.models import (
+    BlacklistedToken,
+    OutstandingToken,
+)
+from rest_framework_simplejwt.utils import aware_utcnow
+
+from core.authentication import FilteredRefreshToken
+from core.blacklist import blacklist_filter
+from core.models import User
+from userauth.serializers import CookieTokenRefreshSerializer
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure refresh token rotation latency as the outstanding and "
+        "blacklisted token tables grow, before and after compact_tokens. "
+        "Everything runs in one transaction that is rolled back, which holds "
+        "the database write lock on SQLite: use a development database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--history",
+            type=int,
+            nargs="+",
+            default=[1000, 10000, 100000],
+            help="Numbers of expired, blacklisted tokens to try.",
+        )
+        parser.add_argument("--refreshes", type=int, default=200)
+
+    def handle(self, *args, **options):
+        if options["refreshes"] < 1:
+            raise CommandError("--refreshes must be at least 1")
+        try:
+            with transaction.atomic():
+                self.run(sorted(options["history"]), options["refreshes"])
+                raise _Rollback
+        except _Rollback:
+            pass
+        finally:
+            # The filter may hold jtis of the rolled back rows
+            blacklist_filter.reset()
+
+    def run(self, history, refreshes):
+        user = User.objects.create_user(
+            email=f"benchmark-{uuid.uuid4().hex}@example.com",
+            password=uuid.uuid4().hex,
+            is_active=True,
+        )
+        self.stdout.write(f"{refreshes} refreshes per size; median / p99 latency in ms")
+        for size in history:
+            self.add_history(user, size)
+            build = self.build_filter()
+            before = self.measure(user, refreshes)
+            compacted = StringIO()
+            call_command("compact_tokens", pause=0, stdout=compacted)
+            self.build_filter()
+            after = self.measure(user, refreshes)
+            self.stdout.write(
+                f"{size:>9} expired tokens: "
+                f"{before[0]:6.2f} / {before[1]:6.2f} before compaction, "
+                f"{after[0]:6.2f} / {after[1]:6.2f} after"
+            )
+            self.stdout.write(f"{'':>11}Blacklist filter built in {build:.1f} ms")
+            for line in compacted.getvalue().splitlines():
+                self.stdout.write(f"{'':>11}{line}")
+
+    @staticmethod
+    def add_history(user, size):
+        """
+        Inserts expired, blacklisted tokens until ``size`` are stored.
+        """
+        expires_at = aware_utcnow() - timedelta(days=1)
+        missing = (
+            size - OutstandingToken.objects.filter(expires_at__lte=expires_at).count()
+        )
+        for start in range(0, max(missing, 0), 10000):
+            tokens = OutstandingToken.objects.bulk_create(
+                OutstandingToken(
+                    user=user,
+                    jti=uuid.uuid4().hex,
+                    token="",
+                    created_at=expires_at - timedelta(days=1),
+                    expires_at=expires_at,
+                )
+                for _ in range(min(10000, missing - start))
+            )
+            BlacklistedToken.objects.bulk_create(
+                BlacklistedToken(token=token) for token in tokens
+            )
+
+    @staticmethod
+    def build_filter():
+        """
+        Rebuilds the blacklist filter, as a restart would, outside the
+        measured refreshes; returns how long it took in ms.
+        """
+        blacklist_filter.reset()
+        started = time.perf_counter()
+        blacklist_filter.is_blacklisted("")
+        return (time.perf_counter() - started) * 1000
+
+    @staticmethod
+    def measure(user, refreshes):
+        """
+        Rotates a refresh token ``refreshes`` times as CookieTokenRefreshView
+        does; returns the median and 99th percentile latency in ms.
+        """
+        refresh = str(FilteredRefreshToken.for_user(user))
+        timings = []
+        for _ in range(refreshes):
+            started = time.perf_counter()
+            serializer = CookieTokenRefreshSerializer(data={"refresh": refresh})
+            serializer.is_valid(raise_exception=True)
+            refresh = serializer.validated_data["refresh"]
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        return (
+            statistics.median(timings),
+            timings[min(len(timings) - 1, int(len(timings) * 0.99))],
+        )
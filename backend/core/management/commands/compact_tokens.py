@@ -0,0 +1,113 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.token_blacklist.models import (
+    BlacklistedToken,
+    OutstandingToken,
+)
+from rest_framework_simplejwt.utils import aware_utcnow
+
+
+def expiry_cutoff():
+    """
+    Tokens that expired before this can no longer pass verification, even
+    with the clock skew allowed by LEEWAY.
+    """
+    leeway = jwt_settings.LEEWAY
+    if not isinstance(leeway, timedelta):
+        leeway = timedelta(seconds=leeway)
+    return aware_utcnow() - leeway
+
+
+def delete_tokens(ids):
+    """
+    Deletes the OutstandingTokens ``ids`` and their BlacklistedTokens in one
+    short transaction; returns ``(outstanding, blacklisted)`` deleted.
+    """
+    with transaction.atomic():
+        blacklisted, _ = BlacklistedToken.objects.filter(token_id__in=ids).delete()
+        outstanding, _ = OutstandingToken.objects.filter(id__in=ids).delete()
+    return outstanding, blacklisted
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete expired outstanding and blacklisted refresh tokens in small "
+        "batches, each in its own transaction, so the tables are never locked "
+        "for long. Progress is committed batch by batch: an interrupted run "
+        "is resumed by running the command again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0.05,
+            help="Seconds to wait between batches, letting other writers in.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only count the expired tokens.",
+        )
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be at least 1")
+        if options["pause"] < 0:
+            raise CommandError("--pause must not be negative")
+        cutoff = expiry_cutoff()
+        expired = OutstandingToken.objects.filter(expires_at__lte=cutoff)
+        if options["dry_run"]:
+            self.stdout.write(
+                f"{expired.count()} expired outstanding tokens, "
+                f"{BlacklistedToken.objects.filter(token__in=expired).count()} "
+                "of them blacklisted"
+            )
+            return
+
+        # Walk the primary key, so each batch is found through the index
+        # from where the last one ended instead of from the start
+        started = time.monotonic()
+        outstanding = blacklisted = batches = 0
+        locked = longest = 0.0
+        last_id = 0
+        while True:
+            ids = list(
+                expired.filter(id__gt=last_id)
+                .order_by("id")
+                .values_list("id", flat=True)[: options["batch_size"]]
+            )
+            if not ids:
+                break
+            last_id = ids[-1]
+            if batches and options["pause"]:
+                time.sleep(options["pause"])
+            lock_started = time.monotonic()
+            deleted = delete_tokens(ids)
+            held = time.monotonic() - lock_started
+            outstanding += deleted[0]
+            blacklisted += deleted[1]
+            batches += 1
+            locked += held
+            longest = max(longest, held)
+            if options["verbosity"] > 1:
+                self.stdout.write(
+                    f"Batch {batches}: {deleted[0]} outstanding, {deleted[1]} "
+                    f"blacklisted, up to id {last_id} ({held * 1000:.1f} ms)"
+                )
+
+        self.stdout.write(
+            f"Deleted {outstanding} outstanding and {blacklisted} blacklisted "
+            f"tokens in {batches} batches ({time.monotonic() - started:.1f}s)"
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Write lock held {locked * 1000:.1f} ms in total, "
+                f"longest {longest * 1000:.1f} ms"
+            )
+        )
@@ -0,0 +1,36 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from core.models import File
+from core.previews import render_previews, renderers_for, store_previews
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate previews for files that have none yet, e.g. files uploaded "
+        "before previews existed or while a renderer was not installed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=2)
+        parser.add_argument(
+            "--force", action="store_true", help="Regenerate existing previews too."
+        )
+
+    def handle(self, *args, **options):
+        files = File.objects.filter(client_encrypted=False).exclude(encrypted_key=b"")
+        if not options["force"]:
+            files = files.filter(previews__isnull=True)
+        files = [file for file in files.order_by("pk") if renderers_for(file)]
+
+        # Render on the pool, store from this thread
+        created = 0
+        with ThreadPoolExecutor(max(options["workers"], 1)) as pool:
+            for file, rendered in zip(files, pool.map(render_previews, files)):
+                created += len(store_previews(file, rendered))
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Generated {created} previews for {len(files)} candidate files"
+            )
+        )
@@ -0,0 +1,99 @@
+import os
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.models import BLOB_PREFIX, ContentBlob, File, blob_path
+from core.storage import FileSystemBlobStorage, blob_storage
+
+
+def delete_legacy_blob(name):
+    """
+    Deletes a blob of the old layout together with its per-file directory
+    and, once empty, the owner's directory.
+    """
+    blob_storage.delete(name)
+    if not isinstance(blob_storage, FileSystemBlobStorage):
+        return
+    directory = os.path.dirname(blob_storage.path(name))
+    for _ in range(2):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            break
+        directory = os.path.dirname(directory)
+
+
+class Command(BaseCommand):
+    help = (
+        "Move blobs stored under the old uploads/<owner>/<uuid>/<name> layout "
+        "to the sharded blobs/ layout, in batches, while the site is running."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100)
+
+    def handle(self, *args, **options):
+        legacy = (
+            File.objects.exclude(file__startswith=BLOB_PREFIX)
+            .exclude(file="")
+            .order_by("file")
+            .values_list("file", flat=True)
+            .distinct()
+        )
+        moved = missing = 0
+        last = None
+        while True:
+            page = legacy if last is None else legacy.filter(file__gt=last)
+            names = list(page[: options["batch_size"]])
+            if not names:
+                break
+            last = names[-1]
+            batch_moved, batch_missing = self.migrate(names)
+            moved += batch_moved
+            missing += batch_missing
+            self.stdout.write(f"{moved} blobs moved")
+
+        self.stdout.write(self.style.SUCCESS(f"Moved {moved} blobs, {missing} missing"))
+
+    def migrate(self, names):
+        """
+        Moves one batch: each blob is first linked under its new name, then
+        the rows are repointed in one transaction, and the old names are
+        deleted once it commits. Readers therefore always find the blob
+        under whichever name they loaded.
+        """
+        links = []
+        missing = 0
+        for name in names:
+            # A deduplicated blob is named after the oldest File using it
+            first = File.objects.filter(file=name).order_by("uploaded_at").first()
+            if first is None:
+                continue
+            new_name = blob_path(first.pk)
+            try:
+                blob_storage.link(name, new_name)
+            except FileNotFoundError:
+                missing += 1
+                self.stdout.write(self.style.ERROR(f"{name}: blob not found"))
+                continue
+            links.append((name, new_name))
+
+        with transaction.atomic():
+            for name, new_name in links:
+                # Repoint the ContentBlob first: its row lock holds back
+                # uploads that would add Files under the old name
+                ContentBlob.objects.filter(storage_name=name).update(
+                    storage_name=new_name
+                )
+                files = File.objects.filter(file=name)
+                # The file name used to be kept only in the path
+                files.filter(name="").update(name=os.path.basename(name))
+                if files.update(file=new_name):
+                    transaction.on_commit(lambda name=name: delete_legacy_blob(name))
+                else:
+                    # Deleted in the meantime
+                    transaction.on_commit(
+                        lambda new_name=new_name: blob_storage.delete(new_name)
+                    )
+        return len(links), missing
@@ -0,0 +1,220 @@
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import BLOB_PREFIX, ContentBlob, File, UploadSession
+from core.storage import blob_storage
+
+# Blobs stored before the sharded layout
+LEGACY_PREFIX = "uploads/"
+# Where --quarantine moves orphans to, outside every shard
+QUARANTINE_PREFIX = "quarantine/"
+PART_SUFFIX = ".part"
+
+
+def all_shards():
+    return [f"{BLOB_PREFIX}{i:02x}/" for i in range(256)] + [LEGACY_PREFIX]
+
+
+def shard_prefix(shard):
+    shard = shard.strip("/").lower()
+    if f"{shard}/" == LEGACY_PREFIX:
+        return LEGACY_PREFIX
+    if not re.fullmatch(r"[0-9a-f]{2}", shard):
+        raise CommandError(
+            f"Invalid shard {shard!r}: expected two hex digits or 'uploads'"
+        )
+    return f"{BLOB_PREFIX}{shard}/"
+
+
+def referenced_names(lookup, value, batch_size):
+    """
+    Returns the storage names the database refers to among those matching
+    ``name__<lookup>=value``, read from each table in batches.
+    """
+    names = set()
+    files = File.objects.filter(**{f"file__{lookup}": value})
+    names.update(files.values_list("file", flat=True).iterator(batch_size))
+    blobs = ContentBlob.objects.filter(**{f"storage_name__{lookup}": value})
+    names.update(blobs.values_list("storage_name", flat=True).iterator(batch_size))
+    # Resumable uploads still being received live in a .part file
+    sessions = UploadSession.objects.filter(
+        file__isnull=True, **{f"storage_name__{lookup}": value}
+    )
+    for name in sessions.values_list("storage_name", flat=True).iterator(batch_size):
+        names.update((name, name + PART_SUFFIX))
+    return names
+
+
+def still_referenced(names, batch_size):
+    """
+    Returns which of ``names`` the database refers to now.
+    """
+    found = set()
+    names = list(names)
+    for i in range(0, len(names), batch_size):
+        batch = names[i : i + batch_size]
+        found.update(
+            referenced_names(
+                "in",
+                batch + [name.removesuffix(PART_SUFFIX) for name in batch],
+                batch_size,
+            )
+        )
+    return found & set(names)
+
+
+def quarantine_blob(name):
+    blob_storage.link(name, QUARANTINE_PREFIX + name)
+    blob_storage.delete(name)
+
+
+class Command(BaseCommand):
+    help = (
+        "Find blobs in storage that no File, ContentBlob or upload session "
+        "refers to, e.g. left behind by failed uploads, and report, delete "
+        "or quarantine them. Works one directory shard at a time."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--batch-size", type=int, default=2000)
+        parser.add_argument(
+            "--shard",
+            action="append",
+            dest="shards",
+            metavar="SHARD",
+            help=(
+                "Only reconcile this shard: two hex digits for blobs/<xx>/, or "
+                "'uploads' for the old layout. May be repeated."
+            ),
+        )
+        parser.add_argument(
+            "--start-after",
+            metavar="SHARD",
+            help="Skip the shards up to and including this one, to resume a run.",
+        )
+        parser.add_argument(
+            "--grace-hours",
+            type=float,
+            default=24,
+            help=(
+                "Leave orphans modified more recently than this alone: they may "
+                "belong to an upload that is still being saved."
+            ),
+        )
+        action = parser.add_mutually_exclusive_group()
+        action.add_argument(
+            "--delete", action="store_true", help="Delete the orphaned blobs."
+        )
+        action.add_argument(
+            "--quarantine",
+            action="store_true",
+            help=f"Move the orphaned blobs under {QUARANTINE_PREFIX}.",
+        )
+
+    def handle(self, *args, **options):
+        if options["grace_hours"] < 0:
+            raise CommandError("--grace-hours must not be negative")
+        order = all_shards()
+        shards = order
+        if options["shards"]:
+            selected = {shard_prefix(shard) for shard in options["shards"]}
+            shards = [shard for shard in order if shard in selected]
+        if options["start_after"]:
+            first = order.index(shard_prefix(options["start_after"])) + 1
+            shards = [shard for shard in shards if order.index(shard) >= first]
+
+        self.options = options
+        self.cutoff = time.time() - options["grace_hours"] * 3600
+        self.scanned = self.orphans = self.orphan_bytes = self.recent = 0
+        self.removed = self.removed_bytes = 0
+
+        # List a few shards ahead on the pool and diff them on this thread,
+        # so only those shards are held in memory at once
+        workers = max(options["workers"], 1)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            listing = deque()
+            for shard in shards:
+                listing.append((shard, pool.submit(list, blob_storage.scan(shard))))
+                if len(listing) > workers:
+                    self.reconcile(pool, *listing.popleft())
+            while listing:
+                self.reconcile(pool, *listing.popleft())
+
+        self.report(len(shards))
+
+    def reconcile(self, pool, shard, listing):
+        blobs = listing.result()
+        referenced = referenced_names("startswith", shard, self.options["batch_size"])
+        orphans = []
+        for name, size, modified in blobs:
+            if name in referenced:
+                continue
+            if modified > self.cutoff:
+                self.recent += 1
+                continue
+            orphans.append((name, size))
+        self.scanned += len(blobs)
+        if not orphans:
+            return
+
+        # Rows may have been added since the shard was read
+        current = still_referenced(
+            [name for name, _ in orphans], self.options["batch_size"]
+        )
+        orphans = [(name, size) for name, size in orphans if name not in current]
+        self.orphans += len(orphans)
+        self.orphan_bytes += sum(size for _, size in orphans)
+        if self.options["verbosity"] > 1:
+            for name, size in orphans:
+                self.stdout.write(f"{name} ({size} bytes)")
+
+        if self.options["delete"]:
+            remove = blob_storage.delete
+        elif self.options["quarantine"]:
+            remove = quarantine_blob
+        else:
+            remove = None
+        removed = 0
+        if remove is not None:
+            results = pool.map(lambda orphan: self.remove(remove, *orphan), orphans)
+            for size in results:
+                if size is not None:
+                    self.removed += 1
+                    self.removed_bytes += size
+                    removed += 1
+        self.stdout.write(
+            f"{shard}: {len(blobs)} blobs, {len(orphans)} orphaned"
+            + (f", {removed} removed" if remove is not None else "")
+        )
+
+    def remove(self, remove, name, size):
+        try:
+            remove(name)
+        except FileNotFoundError:
+            # Removed by someone else in the meantime
+            return None
+        return size
+
+    def report(self, shards):
+        self.stdout.write(
+            f"Scanned {self.scanned} blobs in {shards} shards: {self.orphans} "
+            f"orphaned ({self.orphan_bytes / 1e6:.1f} MB), {self.recent} too "
+            "recent to tell"
+        )
+        if self.options["delete"]:
+            message = f"Deleted {self.removed} blobs, reclaiming"
+        elif self.options["quarantine"]:
+            message = f"Moved {self.removed} blobs to {QUARANTINE_PREFIX},"
+        else:
+            self.stdout.write(
+                "Nothing was removed; run with --delete or --quarantine to do so"
+            )
+            return
+        self.stdout.write(
+            self.style.SUCCESS(f"{message} {self.removed_bytes / 1e6:.1f} MB")
+        )
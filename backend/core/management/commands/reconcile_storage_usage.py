@@ -0,0 +1,32 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.models import StorageUsage
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute each user's storage usage from their files and correct "
+        "the running totals used for quota checks where they have drifted."
+    )
+
+    def handle(self, *args, **options):
+        fixed = 0
+        user_ids = get_user_model().objects.order_by("pk").values_list("pk", flat=True)
+        for user_id in user_ids.iterator():
+            # Lock the row so uploads and deletes wait for the recount
+            with transaction.atomic():
+                usage = StorageUsage.for_user(user_id, lock=True)
+                totals = StorageUsage.totals(user_id)
+                if (usage.bytes, usage.files) == (totals["bytes"], totals["files"]):
+                    continue
+                self.stdout.write(
+                    f"{user_id}: {usage.bytes} bytes in {usage.files} files, "
+                    f"counted {totals['bytes']} bytes in {totals['files']} files"
+                )
+                usage.bytes = totals["bytes"]
+                usage.files = totals["files"]
+                usage.save(update_fields=["bytes", "files", "updated_at"])
+                fixed += 1
+        self.stdout.write(self.style.SUCCESS(f"Corrected the usage of {fixed} users"))
@@ -0,0 +1,137 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from core import crypto
+from core.models import ContentBlob, File, UploadSession
+
+# Every model holding a data key wrapped under a master key
+WRAPPED_KEY_MODELS = (File, ContentBlob, UploadSession)
+
+_keyring = {}
+_target_id = None
+
+
+def _init_worker(keyring, target_id):
+    global _keyring, _target_id
+    _keyring = keyring
+    _target_id = target_id
+
+
+def rewrap_batch(rows):
+    """
+    Rewraps ``(pk, key_id, encrypted_key)`` rows under the target master key.
+    Runs in worker processes; a row that cannot be unwrapped maps to None.
+    """
+    target = _keyring[_target_id]
+    results = []
+    for pk, key_id, wrapped in rows:
+        try:
+            key = crypto.unwrap_key(_keyring[key_id], wrapped)
+        except (KeyError, crypto.BlobIntegrityError):
+            results.append((pk, key_id, None))
+            continue
+        results.append((pk, key_id, crypto.wrap_key(target, key)))
+    return results
+
+
+class Command(BaseCommand):
+    help = (
+        "Rewrap every data key under the current (or given) master key. "
+        "File contents are not touched. Rows already wrapped under the target "
+        "key are skipped, so an interrupted run can simply be restarted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--key-id",
+            default=None,
+            help="Master key id to rewrap to (default: MASTER_KEY_ID).",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count() or 1,
+            help="Number of worker processes doing the key unwrap/wrap.",
+        )
+
+    def handle(self, *args, **options):
+        target_id = options["key_id"] or settings.MASTER_KEY_ID
+        if target_id not in settings.MASTER_KEYS:
+            raise CommandError(f"Master key id {target_id!r} is not in MASTER_KEYS")
+        batch_size = options["batch_size"]
+        workers = max(options["workers"], 1)
+
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(dict(settings.MASTER_KEYS), target_id),
+        ) as pool:
+            for model in WRAPPED_KEY_MODELS:
+                self.rotate_model(model, target_id, pool, batch_size, workers * 2)
+
+    def rotate_model(self, model, target_id, pool, batch_size, max_in_flight):
+        # Client-wrapped keys (empty key id) are not ours to rewrap
+        pending = (
+            model.objects.exclude(key_id=target_id).exclude(key_id="").order_by("pk")
+        )
+        total = pending.count()
+        label = model._meta.verbose_name_plural
+        if not total:
+            self.stdout.write(f"{label}: nothing to rewrap")
+            return
+
+        started = time.monotonic()
+        done = failed = 0
+        in_flight = deque()
+        last_pk = None
+        while True:
+            page = pending if last_pk is None else pending.filter(pk__gt=last_pk)
+            rows = [
+                (pk, key_id, bytes(wrapped))
+                for pk, key_id, wrapped in page.values_list(
+                    "pk", "key_id", "encrypted_key"
+                )[:batch_size]
+            ]
+            if rows:
+                last_pk = rows[-1][0]
+                in_flight.append(pool.submit(rewrap_batch, rows))
+            # Keep the pool busy while writing finished batches in order
+            while in_flight and (len(in_flight) >= max_in_flight or not rows):
+                written, skipped = self.apply(model, target_id, in_flight.popleft())
+                done += written
+                failed += skipped
+                elapsed = time.monotonic() - started
+                self.stdout.write(
+                    f"{label}: {done + failed}/{total} processed, "
+                    f"{failed} failed ({done / max(elapsed, 1e-9):.0f} rows/s)"
+                )
+            if not rows:
+                break
+
+        style = self.style.WARNING if failed else self.style.SUCCESS
+        self.stdout.write(
+            style(f"{label}: rewrapped {done} keys, {failed} could not be unwrapped")
+        )
+
+    def apply(self, model, target_id, future):
+        """
+        Stores one rewrapped batch in a single transaction. Rows whose key id
+        changed in the meantime are left alone.
+        """
+        written = skipped = 0
+        with transaction.atomic():
+            for pk, key_id, wrapped in future.result():
+                if wrapped is None:
+                    skipped += 1
+                    continue
+                written += model.objects.filter(pk=pk, key_id=key_id).update(
+                    encrypted_key=wrapped, key_id=target_id
+                )
+        return written, skipped
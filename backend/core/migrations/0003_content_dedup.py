@@ -0,0 +1,54 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:00
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0002_upload_sessions"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="file",
+            name="content_digest",
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name="uploadpart",
+            name="segment_digests",
+            field=models.BinaryField(default=b""),
+        ),
+        migrations.CreateModel(
+            name="ContentBlob",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("digest", models.CharField(max_length=64)),
+                ("storage_name", models.CharField(max_length=255)),
+                ("encrypted_key", models.BinaryField()),
+                ("ref_count", models.PositiveIntegerField(default=0)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "owner",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("owner", "digest")},
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:04
+
+import core.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0003_content_dedup"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="contentblob",
+            name="key_id",
+            field=models.CharField(
+                db_index=True, default=core.models.current_master_key_id, max_length=32
+            ),
+        ),
+        migrations.AddField(
+            model_name="file",
+            name="key_id",
+            field=models.CharField(
+                db_index=True, default=core.models.current_master_key_id, max_length=32
+            ),
+        ),
+        migrations.AddField(
+            model_name="uploadsession",
+            name="key_id",
+            field=models.CharField(
+                db_index=True, default=core.models.current_master_key_id, max_length=32
+            ),
+        ),
+    ]
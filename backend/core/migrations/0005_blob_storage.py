@@ -0,0 +1,33 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:19
+
+import core.models
+import core.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0004_master_key_ids"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="uploadpart",
+            name="etag",
+            field=models.CharField(blank=True, default="", max_length=255),
+        ),
+        migrations.AddField(
+            model_name="uploadsession",
+            name="upload_id",
+            field=models.CharField(blank=True, default="", max_length=255),
+        ),
+        migrations.AlterField(
+            model_name="file",
+            name="file",
+            field=models.FileField(
+                storage=core.storage.get_blob_storage,
+                upload_to=core.models.file_upload_path,
+            ),
+        ),
+    ]
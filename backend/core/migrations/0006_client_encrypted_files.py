@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0005_blob_storage"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="file",
+            name="client_encrypted",
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0006_client_encrypted_files"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ScrubRun",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("started_at", models.DateTimeField(auto_now_add=True)),
+                ("finished_at", models.DateTimeField(blank=True, null=True)),
+                ("last_file_id", models.UUIDField(blank=True, null=True)),
+                ("files_checked", models.PositiveIntegerField(default=0)),
+                ("bytes_checked", models.BigIntegerField(default=0)),
+                ("failures", models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="file",
+            name="integrity",
+            field=models.CharField(
+                choices=[
+                    ("unverified", "Unverified"),
+                    ("ok", "OK"),
+                    ("corrupt", "Corrupt"),
+                    ("missing", "Missing"),
+                ],
+                db_index=True,
+                default="unverified",
+                max_length=10,
+            ),
+        ),
+        migrations.AddField(
+            model_name="file",
+            name="verified_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
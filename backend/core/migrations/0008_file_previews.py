@@ -0,0 +1,54 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0007_blob_scrubbing"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FilePreview",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[
+                            ("thumbnail", "Thumbnail"),
+                            ("page", "First page"),
+                            ("text", "Text excerpt"),
+                        ],
+                        max_length=10,
+                    ),
+                ),
+                ("content_type", models.CharField(max_length=100)),
+                ("data", models.BinaryField()),
+                ("digest", models.CharField(max_length=64)),
+                ("created_at", models.DateTimeField(auto_now=True)),
+                (
+                    "file",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="previews",
+                        to="core.file",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("file", "kind")},
+            },
+        ),
+    ]
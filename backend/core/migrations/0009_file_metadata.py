@@ -0,0 +1,60 @@
+# Generated by Django 5.1.4 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0008_file_previews"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="file",
+            name="blob_size",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="file",
+            name="codec",
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="file",
+            name="content_type",
+            field=models.CharField(blank=True, default="", max_length=255),
+        ),
+        migrations.AddField(
+            model_name="file",
+            name="segment_count",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="file",
+            name="sha256",
+            field=models.CharField(blank=True, default="", max_length=64),
+        ),
+        migrations.AddField(
+            model_name="file",
+            name="size",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="uploadsession",
+            name="content_type",
+            field=models.CharField(blank=True, default="", max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name="file",
+            index=models.Index(
+                fields=["owner", "size"], name="core_file_owner_i_94bdfd_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="file",
+            index=models.Index(
+                fields=["owner", "content_type"], name="core_file_owner_i_19d021_idx"
+            ),
+        ),
+    ]
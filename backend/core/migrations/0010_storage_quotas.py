@@ -0,0 +1,37 @@
+# Generated by Django 5.1.4 on 2026-10-18 10:07
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0009_file_metadata"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StorageUsage",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        serialize=False,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                ("bytes", models.BigIntegerField(default=0)),
+                ("files", models.IntegerField(default=0)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="user",
+            name="storage_quota",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-18 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0011_user_token_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="uploadpart",
+            name="writer",
+            field=models.UUIDField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="uploadpart",
+            name="writing_since",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,18 +1,31 @@
 import enum
+import hashlib
+import io
 import os
+import threading
 import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 import pyotp
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from django.conf import settings
 from django.contrib.auth.models import (
     AbstractBaseUser,
     BaseUserManager,
     PermissionsMixin,
 )
-from django.db import models
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_save
 from django.utils import timezone
+from django.utils.crypto import salted_hmac
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from core import crypto
+from core.sniffing import SAMPLE_SIZE, sniff_content_type
+from core.storage import blob_storage, get_blob_storage
 
 
 class UserRole(enum.Enum):
@@ -64,80 +77,530 @@ class User(AbstractBaseUser, PermissionsMixin):
     email_verification_expiry = models.DateTimeField(null=True, blank=True)
     is_active = models.BooleanField(default=False)
     is_staff = models.BooleanField(default=False)
+    # Bytes the user may store; null falls back to the role's quota
+    storage_quota = models.BigIntegerField(null=True, blank=True)
+    # Bumped whenever a field copied into access tokens changes, so tokens
+    # carrying the old values are refreshed
+    token_version = models.PositiveIntegerField(default=0)
 
     objects = UserManager()
 
     USERNAME_FIELD = "email"
     REQUIRED_FIELDS = []
 
+    # Fields access tokens carry as claims (see core.authentication)
+    CLAIM_FIELDS = ("role", "is_superuser", "is_active")
+
     def __str__(self):
         return self.email
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        user = super().from_db(db, field_names, values)
+        user._loaded_claims = {
+            name: value
+            for name, value in zip(field_names, values)
+            if name in cls.CLAIM_FIELDS
+        }
+        return user
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        # Load every deferred field on first access rather than one query
+        # per field, for users built from token claims
+        deferred = self.get_deferred_fields()
+        if fields is not None and deferred.issuperset(fields):
+            fields = deferred
+        super().refresh_from_db(using, fields, from_queryset)
+
+    def save(self, *args, **kwargs):
+        loaded = getattr(self, "_loaded_claims", {})
+        if any(getattr(self, name) != value for name, value in loaded.items()):
+            self.token_version += 1
+            update_fields = kwargs.get("update_fields")
+            if update_fields is not None:
+                kwargs["update_fields"] = {*update_fields, "token_version"}
+        super().save(*args, **kwargs)
+        deferred = self.get_deferred_fields()
+        self._loaded_claims = {
+            name: getattr(self, name)
+            for name in self.CLAIM_FIELDS
+            if name not in deferred
+        }
+        version = self.token_version
+        transaction.on_commit(
+            lambda: cache.set(
+                self.token_version_key(self.pk),
+                version,
+                jwt_settings.ACCESS_TOKEN_LIFETIME.total_seconds(),
+            )
+        )
+
+    @staticmethod
+    def token_version_key(user_id):
+        return f"user-token-version:{user_id}"
+
+
+def current_master_key_id() -> str:
+    return settings.MASTER_KEY_ID
+
+
+# Blobs live under BLOB_PREFIX, fanned out over two levels of 256
+# directories; names from before this layout start with "uploads/"
+BLOB_PREFIX = "blobs/"
+
+
+def blob_path(blob_id):
+    key = blob_id.hex
+    return f"{BLOB_PREFIX}{key[:2]}/{key[2:4]}/{key}"
+
 
 def file_upload_path(instance, filename):
-    # Organize files by user ID and generate unique names
-    return os.path.join("uploads", str(instance.owner.id), str(uuid.uuid4()), filename)
+    # Named after a random uuid only: the original name is kept in File.name,
+    # and no directory grows with the number of files of one owner. The uuid
+    # is the id of the File being saved, which a blob written before its
+    # File exists (or shared by deduplicated Files) does not match.
+    return blob_path(instance.id)
+
+
+# File fields describing the stored blob rather than the content: a
+# deduplicated upload takes them from the File whose blob it reuses
+BLOB_FIELDS = ("blob_size", "codec", "segment_count")
+
+
+class UploadMetadata:
+    """
+    Collects the metadata of a File in the same pass as its encryption:
+    ``plaintext`` is fed the content and ``ciphertext`` the sealed blob.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.sample = b""
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.blob_size = 0
+
+    def plaintext(self, data):
+        if len(self.sample) < SAMPLE_SIZE:
+            self.sample += data[: SAMPLE_SIZE - len(self.sample)]
+        self.sha256.update(data)
+        self.size += len(data)
+
+    def ciphertext(self, data):
+        self.blob_size += len(data)
+        return data
+
+    def fields(self, codec, segment_size):
+        body = self.blob_size - crypto.HEADER_SIZE
+        return {
+            "size": self.size,
+            "blob_size": self.blob_size,
+            "sha256": self.sha256.hexdigest(),
+            "content_type": sniff_content_type(self.sample, self.name),
+            "codec": codec,
+            "segment_count": -(-body // crypto.ciphertext_segment_size(segment_size)),
+        }
+
+
+class _Metered:
+    """
+    Passes everything read from or written to ``f`` to ``callback``.
+    """
+
+    def __init__(self, f, callback):
+        self.f = f
+        self.callback = callback
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.callback(data)
+        return data
+
+    def write(self, data):
+        self.callback(data)
+        return self.f.write(data)
+
+
+class FileManager(models.Manager):
+    def _blob_fields(self, storage_name):
+        """
+        Returns the blob metadata recorded for ``storage_name`` (None for any
+        that is unknown).
+        """
+        fields = dict.fromkeys(BLOB_FIELDS)
+        known = (
+            self.filter(file=storage_name, blob_size__isnull=False)
+            .values(*BLOB_FIELDS)
+            .first()
+        )
+        fields.update(known or {})
+        return fields
+
+    def create_from_blob(
+        self,
+        owner,
+        pending,
+        encrypted_key,
+        key_id,
+        content_digest,
+        **fields,
+    ):
+        """
+        Commits the uncommitted blob ``pending`` (a ``BlobWriter`` or
+        ``MultipartBlob``) as a new File.
+
+        If ``owner`` already stores a blob with the same content digest, the
+        new blob is aborted and the File references the existing one. Blobs
+        without a digest (client-encrypted ones) are never deduplicated.
+        """
+        if content_digest is None:
+            pending.commit()
+            return self.create(
+                owner=owner,
+                file=pending.name,
+                encrypted_key=encrypted_key,
+                key_id=key_id,
+                **fields,
+            )
+        with transaction.atomic():
+            blob, created = ContentBlob.objects.select_for_update().get_or_create(
+                owner=owner,
+                digest=content_digest,
+                defaults={
+                    "storage_name": pending.name,
+                    "encrypted_key": encrypted_key,
+                    "key_id": key_id,
+                },
+            )
+            ContentBlob.objects.filter(pk=blob.pk).update(
+                ref_count=models.F("ref_count") + 1
+            )
+            if created:
+                pending.commit()
+            else:
+                pending.abort()
+                fields.update(self._blob_fields(blob.storage_name))
+            return self.create(
+                owner=owner,
+                file=blob.storage_name,
+                encrypted_key=blob.encrypted_key,
+                key_id=blob.key_id,
+                content_digest=content_digest,
+                **fields,
+            )
+
+    def create_from_blobs(self, owner, items, workers=1):
+        """
+        Batch form of ``create_from_blob``: each item holds its keyword
+        arguments (``pending``, ``encrypted_key``, ``key_id``,
+        ``content_digest`` and File fields). Returns, per item, the new File
+        or the exception that kept its blob from being stored.
+
+        Copies of a content already stored, or repeated within the batch,
+        are not committed. The remaining blobs are committed concurrently on
+        ``workers`` threads, then every ContentBlob and File row is inserted
+        with ``bulk_create`` in one transaction, which locks the ContentBlobs
+        referenced; one released by a concurrent delete in the meantime is
+        replaced by a copy from the batch. The unneeded copies are aborted
+        at the end. ``post_save`` is sent for each File, as ``bulk_create``
+        does not.
+        """
+        results = [None] * len(items)
+        digests = {item["content_digest"] for item in items} - {None}
+        stored = set(
+            ContentBlob.objects.filter(owner=owner, digest__in=digests).values_list(
+                "digest", flat=True
+            )
+        )
+        # Index of the item whose blob is kept, for each new digest
+        keepers = {}
+        commits = []
+        for i, item in enumerate(items):
+            digest = item["content_digest"]
+            if digest in stored or digest in keepers:
+                continue
+            if digest is not None:
+                keepers[digest] = i
+            commits.append(i)
+
+        with ThreadPoolExecutor(max(workers, 1)) as pool:
+            futures = [(i, pool.submit(items[i]["pending"].commit)) for i in commits]
+        for i, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                results[i] = e
+        for i, item in enumerate(items):
+            keeper = keepers.get(item["content_digest"])
+            if keeper is not None and results[keeper] is not None:
+                results[i] = results[keeper]
+
+        ok = [i for i in range(len(items)) if results[i] is None]
+        try:
+            with transaction.atomic():
+                created = self._insert_blob_files(owner, items, ok, keepers, results)
+                for i, file in created:
+                    results[i] = file
+                    post_save.send(
+                        sender=self.model,
+                        instance=file,
+                        created=True,
+                        raw=False,
+                        using=self.db,
+                        update_fields=None,
+                    )
+        finally:
+            # The copies left uncommitted were not needed
+            for item in items:
+                item["pending"].abort()
+        return results
+
+    def _insert_blob_files(self, owner, items, ok, keepers, results):
+        """
+        Inserts the ContentBlob and File rows of ``create_from_blobs`` for
+        the items ``ok``; returns ``(index, File)`` pairs. Must run in a
+        transaction.
+        """
+        digests = {items[i]["content_digest"] for i in ok} - {None}
+        # Locked, so that no concurrent delete releases them meanwhile
+        blobs = {
+            blob.digest: blob
+            for blob in ContentBlob.objects.select_for_update().filter(
+                owner=owner, digest__in=digests
+            )
+        }
+        counts = Counter(
+            items[i]["content_digest"]
+            for i in ok
+            if items[i]["content_digest"] is not None
+        )
+        new_blobs = []
+        for digest, count in counts.items():
+            keeper = keepers.get(digest)
+            if digest in blobs:
+                updated = ContentBlob.objects.filter(pk=blobs[digest].pk).update(
+                    ref_count=models.F("ref_count") + count
+                )
+                if updated:
+                    if keeper is not None:
+                        # Stored meanwhile by a concurrent upload: use that one
+                        name = items[keeper]["pending"].name
+                        transaction.on_commit(
+                            lambda name=name: blob_storage.delete(name)
+                        )
+                    continue
+            if keeper is None:
+                # Released since it was looked up: store a copy from the batch
+                keeper = next(i for i in ok if items[i]["content_digest"] == digest)
+                try:
+                    items[keeper]["pending"].commit()
+                except Exception as e:
+                    for i in ok:
+                        if items[i]["content_digest"] == digest:
+                            results[i] = e
+                    continue
+            blobs[digest] = ContentBlob(
+                owner=owner,
+                digest=digest,
+                storage_name=items[keeper]["pending"].name,
+                encrypted_key=items[keeper]["encrypted_key"],
+                key_id=items[keeper]["key_id"],
+                ref_count=count,
+            )
+            new_blobs.append(blobs[digest])
+        ContentBlob.objects.bulk_create(new_blobs)
+
+        ok = [i for i in ok if results[i] is None]
+        files = []
+        for i in ok:
+            fields = dict(items[i])
+            pending = fields.pop("pending")
+            digest = fields.pop("content_digest")
+            if digest is not None:
+                blob = blobs[digest]
+                fields.update(
+                    file=blob.storage_name,
+                    encrypted_key=blob.encrypted_key,
+                    key_id=blob.key_id,
+                )
+                if blob.storage_name != pending.name:
+                    fields.update(self._blob_fields(blob.storage_name))
+            else:
+                fields["file"] = pending.name
+            files.append(self.model(owner=owner, content_digest=digest, **fields))
+        self.bulk_create(files)
+        return list(zip(ok, files))
 
 
 class File(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(max_length=255, default="")
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
-    file = models.FileField(upload_to=file_upload_path)
+    file = models.FileField(upload_to=file_upload_path, storage=get_blob_storage)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     description = models.TextField(blank=True, null=True)
     encrypted_key = models.BinaryField()
+    # Id of the master key in settings.MASTER_KEYS that wraps encrypted_key
+    key_id = models.CharField(
+        max_length=32, default=current_master_key_id, db_index=True
+    )
+    content_digest = models.CharField(
+        max_length=64, blank=True, null=True, db_index=True
+    )
+    # Encrypted by the client before upload: the blob is opaque to the
+    # server, encrypted_key is wrapped by the client and key_id is empty
+    client_encrypted = models.BooleanField(default=False)
+
+    # Recorded while the content is encrypted, so that listings and
+    # downloads never open the blob; null for files stored before
+    size = models.BigIntegerField(null=True, blank=True)
+    blob_size = models.BigIntegerField(null=True, blank=True)
+    sha256 = models.CharField(max_length=64, blank=True, default="")
+    # Sniffed from the first bytes of the content
+    content_type = models.CharField(max_length=255, blank=True, default="")
+    codec = models.PositiveSmallIntegerField(null=True, blank=True)
+    segment_count = models.PositiveIntegerField(null=True, blank=True)
+
+    INTEGRITY_CHOICES = (
+        ("unverified", "Unverified"),
+        ("ok", "OK"),
+        ("corrupt", "Corrupt"),
+        ("missing", "Missing"),
+    )
+    # Outcome of the last integrity scrub of the blob
+    integrity = models.CharField(
+        max_length=10, choices=INTEGRITY_CHOICES, default="unverified", db_index=True
+    )
+    verified_at = models.DateTimeField(null=True, blank=True)
+
+    objects = FileManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["owner", "size"]),
+            models.Index(fields=["owner", "content_type"]),
+        ]
+
+    @property
+    def quota_bytes(self):
+        # Counted against the quota: the plaintext size, or the size of the
+        # blob where the plaintext is unknown (client-encrypted files)
+        if self.size is not None:
+            return self.size
+        return self.blob_size or 0
+
+    @classmethod
+    def generate_blob_name(cls, owner, filename):
+        """
+        Returns the storage name a new blob uploaded by ``owner`` is saved
+        under: a fresh random uuid, unrelated to the id of the File that
+        will refer to it.
+        """
+        field = cls._meta.get_field("file")
+        return field.generate_filename(cls(owner=owner), filename)
 
     def encrypt_file(self):
         # Generate a 256-bit encryption key
         key = os.urandom(32)
-        iv = os.urandom(12)
 
         # Store the encryption key for later decryption
         self.encrypted_key = encrypt_key(key)
+        self.key_id = current_master_key_id()
 
-        # Perform AES encryption
-        cipher = Cipher(algorithms.AES(key), modes.GCM(iv), backend=default_backend())
-        encryptor = cipher.encryptor()
+        # Stream the plaintext into a segmented blob replacing the original
+        # once complete, so the upload is never held in memory
+        writer = self.file.storage.writer(self.file.name)
+        metadata = UploadMetadata(self.name or self.file.name)
+        try:
+            with self.file.storage.open(self.file.name, "rb") as src:
+                codec = choose_upload_codec(
+                    src.read(settings.FILE_COMPRESSION_SAMPLE_SIZE)
+                )
+                src.seek(0)
+                crypto.encrypt_stream(
+                    key,
+                    _Metered(src, metadata.plaintext),
+                    _Metered(writer, metadata.ciphertext),
+                    settings.FILE_ENCRYPTION_SEGMENT_SIZE,
+                    codec,
+                    executor=encryption_executor(),
+                    batch=encryption_batch(),
+                )
+            writer.commit()
+        except BaseException:
+            writer.abort()
+            raise
 
-        # Read file content
-        with self.file.open("rb") as f:
-            file_data = f.read()
+        counted = self.quota_bytes
+        for field, value in metadata.fields(
+            codec, settings.FILE_ENCRYPTION_SEGMENT_SIZE
+        ).items():
+            setattr(self, field, value)
+        with transaction.atomic():
+            self.save()
+            StorageUsage.add(self.owner_id, self.quota_bytes - counted, 0)
 
-        # Encrypt the file data
-        encrypted_data = (
-            iv + encryptor.update(file_data) + encryptor.finalize() + encryptor.tag
-        )
-
-        # Overwrite the file with encrypted content
-        with self.file.open("wb") as f:
-            f.write(encrypted_data)
-
-        self.save()
+    def iter_decrypt(self, start=None, end=None, decode=True):
+        """
+        Returns an iterator over the decrypted file content, or over the
+        inclusive byte range ``start``-``end`` of it for uncompressed
+        segmented blobs. With ``decode=False`` a compressed blob yields its
+        compressed stream. The key is unwrapped and the blob opened eagerly
+        so that errors surface before the first chunk is requested.
+        """
+        if self.client_encrypted:
+            raise ValueError("File is encrypted client-side")
 
-    def decrypt_file(self):
         # Retrieve the encryption key
-        key = decrypt_key(self.encrypted_key)
+        key = decrypt_key(self.encrypted_key, self.key_id)
         if not key:
             raise ValueError("Encryption key is missing")
 
-        # Read the encrypted file data
-        with self.file.open("rb") as f:
-            encrypted_data = f.read()
-
-        # Extract the IV from the encrypted data
-        iv = encrypted_data[:12]
-        tag = encrypted_data[-16:]
-        encrypted_file_data = encrypted_data[12:-16]
+        f = self.file.storage.open(self.file.name, "rb")
+        if start is None:
+            return _closing_iterator(crypto.iter_decrypt(key, f, decode), f)
 
-        # Perform AES decryption
-        cipher = Cipher(
-            algorithms.AES(key), modes.GCM(iv, tag), backend=default_backend()
+        header = crypto.read_header(f)
+        if header is None or header.codec:
+            f.close()
+            raise ValueError("Byte ranges require an uncompressed segmented blob")
+        blob_size = self.file.storage.size(self.file.name)
+        return _closing_iterator(
+            crypto.iter_decrypt_range(key, f, header, blob_size, start, end), f
         )
-        decryptor = cipher.decryptor()
-        decrypted_data = decryptor.update(encrypted_file_data) + decryptor.finalize()
 
-        return decrypted_data
+    def blob_header(self):
+        """
+        Returns the segmented blob header, or None for a version 1 blob.
+        """
+        with self.file.storage.open(self.file.name, "rb") as f:
+            return crypto.read_header(f)
+
+    def plaintext_size(self, header=None):
+        """
+        Computes the decrypted size from the blob header and its stored size.
+        For a compressed blob this is the size of the compressed stream.
+        """
+        if header is None:
+            header = self.blob_header()
+        return crypto.plaintext_size(self.file.storage.size(self.file.name), header)
+
+    def decrypt_file(self):
+        return b"".join(self.iter_decrypt())
+
+    def verify_blob(self, wrap=None):
+        """
+        Authenticates every segment of the blob without keeping any
+        plaintext. ``wrap`` is applied to the opened blob, e.g. to throttle
+        reads. Raises BlobIntegrityError for a corrupted or truncated blob
+        (or an unwrappable key) and FileNotFoundError for a missing one.
+        """
+        if self.client_encrypted:
+            raise ValueError("File is encrypted client-side")
+        key = decrypt_key(self.encrypted_key, self.key_id)
+        with self.file.storage.open(self.file.name, "rb") as f:
+            for _ in crypto.iter_decrypt(key, wrap(f) if wrap else f, decode=False):
+                pass
 
     def __str__(self):
         return self.file.name
@@ -172,32 +635,513 @@ class FileShare(models.Model):
         return f"{self.file.name} shared with {self.shared_with or 'Link'}"
 
 
-def encrypt_key(key: bytes) -> bytes:
+class ContentBlob(models.Model):
     """
-    Encrypts the given key using AES-GCM with a master key.
-    Returns the encrypted key with IV and tag appended.
+    An encrypted blob shared by every File of ``owner`` with the same content.
+    ``ref_count`` tracks those Files; the blob is removed with the last one.
     """
-    iv = os.urandom(12)  # Generate a random 96-bit IV
-    cipher = Cipher(
-        algorithms.AES(settings.MASTER_KEY), modes.GCM(iv), backend=default_backend()
+
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    digest = models.CharField(max_length=64)
+    storage_name = models.CharField(max_length=255)
+    encrypted_key = models.BinaryField()
+    key_id = models.CharField(
+        max_length=32, default=current_master_key_id, db_index=True
     )
-    encryptor = cipher.encryptor()
-    encrypted_key = iv + encryptor.update(key) + encryptor.finalize() + encryptor.tag
-    return encrypted_key
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("owner", "digest")
+
+    def __str__(self):
+        return f"{self.storage_name} ({self.ref_count} references)"
 
 
-def decrypt_key(encrypted_key: bytes) -> bytes:
+class StorageUsage(models.Model):
     """
-    Decrypts the given key using AES-GCM with a master key.
-    Extracts IV and tag from the encrypted key.
+    Running totals of the Files of ``user``, kept up to date by signals in
+    the transaction that creates or deletes each File, so quota checks read
+    one row. ``reconcile_storage_usage`` repairs any drift.
     """
-    iv = encrypted_key[:12]
-    tag = encrypted_key[-16:]
-    key_data = encrypted_key[12:-16]
-    cipher = Cipher(
-        algorithms.AES(settings.MASTER_KEY),
-        modes.GCM(iv, tag),
-        backend=default_backend(),
+
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True
     )
-    decryptor = cipher.decryptor()
-    return decryptor.update(key_data) + decryptor.finalize()
+    bytes = models.BigIntegerField(default=0)
+    files = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @staticmethod
+    def totals(user_id):
+        """
+        Computes the totals of ``user_id`` from the File table.
+        """
+        return File.objects.filter(owner_id=user_id).aggregate(
+            bytes=Coalesce(Sum(Coalesce("size", "blob_size")), 0),
+            files=Count("pk"),
+        )
+
+    @classmethod
+    def for_user(cls, user_id, lock=False):
+        """
+        Returns the row of ``user_id``, created from the File table the first
+        time. With ``lock`` the row stays locked until the transaction ends.
+        """
+        usage, created = cls.objects.get_or_create(
+            user_id=user_id, defaults=cls.totals(user_id)
+        )
+        if lock and not created:
+            usage = cls.objects.select_for_update().get(pk=usage.pk)
+        return usage
+
+    @classmethod
+    def add(cls, user_id, bytes, files):
+        """
+        Adds to the totals of ``user_id``, whose Files already reflect the
+        change.
+        """
+        usage, created = cls.objects.get_or_create(
+            user_id=user_id, defaults=cls.totals(user_id)
+        )
+        # A new row was computed with the change already in the table
+        if not created:
+            cls.objects.filter(pk=usage.pk).update(
+                bytes=models.F("bytes") + bytes, files=models.F("files") + files
+            )
+
+    def __str__(self):
+        return f"{self.user_id}: {self.bytes} bytes in {self.files} files"
+
+
+class FilePreview(models.Model):
+    """
+    A small derivative of a File shown in listings instead of the file
+    itself. ``data`` is a segmented blob encrypted with the File's data key.
+    """
+
+    KIND_CHOICES = (
+        ("thumbnail", "Thumbnail"),
+        ("page", "First page"),
+        ("text", "Text excerpt"),
+    )
+
+    file = models.ForeignKey(File, related_name="previews", on_delete=models.CASCADE)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    content_type = models.CharField(max_length=100)
+    data = models.BinaryField()
+    # SHA-256 of the plaintext, served as the ETag
+    digest = models.CharField(max_length=64)
+    created_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("file", "kind")
+
+    def decrypt(self):
+        key = decrypt_key(self.file.encrypted_key, self.file.key_id)
+        return b"".join(crypto.iter_decrypt(key, io.BytesIO(bytes(self.data))))
+
+    def __str__(self):
+        return f"{self.kind} of {self.file}"
+
+
+class ScrubRun(models.Model):
+    """
+    One pass of the blob integrity scrubber over all Files, in primary key
+    order. ``last_file_id`` is the checkpoint an interrupted run resumes from.
+    """
+
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    last_file_id = models.UUIDField(null=True, blank=True)
+    files_checked = models.PositiveIntegerField(default=0)
+    bytes_checked = models.BigIntegerField(default=0)
+    failures = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        state = "finished" if self.finished_at else "in progress"
+        return f"Scrub started {self.started_at:%Y-%m-%d %H:%M} ({state})"
+
+
+class UploadSession(models.Model):
+    """
+    A resumable upload: the client declares the total size up front and then
+    sends fixed-size numbered parts in any order. Every part is encrypted into
+    its own run of segments and written at its final offset in the blob, so
+    completing the session only renames the blob into place.
+    """
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    name = models.CharField(max_length=255)
+    description = models.TextField(blank=True, null=True)
+    size = models.BigIntegerField()
+    part_size = models.IntegerField()
+    storage_name = models.CharField(max_length=255)
+    # Storage-side id of the multipart upload (empty on the filesystem)
+    upload_id = models.CharField(max_length=255, blank=True, default="")
+    encrypted_key = models.BinaryField()
+    key_id = models.CharField(
+        max_length=32, default=current_master_key_id, db_index=True
+    )
+    header = models.BinaryField()
+    # Sniffed from the start of part 1
+    content_type = models.CharField(max_length=255, blank=True, default="")
+    file = models.OneToOneField(File, null=True, blank=True, on_delete=models.SET_NULL)
+    idempotency_key = models.CharField(max_length=255, blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ("owner", "idempotency_key")
+
+    @classmethod
+    def start(
+        cls, owner, name, size, part_size, description=None, idempotency_key=None
+    ):
+        """
+        Creates a session and starts the multipart upload of its blob.
+        """
+        key = os.urandom(32)
+        cipher = crypto.SegmentCipher.create(key, settings.FILE_ENCRYPTION_SEGMENT_SIZE)
+        session = cls(
+            owner=owner,
+            name=name,
+            description=description,
+            size=size,
+            part_size=part_size,
+            storage_name=File.generate_blob_name(owner, name),
+            encrypted_key=encrypt_key(key),
+            key_id=current_master_key_id(),
+            header=cipher.header.to_bytes(),
+            expires_at=timezone.now() + settings.FILE_UPLOAD_SESSION_LIFETIME,
+            idempotency_key=idempotency_key,
+        )
+        blob = blob_storage.multipart(session.storage_name)
+        session.upload_id = blob.upload_id
+        try:
+            session.save()
+        except Exception:
+            # E.g. a concurrent request created the session for the same key
+            blob.abort()
+            raise
+        return session
+
+    @property
+    def blob(self):
+        return blob_storage.multipart(self.storage_name, self.upload_id)
+
+    @property
+    def segment_size(self):
+        return crypto.Header.from_bytes(bytes(self.header)).segment_size
+
+    @property
+    def segment_count(self):
+        return max(-(-self.size // self.segment_size), 1)
+
+    @property
+    def part_count(self):
+        return max(-(-self.size // self.part_size), 1)
+
+    @property
+    def blob_size(self):
+        return crypto.HEADER_SIZE + self.segment_count * crypto.TAG_SIZE + self.size
+
+    def is_expired(self):
+        return timezone.now() > self.expires_at
+
+    def part_length(self, number):
+        """
+        Returns the plaintext length part ``number`` (1-based) must have.
+        """
+        start = (number - 1) * self.part_size
+        return min(self.part_size, self.size - start)
+
+    def write_part(self, part, src):
+        """
+        Encrypts ``part`` read from ``src`` and stores its segments (preceded
+        by the header for part 1) as that part of the blob. The caller must
+        hold the part's claim. Returns the plaintext bytes written, the
+        concatenated SHA-256 digests of its segments and the ETag of the
+        stored part.
+
+        Segment nonces follow from the segment index, so a segment sealed by
+        an earlier attempt may only be sealed again with the same content:
+        the digest of every sealed segment is recorded before it is stored,
+        and a retry that differs raises UploadPartConflict.
+        """
+        number = part.number
+        if not 1 <= number <= self.part_count:
+            raise ValueError("Part number out of range")
+        header = crypto.Header.from_bytes(bytes(self.header))
+        cipher = crypto.SegmentCipher(
+            decrypt_key(self.encrypted_key, self.key_id), header
+        )
+        expected = self.part_length(number)
+        index = (number - 1) * (self.part_size // header.segment_size)
+        offset = crypto.HEADER_SIZE + index * crypto.ciphertext_segment_size(
+            header.segment_size
+        )
+
+        end = index + max(-(-expected // header.segment_size), 1)
+        executor = encryption_executor()
+        batch = encryption_batch()
+        sealed = bytes(part.segment_digests)
+        written = 0
+        digests = []
+
+        def sealed_batches(index):
+            nonlocal written
+            if number == 1:
+                yield bytes(self.header)
+            while index < end:
+                chunks = []
+                for _ in range(min(batch, end - index)):
+                    wanted = min(header.segment_size, expected - written)
+                    chunk = crypto.read_exact(src, wanted)
+                    if len(chunk) != wanted:
+                        raise ValueError(f"Part {number} must be {expected} bytes")
+                    if number == 1 and not written:
+                        sample = chunk[:SAMPLE_SIZE]
+                        self.content_type = sniff_content_type(sample, self.name)
+                    digest = crypto.ContentDigest.leaf(chunk)
+                    previous = sealed[len(digests) * 32 : (len(digests) + 1) * 32]
+                    if previous and previous != digest:
+                        raise UploadPartConflict(
+                            f"Part {number} differs from an earlier attempt; "
+                            "start a new upload session."
+                        )
+                    chunks.append(chunk)
+                    written += len(chunk)
+                    digests.append(digest)
+                sealed_batch = crypto.seal_segments(
+                    cipher, index, chunks, self.segment_count - 1, executor
+                )
+                if len(digests) * 32 > len(sealed):
+                    part.record_sealed(b"".join(digests))
+                yield b"".join(sealed_batch)
+                index += len(chunks)
+            if src.read(1):
+                raise ValueError(f"Part {number} must be {expected} bytes")
+
+        etag = self.blob.upload_part(
+            number, 0 if number == 1 else offset, sealed_batches(index)
+        )
+        if number == 1:
+            UploadSession.objects.filter(pk=self.pk).update(
+                content_type=self.content_type
+            )
+        return written, b"".join(digests), etag
+
+    def finalize(self):
+        """
+        Completes the multipart upload and creates its File. An identical
+        blob already stored by the owner is reused instead.
+        """
+        digest = crypto.ContentDigest(
+            content_digest_secret(self.owner), self.segment_size
+        )
+        blob = self.blob
+        for part in self.parts.filter(completed=True).order_by("number"):
+            digest.add_leaves(bytes(part.segment_digests), part.size)
+            blob.parts.append((part.number, part.etag))
+
+        self.file = File.objects.create_from_blob(
+            owner=self.owner,
+            pending=blob,
+            encrypted_key=self.encrypted_key,
+            key_id=self.key_id,
+            content_digest=digest.hexdigest(),
+            name=self.name,
+            description=self.description,
+            # Parts arrive in any order, so no whole-file SHA-256 is known
+            size=self.size,
+            blob_size=self.blob_size,
+            content_type=self.content_type or sniff_content_type(b"", self.name),
+            codec=crypto.Header.from_bytes(bytes(self.header)).codec,
+            segment_count=self.segment_count,
+        )
+        self.save(update_fields=["file"])
+        return self.file
+
+    def abort(self):
+        self.blob.abort()
+        self.delete()
+
+    def __str__(self):
+        return f"Upload of {self.name} by {self.owner}"
+
+
+class UploadPartConflict(Exception):
+    """
+    Raised when a part cannot be written: another request is writing it, or
+    its content differs from segments an earlier attempt already sealed.
+    """
+
+
+class UploadPart(models.Model):
+    session = models.ForeignKey(
+        UploadSession, related_name="parts", on_delete=models.CASCADE
+    )
+    number = models.PositiveIntegerField()
+    size = models.BigIntegerField(default=0)
+    # SHA-256 of every plaintext segment in the part, for the content digest.
+    # Until the part is completed: of the segments sealed so far.
+    segment_digests = models.BinaryField(default=b"")
+    etag = models.CharField(max_length=255, blank=True, default="")
+    idempotency_key = models.CharField(max_length=255, blank=True, null=True)
+    completed = models.BooleanField(default=False)
+    # The request writing the part, and when it last made progress
+    writer = models.UUIDField(null=True, blank=True)
+    writing_since = models.DateTimeField(null=True, blank=True)
+    received_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("session", "number")
+        ordering = ["number"]
+
+    def __str__(self):
+        return f"Part {self.number} of {self.session_id}"
+
+    def _mine(self):
+        return UploadPart.objects.filter(pk=self.pk, writer=self.writer)
+
+    def claim(self):
+        """
+        Makes the caller the only writer of this incomplete part and reloads
+        it. A writer that made no progress for FILE_UPLOAD_PART_TIMEOUT is
+        taken over. Returns False if another request holds the part.
+        """
+        now = timezone.now()
+        writer = uuid.uuid4()
+        claimed = (
+            UploadPart.objects.filter(pk=self.pk, completed=False)
+            .filter(
+                models.Q(writer__isnull=True)
+                | models.Q(writing_since__lt=now - settings.FILE_UPLOAD_PART_TIMEOUT)
+            )
+            .update(writer=writer, writing_since=now)
+        )
+        if claimed:
+            self.refresh_from_db()
+        return bool(claimed)
+
+    def record_sealed(self, digests):
+        """
+        Records the digests of the segments sealed so far, before they are
+        stored.
+        """
+        if not self._mine().update(
+            segment_digests=digests, writing_since=timezone.now()
+        ):
+            raise UploadPartConflict("Part was taken over by another request.")
+
+    def release(self):
+        """
+        Gives up the claim after a failed write, keeping the digests of the
+        sealed segments for the retry.
+        """
+        self._mine().update(writer=None, writing_since=None)
+
+    def complete(self, size, segment_digests, etag, idempotency_key):
+        updated = self._mine().update(
+            size=size,
+            segment_digests=segment_digests,
+            etag=etag,
+            idempotency_key=idempotency_key,
+            completed=True,
+            writer=None,
+            writing_since=None,
+            received_at=timezone.now(),
+        )
+        if not updated:
+            raise UploadPartConflict("Part was taken over by another request.")
+        self.refresh_from_db()
+
+
+def _closing_iterator(iterator, f):
+    try:
+        yield from iterator
+    finally:
+        f.close()
+
+
+def choose_upload_codec(sample: bytes) -> int:
+    """
+    Picks the compression codec for a new blob from its first bytes.
+    """
+    return crypto.choose_codec(
+        sample,
+        crypto.codec_by_name(settings.FILE_COMPRESSION),
+        settings.FILE_COMPRESSION_MAX_RATIO,
+    )
+
+
+_encryption_pool = (0, None)
+_encryption_pool_lock = threading.Lock()
+
+
+def encryption_executor():
+    """
+    Returns the process-wide thread pool segments are sealed on, or None
+    when FILE_ENCRYPTION_WORKERS is 1. The pool is shared by all requests so
+    concurrent uploads cannot oversubscribe the cores.
+    """
+    global _encryption_pool
+    workers = settings.FILE_ENCRYPTION_WORKERS
+    if workers <= 1:
+        return None
+    with _encryption_pool_lock:
+        size, pool = _encryption_pool
+        if size != workers:
+            if pool is not None:
+                pool.shutdown(wait=False)
+            pool = ThreadPoolExecutor(workers, thread_name_prefix="encrypt")
+            _encryption_pool = (workers, pool)
+        return pool
+
+
+def encryption_batch() -> int:
+    """
+    Number of segments handed to the encryption pool at a time; bounds the
+    plaintext held in memory per upload.
+    """
+    return max(settings.FILE_ENCRYPTION_WORKERS, 1) * 4
+
+
+def content_digest_secret(owner) -> bytes:
+    """
+    Per-owner secret keying content digests, so equal files of different
+    owners cannot be correlated through their digests.
+    """
+    return salted_hmac(
+        "core.models.content_digest_secret", str(owner.pk), algorithm="sha256"
+    ).digest()
+
+
+def master_key(key_id: str = None) -> bytes:
+    """
+    Looks up a master key in the keyring, defaulting to the current one.
+    """
+    key_id = key_id or settings.MASTER_KEY_ID
+    try:
+        return settings.MASTER_KEYS[key_id]
+    except KeyError:
+        raise ValueError(f"Unknown master key id {key_id!r}")
+
+
+def encrypt_key(key: bytes, key_id: str = None) -> bytes:
+    """
+    Encrypts the given key using AES-GCM with the master key ``key_id``
+    (the current master key by default).
+    Returns the encrypted key with IV and tag appended.
+    """
+    return crypto.wrap_key(master_key(key_id), key)
+
+
+def decrypt_key(encrypted_key: bytes, key_id: str = None) -> bytes:
+    """
+    Decrypts the given key using AES-GCM with the master key ``key_id``.
+    Extracts IV and tag from the encrypted key.
+    """
+    return crypto.unwrap_key(master_key(key_id), encrypted_key)
@@ -0,0 +1,201 @@
+"""
+Previews: small derivatives of uploaded files (image thumbnails, first page
+renders of PDFs, text excerpts) generated once after upload, so that
+browsing files never decrypts them in full.
+
+Previews are encrypted with the file's data key and stored as FilePreview
+rows. Image and PDF rendering need Pillow (and pypdfium2 for PDFs); file
+types without an available renderer simply get no preview.
+"""
+
+import codecs
+import hashlib
+import io
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from mimetypes import guess_type
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from core import crypto
+from core.models import File, FilePreview, decrypt_key
+
+try:
+    from PIL import Image
+except ImportError:  # thumbnails are optional
+    Image = None
+
+try:
+    import pypdfium2
+except ImportError:  # PDF page renders are optional
+    pypdfium2 = None
+
+logger = logging.getLogger(__name__)
+
+TEXT_TYPES = {
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "application/x-sh",
+    "application/x-yaml",
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class SourceTooLarge(Exception):
+    pass
+
+
+def _read(file, limit, strict):
+    """
+    Reads up to ``limit`` plaintext bytes of ``file``, decrypting only the
+    segments needed. With ``strict``, a longer file raises SourceTooLarge.
+    """
+    chunks = file.iter_decrypt()
+    data = bytearray()
+    try:
+        for chunk in chunks:
+            data += chunk
+            if len(data) > limit:
+                if strict:
+                    raise SourceTooLarge(file.pk)
+                break
+    finally:
+        chunks.close()
+    return bytes(data[:limit])
+
+
+def _jpeg(image):
+    out = io.BytesIO()
+    image.convert("RGB").save(out, "JPEG", quality=80, optimize=True)
+    return out.getvalue()
+
+
+def render_text(file):
+    data = _read(file, settings.FILE_PREVIEW_TEXT_BYTES, strict=False)
+    # Drop a multi-byte character cut in half at the end
+    text = codecs.getincrementaldecoder("utf-8")("replace").decode(data)
+    return "text", "text/plain; charset=utf-8", text.encode()
+
+
+def render_image(file):
+    size = (settings.FILE_PREVIEW_SIZE, settings.FILE_PREVIEW_SIZE)
+    data = _read(file, settings.FILE_PREVIEW_MAX_SOURCE_SIZE, strict=True)
+    with Image.open(io.BytesIO(data)) as image:
+        # Lets JPEG decode at a reduced scale, which is much faster
+        image.draft("RGB", size)
+        image.thumbnail(size)
+        return "thumbnail", "image/jpeg", _jpeg(image)
+
+
+def render_pdf(file):
+    size = settings.FILE_PREVIEW_SIZE
+    data = _read(file, settings.FILE_PREVIEW_MAX_SOURCE_SIZE, strict=True)
+    pdf = pypdfium2.PdfDocument(data)
+    try:
+        page = pdf[0]
+        width, height = page.get_size()
+        image = page.render(scale=size / max(width, height, 1)).to_pil()
+        return "page", "image/jpeg", _jpeg(image)
+    finally:
+        pdf.close()
+
+
+def renderers_for(file):
+    content_type = file.content_type or guess_type(file.name or file.file.name)[0] or ""
+    if content_type.startswith("image/") and Image is not None:
+        return [render_image]
+    if content_type == "application/pdf" and pypdfium2 and Image is not None:
+        return [render_pdf]
+    if content_type.startswith("text/") or content_type in TEXT_TYPES:
+        return [render_text]
+    return []
+
+
+def render_previews(file):
+    """
+    Renders every preview available for ``file`` as ``(kind, content_type,
+    data)``. A renderer failing (unsupported content, oversized source) only
+    skips its preview. Touches no database rows, so it can run on any thread.
+    """
+    if file.client_encrypted:
+        return []
+    rendered = []
+    for renderer in renderers_for(file):
+        try:
+            rendered.append(renderer(file))
+        except SourceTooLarge:
+            continue
+        except Exception:
+            logger.warning("Preview of %s failed", file.pk, exc_info=True)
+    return rendered
+
+
+def store_previews(file, rendered):
+    """
+    Encrypts rendered previews with the file's data key and saves them.
+    """
+    if not rendered:
+        return []
+    key = decrypt_key(file.encrypted_key, file.key_id)
+    previews = []
+    for kind, content_type, data in rendered:
+        blob = io.BytesIO()
+        crypto.encrypt_stream(key, io.BytesIO(data), blob)
+        preview, _ = FilePreview.objects.update_or_create(
+            file=file,
+            kind=kind,
+            defaults={
+                "content_type": content_type,
+                "data": blob.getvalue(),
+                "digest": hashlib.sha256(data).hexdigest(),
+            },
+        )
+        previews.append(preview)
+    return previews
+
+
+def generate_previews(file):
+    return store_previews(file, render_previews(file))
+
+
+def _generate_in_background(file_id):
+    close_old_connections()
+    try:
+        file = File.objects.filter(pk=file_id).first()
+        if file is not None:
+            generate_previews(file)
+    except Exception:
+        logger.exception("Preview generation for %s failed", file_id)
+    finally:
+        close_old_connections()
+
+
+def preview_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                settings.FILE_PREVIEW_WORKERS, thread_name_prefix="preview"
+            )
+        return _executor
+
+
+def schedule_previews(file):
+    """
+    Generates the previews of a newly stored file once the current
+    transaction commits: on a background thread, or inline when
+    FILE_PREVIEW_ASYNC is off.
+    """
+    if not renderers_for(file) or file.client_encrypted:
+        return
+    if settings.FILE_PREVIEW_ASYNC:
+        transaction.on_commit(
+            lambda: preview_executor().submit(_generate_in_background, file.pk)
+        )
+    else:
+        transaction.on_commit(lambda: generate_previews(file))
@@ -0,0 +1,72 @@
+"""
+Storage quotas.
+
+A user's quota is ``User.storage_quota`` if set, otherwise the quota of
+their role in ``settings.FILE_STORAGE_QUOTAS`` (None: unlimited). Usage is
+read from the user's StorageUsage row, so a check costs one indexed read.
+"""
+
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import transaction
+
+from core.models import StorageUsage
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, quota, usage):
+        super().__init__(f"Storage quota of {quota} bytes exceeded")
+        self.quota = quota
+        self.usage = usage
+
+
+def storage_quota(user):
+    if user.storage_quota is not None:
+        return user.storage_quota
+    return settings.FILE_STORAGE_QUOTAS.get(user.role)
+
+
+def check_quota(user, size):
+    """
+    Raises QuotaExceeded if storing ``size`` more bytes would take ``user``
+    over their quota. Used to turn uploads away before they are received.
+    """
+    quota = storage_quota(user)
+    if quota is None:
+        return
+    usage = StorageUsage.for_user(user.pk).bytes
+    if usage + size > quota:
+        raise QuotaExceeded(quota, usage)
+
+
+class Reservation:
+    """
+    The remaining space of a user while their usage row is locked.
+    """
+
+    def __init__(self, quota, usage):
+        self.quota = quota
+        self.usage = usage
+
+    def fits(self, size):
+        return self.quota is None or self.usage + size <= self.quota
+
+    def take(self, size):
+        if not self.fits(size):
+            raise QuotaExceeded(self.quota, self.usage)
+        self.usage += size
+
+
+@contextmanager
+def quota_reservation(user):
+    """
+    Opens a transaction holding the lock on the usage row of ``user`` and
+    yields a Reservation of their remaining space. Files created in the
+    block are counted before the lock is released, so concurrent uploads
+    cannot both fit into the same space.
+    """
+    quota = storage_quota(user)
+    with transaction.atomic():
+        usage = StorageUsage.for_user(user.pk, lock=True)
+        yield Reservation(quota, usage.bytes)
@@ -0,0 +1,71 @@
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+
+from .blacklist import blacklist_filter
+from .models import ContentBlob, File, StorageUsage
+from .previews import schedule_previews
+
+
+@receiver(post_save, sender=File)
+def count_new_file(sender, instance, created, **kwargs):
+    """
+    Adds a new File to its owner's StorageUsage in the creating transaction.
+    """
+    if created:
+        StorageUsage.add(instance.owner_id, instance.quota_bytes, 1)
+
+
+@receiver(post_delete, sender=File)
+def uncount_deleted_file(sender, instance, **kwargs):
+    """
+    Subtracts a deleted File from its owner's StorageUsage. A missing row is
+    left to be computed from the File table when it is first needed.
+    """
+    StorageUsage.objects.filter(user_id=instance.owner_id).update(
+        bytes=F("bytes") - instance.quota_bytes, files=F("files") - 1
+    )
+
+
+@receiver(post_delete, sender=File)
+def release_blob(sender, instance, **kwargs):
+    """
+    Drops the deleted File's reference to its blob and removes the blob from
+    storage once no other File of the owner references it.
+    """
+    name = instance.file.name
+    if instance.content_digest:
+        blobs = ContentBlob.objects.filter(
+            owner_id=instance.owner_id, digest=instance.content_digest
+        )
+        blobs.filter(ref_count__gt=0).update(ref_count=F("ref_count") - 1)
+        blobs.filter(ref_count=0).delete()
+        if File.objects.filter(
+            owner_id=instance.owner_id, content_digest=instance.content_digest
+        ).exists():
+            return
+
+    if name:
+        storage = instance.file.storage
+        transaction.on_commit(lambda: storage.delete(name))
+
+
+@receiver(post_save, sender=File)
+def create_previews(sender, instance, created, **kwargs):
+    """
+    Schedules preview generation for Files created from an encrypted blob.
+    """
+    if created and instance.encrypted_key:
+        schedule_previews(instance)
+
+
+@receiver(post_save, sender=BlacklistedToken)
+def filter_blacklisted_token(sender, instance, created, **kwargs):
+    """
+    Adds a token blacklisted by this process to its filter right away, so
+    it is refused before the next sync.
+    """
+    if created:
+        blacklist_filter.add(instance.token.jti)
@@ -0,0 +1,81 @@
+"""
+Content type detection from the first bytes of a file.
+
+Uploads are typed by their magic bytes where a signature is known, so the
+stored type does not depend on the (client supplied) file name. The name
+only decides between formats sharing a container (e.g. .docx in a ZIP) and
+types without a signature, such as the many kinds of text.
+"""
+
+from mimetypes import guess_type
+
+DEFAULT_CONTENT_TYPE = "application/octet-stream"
+
+# Bytes of the content needed to tell its type
+SAMPLE_SIZE = 4096
+
+TEXT_TYPES = {"application/json", "application/javascript", "application/xml"}
+
+# (offset, signature, content type), most specific first
+SIGNATURES = [
+    (0, b"%PDF-", "application/pdf"),
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (0, b"II*\x00", "image/tiff"),
+    (0, b"MM\x00*", "image/tiff"),
+    (0, b"BM", "image/bmp"),
+    (0, b"\x00\x00\x01\x00", "image/vnd.microsoft.icon"),
+    (8, b"WEBP", "image/webp"),
+    (8, b"WAVE", "audio/wav"),
+    (8, b"AVI ", "video/x-msvideo"),
+    (4, b"ftypheic", "image/heic"),
+    (4, b"ftypqt", "video/quicktime"),
+    (4, b"ftyp", "video/mp4"),
+    (0, b"\x1aE\xdf\xa3", "video/webm"),
+    (0, b"ID3", "audio/mpeg"),
+    (0, b"OggS", "audio/ogg"),
+    (0, b"fLaC", "audio/flac"),
+    (0, b"PK\x03\x04", "application/zip"),
+    (0, b"\x1f\x8b", "application/gzip"),
+    (0, b"7z\xbc\xaf\x27\x1c", "application/x-7z-compressed"),
+    (0, b"Rar!\x1a\x07", "application/vnd.rar"),
+    (0, b"BZh", "application/x-bzip2"),
+    (0, b"\xfd7zXZ\x00", "application/x-xz"),
+    (0, b"\x28\xb5\x2f\xfd", "application/zstd"),
+    (0, b"SQLite format 3\x00", "application/vnd.sqlite3"),
+    (0, b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "application/x-ole-storage"),
+    (0, b"\x7fELF", "application/x-executable"),
+]
+
+# Containers whose contents the file name identifies better
+CONTAINERS = {"application/zip", "application/x-ole-storage"}
+
+
+def _looks_like_text(sample):
+    if b"\x00" in sample:
+        return False
+    try:
+        sample.decode("utf-8")
+    except UnicodeDecodeError as e:
+        # A multi-byte character may be cut off at the end of the sample
+        return e.start >= len(sample) - 3 and e.reason == "unexpected end of data"
+    return True
+
+
+def sniff_content_type(sample, name=""):
+    """
+    Returns the content type of a file starting with ``sample``.
+    """
+    guessed, _ = guess_type(name) if name else (None, None)
+    for offset, signature, content_type in SIGNATURES:
+        if sample[offset : offset + len(signature)] == signature:
+            if content_type in CONTAINERS and guessed:
+                return guessed
+            return content_type
+    if sample and _looks_like_text(sample):
+        if guessed and (guessed.startswith("text/") or guessed in TEXT_TYPES):
+            return guessed
+        return "text/plain"
+    return guessed or DEFAULT_CONTENT_TYPE
@@ -0,0 +1,589 @@
+"""
+Storage backends for encrypted file blobs.
+
+Blobs are immutable once written. New blobs are produced either by a
+``BlobWriter`` (streamed in order, e.g. while an upload is received) or by a
+``MultipartBlob`` (parts written in any order, for resumable uploads). Both
+stay invisible until ``commit()`` and leave nothing behind on ``abort()``.
+``link(name, new_name)`` makes an existing blob also readable under a new
+name, so blobs can be moved without a moment where neither name exists.
+``scan(prefix)`` lists the stored blobs under a prefix with their sizes.
+
+``FileSystemBlobStorage`` keeps uncommitted blobs in ``<name>.part`` files
+renamed into place on commit. ``S3BlobStorage`` maps both onto S3 multipart
+uploads and serves reads with ranged GETs, so any backend node can read any
+blob without a shared volume.
+
+The backend is configured as the ``blobs`` alias in ``settings.STORAGES``.
+"""
+
+import errno
+import os
+import tempfile
+from io import BufferedIOBase, UnsupportedOperation
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import FileSystemStorage, Storage, storages
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.deconstruct import deconstructible
+from django.utils.functional import LazyObject, empty
+
+try:
+    import boto3
+    from botocore.config import Config
+except ImportError:  # only needed for S3BlobStorage without a client
+    boto3 = None
+
+BLOB_STORAGE_ALIAS = "blobs"
+
+# S3 rejects multipart parts (other than the last) smaller than this
+MIN_PART_SIZE = 5 * 1024 * 1024
+# Blobs copied through the application are streamed in chunks of this size
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class BlobStorage(LazyObject):
+    def _setup(self):
+        self._wrapped = storages[BLOB_STORAGE_ALIAS]
+
+
+blob_storage = BlobStorage()
+
+
+def get_blob_storage():
+    """
+    Storage of the ``File.file`` field; resolved lazily so that overriding
+    STORAGES (e.g. in tests) takes effect.
+    """
+    return blob_storage
+
+
+@receiver(setting_changed)
+def reset_blob_storage(*, setting, **kwargs):
+    if setting == "STORAGES":
+        blob_storage._wrapped = empty
+
+
+def copy_blob(storage, name, new_name):
+    """
+    Copies blob ``name`` of ``storage`` to ``new_name`` chunk by chunk, for
+    links the backend cannot make natively.
+    """
+    writer = storage.writer(new_name)
+    try:
+        with storage.open(name, "rb") as src:
+            while chunk := src.read(COPY_CHUNK_SIZE):
+                writer.write(chunk)
+        writer.commit()
+    except BaseException:
+        writer.abort()
+        raise
+
+
+class BlobWriter:
+    """
+    Sequential writer for the new blob ``name``.
+    """
+
+    name = None
+
+    def write(self, data):
+        raise NotImplementedError
+
+    def commit(self):
+        """
+        Makes the blob visible under its name.
+        """
+        raise NotImplementedError
+
+    def abort(self):
+        """
+        Discards everything written so far. Safe to call more than once,
+        and does nothing once the blob has been committed.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Releases what is held for writing (file handles, buffered parts)
+        once everything was written; the blob is still committed or aborted
+        later. Safe to call more than once.
+        """
+
+
+class MultipartBlob:
+    """
+    A blob assembled from numbered parts uploaded independently, possibly
+    by different processes. ``upload_id`` identifies it across requests.
+    """
+
+    def __init__(self, storage, name, upload_id, parts=()):
+        self.storage = storage
+        self.name = name
+        self.upload_id = upload_id
+        # (number, etag) of every part, set before commit
+        self.parts = list(parts)
+
+    def upload_part(self, number, offset, chunks):
+        """
+        Stores part ``number`` (1-based), which starts at byte ``offset`` of
+        the blob, from the iterable of bytes ``chunks``. Returns its ETag.
+        """
+        return self.storage._upload_part(self, number, offset, chunks)
+
+    def commit(self):
+        self.storage._complete_multipart(self)
+
+    def abort(self):
+        self.storage._abort_multipart(self)
+
+
+class _FileBlobWriter(BlobWriter):
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.part_path = f"{path}.part"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(self.part_path, "wb")
+
+    def write(self, data):
+        self.file.write(data)
+
+    def _close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self._close()
+
+    def commit(self):
+        self.close()
+        os.replace(self.part_path, self.path)
+
+    def abort(self):
+        self._close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+
+@deconstructible(path="core.storage.FileSystemBlobStorage")
+class FileSystemBlobStorage(FileSystemStorage):
+    """
+    Blobs on a local (or shared) filesystem under ``location``.
+    """
+
+    # Smallest part (but the last) a multipart blob accepts
+    min_part_size = 0
+
+    def writer(self, name):
+        return _FileBlobWriter(name, self.path(name))
+
+    def multipart(self, name, upload_id=None, parts=()):
+        part_path = f"{self.path(name)}.part"
+        if upload_id is None:
+            os.makedirs(os.path.dirname(part_path), exist_ok=True)
+            open(part_path, "wb").close()
+            upload_id = ""
+        return MultipartBlob(self, name, upload_id, parts)
+
+    def _upload_part(self, blob, number, offset, chunks):
+        fd = os.open(f"{self.path(blob.name)}.part", os.O_WRONLY)
+        try:
+            for chunk in chunks:
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return ""
+
+    def _complete_multipart(self, blob):
+        path = self.path(blob.name)
+        os.replace(f"{path}.part", path)
+
+    def _abort_multipart(self, blob):
+        part_path = f"{self.path(blob.name)}.part"
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+    def link(self, name, new_name):
+        # A hard link appears atomically and shares the data with ``name``
+        new_path = self.path(new_name)
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        try:
+            os.link(self.path(name), new_path)
+        except FileExistsError:
+            if not os.path.samefile(self.path(name), new_path):
+                raise
+        except OSError as e:
+            # Across devices, or on a filesystem without hard links
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+            copy_blob(self, name, new_name)
+
+    def scan(self, prefix):
+        """
+        Yields ``(name, size, modified timestamp)`` of every file under the
+        directory ``prefix``, including uncommitted ``.part`` files.
+        """
+        stack = [self.path(prefix)]
+        while stack:
+            try:
+                entries = os.scandir(stack.pop())
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        stat = entry.stat(follow_symlinks=False)
+                        name = os.path.relpath(entry.path, self.location)
+                        yield (
+                            name.replace(os.sep, "/"),
+                            stat.st_size,
+                            stat.st_mtime,
+                        )
+
+
+class S3BlobFile(BufferedIOBase):
+    """
+    Read-only, seekable view of an S3 object.
+
+    Reading streams one GET from the current position, so sequential reads
+    cost a single request; seeking elsewhere starts a new ranged GET.
+    """
+
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+        self._key = storage._key(name)
+        self._position = 0
+        self._body = None
+        self._size = None
+
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = self.storage.size(self.name)
+        return self._size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        if offset != self._position:
+            self._close_body()
+            self._position = offset
+        return self._position
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if self._body is None:
+            if self._size is not None and self._position >= self._size:
+                return b""
+            self._body = self.storage._get_body(self._key, self._position)
+            if self._body is None:
+                return b""
+        data = self._body.read() if size is None or size < 0 else self._body.read(size)
+        self._position += len(data)
+        return data
+
+    def read1(self, size=-1):
+        return self.read(size)
+
+    def write(self, data):
+        raise UnsupportedOperation("S3 blobs are read-only")
+
+    def _close_body(self):
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+
+    def close(self):
+        self._close_body()
+        super().close()
+
+
+class _S3BlobWriter(BlobWriter):
+    """
+    Buffers up to one part in memory; small blobs are stored with a single
+    PUT, larger ones with a multipart upload started on the first full part.
+    """
+
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+        self.buffer = bytearray()
+        self.blob = None
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.storage.part_size:
+            self._flush(self.storage.part_size)
+
+    def _flush(self, size):
+        if self.blob is None:
+            self.blob = self.storage.multipart(self.name)
+        number = len(self.blob.parts) + 1
+        etag = self.blob.upload_part(number, None, [bytes(self.buffer[:size])])
+        self.blob.parts.append((number, etag))
+        del self.buffer[:size]
+
+    def close(self):
+        # The rest goes up as the last part; only a blob stored with a
+        # single PUT stays buffered
+        if self.blob is not None and self.buffer:
+            self._flush(len(self.buffer))
+
+    def commit(self):
+        if self.blob is None:
+            self.storage.client.put_object(
+                Bucket=self.storage.bucket,
+                Key=self.storage._key(self.name),
+                Body=bytes(self.buffer),
+            )
+        else:
+            if self.buffer:
+                self._flush(len(self.buffer))
+            self.blob.commit()
+            self.blob = None
+        self.buffer = bytearray()
+
+    def abort(self):
+        self.buffer = bytearray()
+        if self.blob is not None:
+            self.blob.abort()
+            self.blob = None
+
+
+@deconstructible(path="core.storage.S3BlobStorage")
+class S3BlobStorage(Storage):
+    """
+    Blobs in an S3-compatible object store.
+
+    ``client`` may be any object implementing the subset of the boto3 S3
+    client API used here (see ``core.fake_s3``); by default a boto3 client
+    with a connection pool of ``max_pool_connections`` is created on first
+    use and shared by all threads. Multipart parts but the last must hold
+    at least ``min_part_size`` bytes.
+    """
+
+    # Largest object CopyObject copies
+    max_copy_size = 5 * 1024**3
+
+    def __init__(
+        self,
+        bucket=None,
+        prefix="",
+        client=None,
+        endpoint_url=None,
+        region_name=None,
+        access_key=None,
+        secret_key=None,
+        max_pool_connections=10,
+        part_size=8 * 1024 * 1024,
+        min_part_size=MIN_PART_SIZE,
+    ):
+        if not bucket:
+            raise ImproperlyConfigured("S3BlobStorage needs a bucket")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.part_size = part_size
+        self.min_part_size = min_part_size
+        self.max_pool_connections = max_pool_connections
+        self._client = client
+        self._client_options = {
+            "endpoint_url": endpoint_url,
+            "region_name": region_name,
+            "aws_access_key_id": access_key,
+            "aws_secret_access_key": secret_key,
+        }
+
+    @property
+    def client(self):
+        if self._client is None:
+            if boto3 is None:
+                raise ImproperlyConfigured("S3BlobStorage requires boto3")
+            self._client = boto3.client(
+                "s3",
+                config=Config(
+                    max_pool_connections=self.max_pool_connections,
+                    retries={"mode": "standard"},
+                ),
+                **self._client_options,
+            )
+        return self._client
+
+    def _key(self, name):
+        name = name.replace("\\", "/").lstrip("/")
+        return f"{self.prefix}/{name}" if self.prefix else name
+
+    def _error_code(self, exc):
+        return exc.response.get("Error", {}).get("Code")
+
+    def _get_body(self, key, start):
+        """
+        Returns the streaming body of ``key`` from byte ``start`` on, or
+        None if ``start`` is at or past the end of the object.
+        """
+        kwargs = {"Bucket": self.bucket, "Key": key}
+        if start:
+            kwargs["Range"] = f"bytes={start}-"
+        try:
+            return self.client.get_object(**kwargs)["Body"]
+        except self.client.exceptions.ClientError as e:
+            if self._error_code(e) == "InvalidRange":
+                return None
+            if self._error_code(e) in ("NoSuchKey", "404"):
+                raise FileNotFoundError(key)
+            raise
+
+    def _open(self, name, mode="rb"):
+        if "w" in mode or "a" in mode or "+" in mode:
+            raise ValueError("S3 blobs are written with writer()")
+        file = S3BlobFile(self, name)
+        # Start the GET now so a missing blob fails on open
+        file.read(0)
+        return file
+
+    def _save(self, name, content):
+        writer = self.writer(name)
+        try:
+            for chunk in content.chunks():
+                writer.write(chunk)
+            writer.commit()
+        except BaseException:
+            writer.abort()
+            raise
+        return name
+
+    def writer(self, name):
+        return _S3BlobWriter(self, name)
+
+    def multipart(self, name, upload_id=None, parts=()):
+        if upload_id is None:
+            upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self._key(name)
+            )["UploadId"]
+        return MultipartBlob(self, name, upload_id, parts)
+
+    def _upload_part(self, blob, number, offset, chunks):
+        # Spool large parts to disk rather than holding them in memory
+        with tempfile.SpooledTemporaryFile(max_size=self.part_size) as body:
+            for chunk in chunks:
+                body.write(chunk)
+            body.seek(0)
+            return self.client.upload_part(
+                Bucket=self.bucket,
+                Key=self._key(blob.name),
+                UploadId=blob.upload_id,
+                PartNumber=number,
+                Body=body,
+            )["ETag"]
+
+    def _complete_multipart(self, blob):
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self._key(blob.name),
+            UploadId=blob.upload_id,
+            MultipartUpload={
+                "Parts": [
+                    {"PartNumber": number, "ETag": etag}
+                    for number, etag in sorted(blob.parts)
+                ]
+            },
+        )
+
+    def _abort_multipart(self, blob):
+        try:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self._key(blob.name), UploadId=blob.upload_id
+            )
+        except self.client.exceptions.ClientError as e:
+            if self._error_code(e) != "NoSuchUpload":
+                raise
+
+    def _head(self, name):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._key(name))
+        except self.client.exceptions.ClientError as e:
+            if self._error_code(e) in ("NoSuchKey", "404", "NotFound"):
+                return None
+            raise
+
+    def exists(self, name):
+        return self._head(name) is not None
+
+    def size(self, name):
+        head = self._head(name)
+        if head is None:
+            raise FileNotFoundError(name)
+        return head["ContentLength"]
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(name))
+
+    def link(self, name, new_name):
+        # Server-side copy; the new object appears atomically when complete.
+        # CopyObject is limited in size: larger blobs are streamed instead.
+        if self.size(name) > self.max_copy_size:
+            copy_blob(self, name, new_name)
+            return
+        try:
+            self.client.copy_object(
+                Bucket=self.bucket,
+                Key=self._key(new_name),
+                CopySource={"Bucket": self.bucket, "Key": self._key(name)},
+            )
+        except self.client.exceptions.ClientError as e:
+            if self._error_code(e) in ("NoSuchKey", "404"):
+                raise FileNotFoundError(name)
+            raise
+
+    def scan(self, prefix):
+        """
+        Yields ``(name, size, modified timestamp)`` of every object under
+        ``prefix``. Unfinished multipart uploads are not objects yet.
+        """
+        strip = len(self._key(""))
+        kwargs = {"Bucket": self.bucket, "Prefix": self._key(prefix)}
+        while True:
+            page = self.client.list_objects_v2(**kwargs)
+            for item in page.get("Contents", []):
+                yield (
+                    item["Key"][strip:],
+                    item["Size"],
+                    item["LastModified"].timestamp(),
+                )
+            if not page.get("IsTruncated"):
+                return
+            kwargs["ContinuationToken"] = page["NextContinuationToken"]
+
+    def url(self, name):
+        # Blobs are ciphertext and only ever served through the API
+        return f"s3://{self.bucket}/{self._key(name)}"
+
+    def get_modified_time(self, name):
+        head = self._head(name)
+        if head is None:
+            raise FileNotFoundError(name)
+        return head["LastModified"]
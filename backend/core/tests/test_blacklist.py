@@ -0,0 +1,79 @@
+import uuid
+
+from django.test import SimpleTestCase, TestCase, override_settings
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.token_blacklist.models import (
+    BlacklistedToken,
+    OutstandingToken,
+)
+
+from core.authentication import FilteredRefreshToken
+from core.blacklist import BloomFilter, blacklist_filter
+from core.models import User
+
+
+class BloomFilterTestCase(SimpleTestCase):
+    def test_no_false_negatives_and_bounded_error(self):
+        bloom = BloomFilter(1000, 0.01)
+        members = [uuid.uuid4().hex for _ in range(1000)]
+        for member in members:
+            bloom.add(member)
+        self.assertTrue(all(member in bloom for member in members))
+
+        others = [uuid.uuid4().hex for _ in range(10000)]
+        false_positives = sum(other in bloom for other in others)
+        self.assertLess(false_positives / len(others), 0.03)
+        self.assertAlmostEqual(bloom.expected_error_rate(), 0.01, delta=0.005)
+
+
+@override_settings(JWT_BLACKLIST_FILTER_SYNC_SECONDS=0)
+class BlacklistFilterTestCase(TestCase):
+    def setUp(self):
+        blacklist_filter.reset()
+        self.addCleanup(blacklist_filter.reset)
+        self.user = User.objects.create_user(
+            email="testuser@example.com", password="testpassword", is_active=True
+        )
+
+    def blacklist_elsewhere(self, jti, **fields):
+        # bulk_create sends no signals, like a row written by another process
+        token = OutstandingToken.objects.create(
+            user=self.user, jti=jti, token="", expires_at="2100-01-01T00:00Z"
+        )
+        BlacklistedToken.objects.bulk_create([BlacklistedToken(token=token, **fields)])
+
+    def test_negative_answers_skip_the_database(self):
+        refresh = FilteredRefreshToken.for_user(self.user)
+        with override_settings(JWT_BLACKLIST_FILTER_SYNC_SECONDS=60):
+            blacklist_filter.is_blacklisted("warm-up")
+            with self.assertNumQueries(0):
+                FilteredRefreshToken(str(refresh))
+
+        refresh.blacklist()
+        with self.assertRaises(TokenError):
+            FilteredRefreshToken(str(refresh))
+        stats = blacklist_filter.stats()
+        self.assertEqual(stats["tokens"], 1)
+        self.assertEqual(stats["database_checks"], 1)
+
+    def test_follows_rows_written_by_other_processes(self):
+        self.assertFalse(blacklist_filter.is_blacklisted("first"))
+        self.blacklist_elsewhere("first")
+        self.assertTrue(blacklist_filter.is_blacklisted("first"))
+
+        # A row committed after one with a higher id is still picked up
+        cursor = blacklist_filter.cursor
+        self.blacklist_elsewhere("late", id=cursor + 2)
+        self.assertTrue(blacklist_filter.is_blacklisted("late"))
+        self.blacklist_elsewhere("early", id=cursor + 1)
+        self.assertTrue(blacklist_filter.is_blacklisted("early"))
+        self.assertEqual(blacklist_filter.gaps, {})
+
+    def test_false_positives_are_confirmed_and_counted(self):
+        self.assertFalse(blacklist_filter.is_blacklisted("warm-up"))
+        blacklist_filter.add("revoked-then-deleted")
+        self.assertFalse(blacklist_filter.is_blacklisted("revoked-then-deleted"))
+        stats = blacklist_filter.stats()
+        self.assertEqual(stats["false_positives"], 1)
+        self.assertEqual(stats["false_positive_rate"], 0.5)
+        self.assertGreater(stats["size_bytes"], 0)
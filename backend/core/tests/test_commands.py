@@ -0,0 +1,329 @@
+import errno
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework_simplejwt.token_blacklist.models import (
+    BlacklistedToken,
+    OutstandingToken,
+)
+
+from core.models import (
+    BLOB_PREFIX,
+    ContentBlob,
+    File,
+    ScrubRun,
+    StorageUsage,
+    UploadSession,
+    User,
+    blob_path,
+)
+from core.management.commands.reconcile_blobs import QUARANTINE_PREFIX
+from core.storage import blob_storage
+
+
+class CommandTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email="testuser@example.com", password="testpassword"
+        )
+
+    def encrypted_file(self, filename, content, **fields):
+        file = File.objects.create(
+            owner=self.user, file=SimpleUploadedFile(filename, content), **fields
+        )
+        file.encrypt_file()
+        return file
+
+
+class RotateMasterKeyTestCase(CommandTestCase):
+    def setUp(self):
+        super().setUp()
+        self.file = self.encrypted_file(
+            "test_file.txt", b"rotate me", name="test_file.txt"
+        )
+        self.old_id = self.file.key_id
+
+    def test_rotate_master_key(self):
+        keyring = {self.old_id: settings.MASTER_KEY, "next": os.urandom(32)}
+        with override_settings(MASTER_KEYS=keyring, MASTER_KEY_ID="next"):
+            blob = self.file.file.read()
+            self.file.file.close()
+            call_command("rotate_master_key", workers=1, stdout=StringIO())
+
+            self.file.refresh_from_db()
+            self.assertEqual(self.file.key_id, "next")
+            self.assertEqual(self.file.decrypt_file(), b"rotate me")
+            with self.file.file.open("rb") as f:
+                self.assertEqual(f.read(), blob)
+
+            # A second run finds nothing left to do
+            out = StringIO()
+            call_command("rotate_master_key", workers=1, stdout=out)
+            self.assertIn("files: nothing to rewrap", out.getvalue())
+
+
+class ScrubBlobsTestCase(CommandTestCase):
+    def setUp(self):
+        super().setUp()
+        self.files = [
+            self.encrypted_file(f"file{i}.txt", os.urandom(100), name=f"file{i}.txt")
+            for i in range(3)
+        ]
+        self.files.sort(key=lambda file: file.pk)
+
+    def test_scrub_records_integrity(self):
+        ok, corrupt, missing = self.files
+        with open(corrupt.file.path, "r+b") as f:
+            f.seek(60)
+            byte = f.read(1)
+            f.seek(60)
+            f.write(bytes([byte[0] ^ 1]))
+        os.remove(missing.file.path)
+
+        out = StringIO()
+        call_command("scrub_blobs", workers=2, rate=0, batch_size=2, stdout=out)
+        for file in self.files:
+            file.refresh_from_db()
+            self.assertIsNotNone(file.verified_at)
+        self.assertEqual(ok.integrity, "ok")
+        self.assertEqual(corrupt.integrity, "corrupt")
+        self.assertEqual(missing.integrity, "missing")
+
+        run = ScrubRun.objects.get()
+        self.assertIsNotNone(run.finished_at)
+        self.assertEqual((run.files_checked, run.failures), (3, 2))
+        self.assertIn(f"CORRUPT: {corrupt.pk}", out.getvalue())
+        self.assertIn(f"MISSING: {missing.pk}", out.getvalue())
+
+    def test_scrub_resumes_from_checkpoint(self):
+        ScrubRun.objects.create(last_file_id=self.files[0].pk, files_checked=1)
+        out = StringIO()
+        call_command("scrub_blobs", resume=True, rate=0, stdout=out)
+
+        self.files[0].refresh_from_db()
+        self.assertIsNone(self.files[0].verified_at)
+        run = ScrubRun.objects.get()
+        self.assertEqual(run.files_checked, 3)
+        self.assertIsNotNone(run.finished_at)
+        self.assertIn("No integrity failures found", out.getvalue())
+
+
+class GeneratePreviewsTestCase(CommandTestCase):
+    def test_backfills_missing_previews(self):
+        file = self.encrypted_file("readme.md", b"# Title\n", name="readme.md")
+        call_command("generate_previews", workers=2, stdout=StringIO())
+        preview = file.previews.get()
+        self.assertEqual(preview.decrypt(), b"# Title\n")
+
+        out = StringIO()
+        call_command("generate_previews", stdout=out)
+        self.assertIn("0 candidate files", out.getvalue())
+
+
+class MigrateBlobLayoutTestCase(CommandTestCase):
+    def legacy_file(self, filename, content, **fields):
+        file = self.encrypted_file(filename, content, **fields)
+        legacy = f"uploads/{self.user.pk}/{file.pk}/{filename}"
+        blob_storage.link(file.file.name, legacy)
+        blob_storage.delete(file.file.name)
+        File.objects.filter(pk=file.pk).update(file=legacy)
+        file.refresh_from_db()
+        return file
+
+    def test_moves_blobs_to_sharded_layout(self):
+        first = self.legacy_file("report.txt", b"quarterly numbers")
+        ContentBlob.objects.create(
+            owner=self.user,
+            digest="d" * 64,
+            storage_name=first.file.name,
+            encrypted_key=first.encrypted_key,
+            key_id=first.key_id,
+            ref_count=2,
+        )
+        File.objects.filter(pk=first.pk).update(content_digest="d" * 64)
+        copy = File.objects.create(
+            owner=self.user,
+            name="copy.txt",
+            file=first.file.name,
+            encrypted_key=first.encrypted_key,
+            key_id=first.key_id,
+            content_digest="d" * 64,
+        )
+        other = self.legacy_file("notes.md", b"# notes", name="notes.md")
+        legacy_dir = os.path.dirname(blob_storage.path(first.file.name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("migrate_blob_layout", batch_size=1, stdout=StringIO())
+
+        for file in (first, copy, other):
+            file.refresh_from_db()
+            self.assertTrue(file.file.name.startswith(BLOB_PREFIX))
+        self.assertEqual(first.file.name, blob_path(first.pk))
+        self.assertEqual(copy.file.name, first.file.name)
+        self.assertEqual(ContentBlob.objects.get().storage_name, first.file.name)
+        self.assertEqual(first.name, "report.txt")
+        self.assertEqual(copy.decrypt_file(), b"quarterly numbers")
+        self.assertEqual(other.decrypt_file(), b"# notes")
+        self.assertFalse(os.path.exists(legacy_dir))
+
+        out = StringIO()
+        call_command("migrate_blob_layout", stdout=out)
+        self.assertIn("Moved 0 blobs", out.getvalue())
+
+    def test_streams_blobs_without_hard_links(self):
+        file = self.legacy_file("report.txt", os.urandom(3 * 1024 * 1024 + 5))
+        content = file.decrypt_file()
+        legacy = file.file.name
+
+        def no_hard_links(src, dst):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+        with mock.patch("core.storage.os.link", no_hard_links):
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command("migrate_blob_layout", stdout=StringIO())
+        file.refresh_from_db()
+        self.assertEqual(file.file.name, blob_path(file.pk))
+        self.assertEqual(file.decrypt_file(), content)
+        self.assertFalse(blob_storage.exists(legacy))
+
+
+class ReconcileStorageUsageTestCase(CommandTestCase):
+    def test_corrects_drift(self):
+        self.encrypted_file("file.txt", b"count me", name="file.txt")
+        StorageUsage.objects.filter(pk=self.user.pk).update(bytes=1000, files=5)
+
+        out = StringIO()
+        call_command("reconcile_storage_usage", stdout=out)
+        usage = StorageUsage.objects.get(pk=self.user.pk)
+        self.assertEqual((usage.bytes, usage.files), (8, 1))
+        self.assertIn("Corrected the usage of 1 users", out.getvalue())
+
+
+class ReconcileBlobsTestCase(CommandTestCase):
+    def setUp(self):
+        super().setUp()
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        storages = {
+            **settings.STORAGES,
+            "blobs": {
+                "BACKEND": "core.storage.FileSystemBlobStorage",
+                "OPTIONS": {"location": location},
+            },
+        }
+        self.settings = override_settings(STORAGES=storages)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+        self.file = self.encrypted_file("kept.txt", b"referenced", name="kept.txt")
+        self.session = UploadSession.start(self.user, "big.bin", 100, 50)
+        self.orphan = self.blob(b"left behind", age_hours=48)
+        self.stale_part = self.blob(b"half written", age_hours=48, suffix=".part")
+        self.recent = self.blob(b"just written", age_hours=0)
+        for name in (self.file.file.name, f"{self.session.storage_name}.part"):
+            self.age(name, 48)
+
+    def age(self, name, hours):
+        modified = time.time() - hours * 3600
+        os.utime(blob_storage.path(name), (modified, modified))
+
+    def blob(self, content, age_hours, suffix=""):
+        name = blob_path(uuid.uuid4()) + suffix
+        path = blob_storage.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+        self.age(name, age_hours)
+        return name
+
+    def remaining(self):
+        return {name for name, _, _ in blob_storage.scan(BLOB_PREFIX)}
+
+    def test_reports_orphans_without_removing(self):
+        before = self.remaining()
+        out = StringIO()
+        call_command("reconcile_blobs", workers=2, stdout=out)
+        self.assertIn("Scanned 5 blobs in 257 shards: 2 orphaned", out.getvalue())
+        self.assertIn("1 too recent", out.getvalue())
+        self.assertEqual(self.remaining(), before)
+
+    def test_deletes_orphans(self):
+        out = StringIO()
+        call_command("reconcile_blobs", delete=True, stdout=out)
+        self.assertEqual(
+            self.remaining(),
+            {
+                self.file.file.name,
+                f"{self.session.storage_name}.part",
+                self.recent,
+            },
+        )
+        self.assertIn("Deleted 2 blobs, reclaiming", out.getvalue())
+        self.assertEqual(self.file.decrypt_file(), b"referenced")
+
+    def test_quarantines_one_shard(self):
+        shard = self.orphan.split("/")[1]
+        out = StringIO()
+        call_command("reconcile_blobs", quarantine=True, shard=[shard], stdout=out)
+        self.assertIn("Scanned", out.getvalue())
+        self.assertIn(" in 1 shards", out.getvalue())
+        self.assertFalse(blob_storage.exists(self.orphan))
+        with blob_storage.open(QUARANTINE_PREFIX + self.orphan) as f:
+            self.assertEqual(f.read(), b"left behind")
+        self.assertTrue(blob_storage.exists(self.recent))
+
+
+class CompactTokensTestCase(CommandTestCase):
+    def setUp(self):
+        super().setUp()
+        now = timezone.now()
+        for i, (expires_in, blacklisted) in enumerate(
+            [(-2, True), (-1, False), (-1, True), (1, True), (1, False)]
+        ):
+            token = OutstandingToken.objects.create(
+                user=self.user,
+                jti=f"jti-{i}",
+                token="",
+                expires_at=now + timedelta(days=expires_in),
+            )
+            if blacklisted:
+                BlacklistedToken.objects.create(token=token)
+
+    def test_deletes_expired_tokens_in_batches(self):
+        out = StringIO()
+        call_command("compact_tokens", batch_size=2, pause=0, stdout=out)
+        self.assertIn(
+            "Deleted 3 outstanding and 2 blacklisted tokens in 2 batches",
+            out.getvalue(),
+        )
+        self.assertIn("Write lock held", out.getvalue())
+        self.assertEqual(
+            set(OutstandingToken.objects.values_list("jti", flat=True)),
+            {"jti-3", "jti-4"},
+        )
+        self.assertEqual(
+            list(BlacklistedToken.objects.values_list("token__jti", flat=True)),
+            ["jti-3"],
+        )
+
+        # Nothing is left for a second run
+        out = StringIO()
+        call_command("compact_tokens", stdout=out)
+        self.assertIn("Deleted 0 outstanding", out.getvalue())
+
+    def test_dry_run_only_counts(self):
+        out = StringIO()
+        call_command("compact_tokens", dry_run=True, stdout=out)
+        self.assertIn("3 expired outstanding tokens, 2 of them", out.getvalue())
+        self.assertEqual(OutstandingToken.objects.count(), 5)
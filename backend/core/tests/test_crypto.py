@@ -0,0 +1,127 @@
+import io
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from django.test import SimpleTestCase
+
+from core import crypto
+
+
+def encrypt_bytes(key, data, segment_size=16):
+    dst = io.BytesIO()
+    crypto.encrypt_stream(key, io.BytesIO(data), dst, segment_size)
+    return dst.getvalue()
+
+
+def decrypt_bytes(key, blob):
+    return b"".join(crypto.iter_decrypt(key, io.BytesIO(blob)))
+
+
+class SegmentedFormatTestCase(SimpleTestCase):
+    def setUp(self):
+        self.key = os.urandom(32)
+
+    def test_round_trip_at_segment_boundaries(self):
+        for size in (0, 1, 15, 16, 17, 32, 100):
+            data = os.urandom(size)
+            blob = encrypt_bytes(self.key, data)
+            self.assertTrue(crypto.is_segmented(blob))
+            self.assertEqual(decrypt_bytes(self.key, blob), data)
+
+    def test_parallel_encryption_round_trip(self):
+        data = os.urandom(1000)
+        with ThreadPoolExecutor(4) as executor:
+            for batch in (1, 3, 8):
+                dst = io.BytesIO()
+                crypto.encrypt_stream(
+                    self.key, io.BytesIO(data), dst, 16, executor=executor, batch=batch
+                )
+                self.assertEqual(
+                    len(dst.getvalue()), len(encrypt_bytes(self.key, data))
+                )
+                self.assertEqual(decrypt_bytes(self.key, dst.getvalue()), data)
+
+    def test_segment_count(self):
+        blob = encrypt_bytes(self.key, b"x" * 32)
+        body = len(blob) - crypto.HEADER_SIZE
+        self.assertEqual(body, 2 * crypto.ciphertext_segment_size(16))
+
+    def test_truncated_blob_is_rejected(self):
+        blob = encrypt_bytes(self.key, b"x" * 40)
+        segment = crypto.ciphertext_segment_size(16)
+        with self.assertRaises(crypto.BlobIntegrityError):
+            decrypt_bytes(self.key, blob[: crypto.HEADER_SIZE + segment])
+
+    def test_tampered_segment_is_rejected(self):
+        blob = bytearray(encrypt_bytes(self.key, b"x" * 40))
+        blob[crypto.HEADER_SIZE + 3] ^= 1
+        with self.assertRaises(crypto.BlobIntegrityError):
+            decrypt_bytes(self.key, bytes(blob))
+
+    def test_wrong_key_fails_commitment(self):
+        blob = encrypt_bytes(self.key, b"secret")
+        with self.assertRaises(crypto.BlobIntegrityError):
+            decrypt_bytes(os.urandom(32), blob)
+
+    def test_range_decrypts_covering_segments(self):
+        data = bytes(range(100))
+        blob = encrypt_bytes(self.key, data)
+        src = io.BytesIO(blob)
+        header = crypto.read_header(src)
+        for start, end in ((0, 0), (15, 16), (20, 99), (95, 200)):
+            chunks = crypto.iter_decrypt_range(
+                self.key, src, header, len(blob), start, end
+            )
+            self.assertEqual(b"".join(chunks), data[start : end + 1])
+
+    def test_content_digest_matches_segment_leaves(self):
+        data = os.urandom(40)
+        streamed = crypto.ContentDigest(b"secret", 16)
+        for start in range(0, len(data), 7):
+            streamed.update(data[start : start + 7])
+
+        combined = crypto.ContentDigest(b"secret", 16)
+        for start in range(0, len(data), 16):
+            segment = data[start : start + 16]
+            combined.add_leaves(crypto.ContentDigest.leaf(segment), len(segment))
+        self.assertEqual(streamed.hexdigest(), combined.hexdigest())
+        self.assertNotEqual(
+            streamed.hexdigest(), crypto.ContentDigest(b"other", 16).hexdigest()
+        )
+
+    def test_compressed_round_trip(self):
+        data = b"a,b,c\n" * 1000
+        dst = io.BytesIO()
+        crypto.encrypt_stream(
+            self.key, io.BytesIO(data), dst, 16, codec=crypto.CODEC_ZLIB
+        )
+        blob = dst.getvalue()
+        header = crypto.read_header(io.BytesIO(blob))
+        self.assertEqual(header.codec, crypto.CODEC_ZLIB)
+        self.assertLess(len(blob), len(data))
+        self.assertEqual(decrypt_bytes(self.key, blob), data)
+
+        raw = b"".join(crypto.iter_decrypt(self.key, io.BytesIO(blob), decode=False))
+        self.assertEqual(zlib.decompress(raw), data)
+
+    def test_incompressible_sample_is_stored(self):
+        self.assertEqual(
+            crypto.choose_codec(os.urandom(4096), crypto.CODEC_ZLIB),
+            crypto.CODEC_NONE,
+        )
+        self.assertEqual(
+            crypto.choose_codec(b"x" * 4096, crypto.CODEC_ZLIB), crypto.CODEC_ZLIB
+        )
+
+    def test_legacy_blob_is_readable(self):
+        data = os.urandom(1000)
+        iv = os.urandom(12)
+        encryptor = Cipher(
+            algorithms.AES(self.key), modes.GCM(iv), backend=default_backend()
+        ).encryptor()
+        blob = iv + encryptor.update(data) + encryptor.finalize() + encryptor.tag
+        self.assertFalse(crypto.is_segmented(blob))
+        self.assertEqual(decrypt_bytes(self.key, blob), data)
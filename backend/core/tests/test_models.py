@@ -1,13 +1,16 @@
 # test_models.py
 import os
 import uuid
+from unittest import mock
 
 from django.test import TestCase
 from django.utils import timezone
 from django.conf import settings
 from django.core.files.uploadedfile import SimpleUploadedFile
 
-from core.models import File, FileShare, User, file_upload_path
+from core import crypto
+from core.models import ContentBlob, File, FileShare, User, file_upload_path
+from core.storage import blob_storage
 
 
 class UserModelTestCase(TestCase):
@@ -68,6 +71,77 @@ class FileModelTestCase(TestCase):
         decrypted_content = self.file.decrypt_file()
         self.assertIsNotNone(decrypted_content)
 
+    def test_file_encryption_round_trip(self):
+        self.file.encrypt_file()
+        with open(self.file.file.path, "rb") as f:
+            self.assertTrue(crypto.is_segmented(f.read(5)))
+        self.assertEqual(self.file.decrypt_file(), b"This is a test file content.")
+
+    def test_create_from_blobs_reports_failed_commits(self):
+        items = []
+        for name, digest in [("a", "d1"), ("b", "d2"), ("c", "d2"), ("d", None)]:
+            writer = blob_storage.writer(File.generate_blob_name(self.user, name))
+            writer.write(name.encode())
+            items.append(
+                {
+                    "pending": writer,
+                    "encrypted_key": b"key",
+                    "key_id": settings.MASTER_KEY_ID,
+                    "content_digest": digest,
+                    "name": name,
+                }
+            )
+        error = OSError("disk full")
+        with mock.patch.object(items[1]["pending"], "commit", side_effect=error):
+            results = File.objects.create_from_blobs(self.user, items, workers=2)
+        self.assertIsInstance(results[0], File)
+        # The copy of a failed blob fails with it
+        self.assertIs(results[1], error)
+        self.assertIs(results[2], error)
+        with blob_storage.open(results[3].file.name) as f:
+            self.assertEqual(f.read(), b"d")
+        self.assertEqual(File.objects.filter(owner=self.user).count(), 3)
+
+    def test_create_from_blobs_replaces_released_blob(self):
+        ContentBlob.objects.create(
+            owner=self.user,
+            digest="d1",
+            storage_name="released",
+            encrypted_key=b"key",
+            ref_count=1,
+        )
+        items = []
+        for name in ["a", "b"]:
+            writer = blob_storage.writer(File.generate_blob_name(self.user, name))
+            writer.write(name.encode())
+            items.append(
+                {
+                    "pending": writer,
+                    "encrypted_key": b"key",
+                    "key_id": settings.MASTER_KEY_ID,
+                    "content_digest": "d1",
+                    "name": name,
+                }
+            )
+
+        # The last File referencing it is deleted after the lookup
+        insert = File.objects._insert_blob_files
+
+        def released_first(*args):
+            ContentBlob.objects.filter(owner=self.user, digest="d1").delete()
+            return insert(*args)
+
+        with mock.patch.object(File.objects, "_insert_blob_files", released_first):
+            results = File.objects.create_from_blobs(self.user, items)
+        blob = ContentBlob.objects.get(owner=self.user, digest="d1")
+        self.assertEqual(blob.storage_name, items[0]["pending"].name)
+        self.assertEqual(blob.ref_count, 2)
+        self.assertEqual([file.file.name for file in results], [blob.storage_name] * 2)
+        with blob_storage.open(blob.storage_name) as f:
+            self.assertEqual(f.read(), b"a")
+        self.assertFalse(blob_storage.exists(items[1]["pending"].name))
+        self.assertFalse(os.path.exists(items[1]["pending"].part_path))
+
 
 class FileShareModelTestCase(TestCase):
     def setUp(self):
@@ -0,0 +1,34 @@
+from django.test import SimpleTestCase
+
+from core.sniffing import sniff_content_type
+
+
+class SniffContentTypeTestCase(SimpleTestCase):
+    def test_magic_bytes_win_over_name(self):
+        self.assertEqual(
+            sniff_content_type(b"%PDF-1.4\n", "notes.txt"), "application/pdf"
+        )
+        self.assertEqual(sniff_content_type(b"\xff\xd8\xff\xe0", "photo"), "image/jpeg")
+        self.assertEqual(
+            sniff_content_type(b"\x00\x00\x00\x18ftypmp42", "clip.bin"), "video/mp4"
+        )
+
+    def test_containers_use_name(self):
+        self.assertEqual(
+            sniff_content_type(b"PK\x03\x04rest", "report.docx"),
+            "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+        )
+        self.assertEqual(sniff_content_type(b"PK\x03\x04rest"), "application/zip")
+
+    def test_text(self):
+        self.assertEqual(sniff_content_type(b"a,b\n1,2\n", "data.csv"), "text/csv")
+        self.assertEqual(sniff_content_type("héllo".encode(), "x.pdf"), "text/plain")
+        # A character cut off at the end of the sample is still text
+        self.assertEqual(sniff_content_type(b"ok \xc3", ""), "text/plain")
+        self.assertEqual(sniff_content_type(b"\xc3ok"), "application/octet-stream")
+
+    def test_binary(self):
+        self.assertEqual(
+            sniff_content_type(b"\x00\x01\x02", "blob"), "application/octet-stream"
+        )
+        self.assertEqual(sniff_content_type(b"", "empty.txt"), "text/plain")
@@ -0,0 +1,201 @@
+import os
+from unittest import mock
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from core.fake_s3 import MIN_PART_SIZE, ClientError, FakeS3Client
+from core.models import File, User
+from core.storage import S3BlobStorage, blob_storage
+
+
+def s3_storages(client):
+    return {
+        **settings.STORAGES,
+        "blobs": {
+            "BACKEND": "core.storage.S3BlobStorage",
+            "OPTIONS": {"bucket": "blobs", "client": client},
+        },
+    }
+
+
+class S3BlobStorageTestCase(SimpleTestCase):
+    def setUp(self):
+        self.client = FakeS3Client()
+        self.storage = S3BlobStorage(bucket="blobs", client=self.client, part_size=10)
+
+    def operations(self):
+        return [operation for operation, _ in self.client.requests]
+
+    def test_small_blob_is_put_on_commit(self):
+        writer = self.storage.writer("a/blob")
+        writer.write(b"hello")
+        self.assertFalse(self.storage.exists("a/blob"))
+        writer.commit()
+        self.assertEqual(self.operations()[-1], "PutObject")
+        with self.storage.open("a/blob") as f:
+            self.assertEqual(f.read(), b"hello")
+
+    def test_large_blob_uses_multipart_upload(self):
+        data = os.urandom(35)
+        writer = self.storage.writer("big")
+        writer.write(data[:17])
+        writer.write(data[17:])
+        self.assertFalse(self.storage.exists("big"))
+        writer.commit()
+        self.assertEqual(self.operations().count("UploadPart"), 4)
+        self.assertEqual(self.storage.size("big"), 35)
+        with self.storage.open("big") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_close_uploads_the_rest_as_last_part(self):
+        data = os.urandom(25)
+        writer = self.storage.writer("big")
+        writer.write(data)
+        writer.close()
+        self.assertEqual(self.operations().count("UploadPart"), 3)
+        self.assertFalse(self.storage.exists("big"))
+        writer.commit()
+        writer.abort()
+        with self.storage.open("big") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_abort_leaves_nothing(self):
+        writer = self.storage.writer("gone")
+        writer.write(os.urandom(25))
+        writer.abort()
+        self.assertFalse(self.storage.exists("gone"))
+        self.assertEqual(self.client.uploads, {})
+
+    def test_seek_issues_ranged_get(self):
+        self.client.put_object(Bucket="blobs", Key="r", Body=bytes(range(100)))
+        with self.storage.open("r") as f:
+            self.assertEqual(f.read(4), bytes(range(4)))
+            f.seek(50)
+            self.assertEqual(f.read(3), bytes([50, 51, 52]))
+            self.assertEqual(f.read(2), bytes([53, 54]))
+            f.seek(200)
+            self.assertEqual(f.read(), b"")
+        ranges = [
+            kwargs["Range"] for op, kwargs in self.client.requests if op == "GetObject"
+        ]
+        self.assertEqual(ranges, [None, "bytes=50-", "bytes=200-"])
+
+    def test_link_copies_object(self):
+        self.client.put_object(Bucket="blobs", Key="old", Body=b"data")
+        self.storage.link("old", "new")
+        with self.storage.open("new") as f:
+            self.assertEqual(f.read(), b"data")
+        with self.assertRaises(FileNotFoundError):
+            self.storage.link("missing", "other")
+
+    def test_link_streams_objects_too_large_to_copy(self):
+        data = os.urandom(35)
+        self.client.put_object(Bucket="blobs", Key="large", Body=data)
+        self.storage.max_copy_size = 20
+        with mock.patch("core.storage.COPY_CHUNK_SIZE", 8):
+            self.storage.link("large", "moved")
+        self.assertNotIn("CopyObject", self.operations())
+        self.assertEqual(self.operations().count("UploadPart"), 4)
+        with self.storage.open("moved") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_scan_lists_objects_under_prefix(self):
+        storage = S3BlobStorage(bucket="blobs", prefix="site", client=self.client)
+        for i in range(3):
+            storage.save(f"blobs/aa/{i}", ContentFile(b"x" * i))
+        storage.save("blobs/ab/0", ContentFile(b"y"))
+        with mock.patch.object(
+            self.client,
+            "list_objects_v2",
+            wraps=lambda **kwargs: FakeS3Client.list_objects_v2(
+                self.client, MaxKeys=2, **kwargs
+            ),
+        ):
+            listed = list(storage.scan("blobs/aa/"))
+        self.assertEqual(
+            [(name, size) for name, size, _ in listed],
+            [("blobs/aa/0", 0), ("blobs/aa/1", 1), ("blobs/aa/2", 2)],
+        )
+        self.assertEqual(self.operations().count("ListObjectsV2"), 2)
+
+    def test_missing_blob(self):
+        self.assertFalse(self.storage.exists("missing"))
+        with self.assertRaises(FileNotFoundError):
+            self.storage.open("missing")
+
+    def test_multipart_parts_in_any_order(self):
+        blob = self.storage.multipart("parts")
+        resumed = self.storage.multipart("parts", blob.upload_id)
+        resumed.parts.append((2, resumed.upload_part(2, None, [b"world"])))
+        resumed.parts.append((1, resumed.upload_part(1, None, [b"hello ", b""])))
+        resumed.commit()
+        with self.storage.open("parts") as f:
+            self.assertEqual(f.read(), b"hello world")
+
+    def test_fake_enforces_minimum_part_size(self):
+        storage = S3BlobStorage(
+            bucket="blobs", client=FakeS3Client(min_part_size=MIN_PART_SIZE)
+        )
+        blob = storage.multipart("small")
+        blob.parts = [
+            (1, blob.upload_part(1, None, [b"x"])),
+            (2, blob.upload_part(2, None, [b"y"])),
+        ]
+        with self.assertRaises(ClientError):
+            blob.commit()
+
+
+class S3FileModelTestCase(TestCase):
+    def setUp(self):
+        self.client = FakeS3Client()
+        self.settings = override_settings(STORAGES=s3_storages(self.client))
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+        self.user = User.objects.create_user(
+            email="testuser@example.com", password="testpassword"
+        )
+
+    def test_file_encryption_round_trip(self):
+        self.assertIsInstance(blob_storage, S3BlobStorage)
+        file = File.objects.create(
+            name="test_file.txt",
+            owner=self.user,
+            file=SimpleUploadedFile("test_file.txt", b"This is a test file content."),
+        )
+        file.encrypt_file()
+        blob, _ = self.client.objects[("blobs", file.file.name)]
+        self.assertNotIn(b"This is a test file content.", blob)
+        self.assertEqual(file.decrypt_file(), b"This is a test file content.")
+        self.assertEqual(b"".join(file.iter_decrypt(5, 8)), b"is a")
+
+    def test_range_reads_start_at_covering_segment(self):
+        content = os.urandom(200)
+        with override_settings(FILE_ENCRYPTION_SEGMENT_SIZE=16):
+            file = File.objects.create(
+                name="data.bin",
+                owner=self.user,
+                file=SimpleUploadedFile("data.bin", content),
+            )
+            file.encrypt_file()
+        self.client.requests.clear()
+        self.assertEqual(b"".join(file.iter_decrypt(100, 120)), content[100:121])
+        ranges = [
+            kwargs["Range"]
+            for op, kwargs in self.client.requests
+            if op == "GetObject" and kwargs["Range"]
+        ]
+        self.assertEqual(len(ranges), 1)
+
+    def test_blob_is_deleted_with_file(self):
+        file = File.objects.create(
+            name="test_file.txt",
+            owner=self.user,
+            file=SimpleUploadedFile("test_file.txt", b"x"),
+        )
+        name = file.file.name
+        with self.captureOnCommitCallbacks(execute=True):
+            file.delete()
+        self.assertNotIn(("blobs", name), self.client.objects)
@@ -1,15 +1,213 @@
+import base64
+import binascii
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from rest_framework import serializers
 
-from core.models import File
+from core.models import File, UploadSession
+from core.storage import blob_storage
+
+from .upload_handlers import EncryptedUploadedFile
 
 
 class FileSerializer(serializers.ModelSerializer):
     class Meta:
         model = File
-        fields = ["id", "owner", "name", "file", "description", "uploaded_at"]
-        read_only_fields = ["id", "owner", "uploaded_at"]
+        fields = [
+            "id",
+            "owner",
+            "name",
+            "file",
+            "description",
+            "uploaded_at",
+            "client_encrypted",
+            "size",
+            "content_type",
+            "sha256",
+        ]
+        read_only_fields = [
+            "id",
+            "owner",
+            "uploaded_at",
+            "client_encrypted",
+            "size",
+            "content_type",
+            "sha256",
+        ]
 
     def create(self, validated_data):
-        # You can add encryption logic here
         validated_data["owner"] = self.context["request"].user
-        return File.objects.create(**validated_data)
+        upload = validated_data.pop("file")
+        # Blob names no longer carry the original file name
+        if not validated_data.get("name"):
+            validated_data["name"] = upload.name
+        if not isinstance(upload, EncryptedUploadedFile):
+            # Anything else would be stored as received, in plaintext
+            raise ImproperlyConfigured(
+                "Uploads must be received by an EncryptingUploadHandler or "
+                "a BlobUploadHandler"
+            )
+        # Already encrypted while it was received; commit or deduplicate
+        return File.objects.create_from_blob(
+            pending=upload.blob,
+            encrypted_key=upload.encrypted_key,
+            key_id=upload.key_id,
+            content_digest=upload.content_digest,
+            **upload.metadata,
+            **validated_data,
+        )
+
+
+class ClientEncryptedFileSerializer(FileSerializer):
+    """
+    Accepts a blob encrypted by the client together with its data key,
+    wrapped by the client and base64 encoded. Neither is ever decrypted by
+    the server; the wrapped key is returned with every download.
+    """
+
+    wrapped_key = serializers.CharField(write_only=True, max_length=4096)
+
+    class Meta(FileSerializer.Meta):
+        fields = FileSerializer.Meta.fields + ["wrapped_key"]
+
+    def validate_wrapped_key(self, value):
+        try:
+            return base64.b64decode(value, validate=True)
+        except binascii.Error:
+            raise serializers.ValidationError("Wrapped key must be base64 encoded.")
+
+    def create(self, validated_data):
+        upload = validated_data.pop("file")
+        if not validated_data.get("name"):
+            validated_data["name"] = upload.name
+        return File.objects.create_from_blob(
+            owner=self.context["request"].user,
+            pending=upload.blob,
+            encrypted_key=validated_data.pop("wrapped_key"),
+            key_id="",
+            content_digest=None,
+            client_encrypted=True,
+            **upload.metadata,
+            **validated_data,
+        )
+
+
+class FileListQuerySerializer(serializers.Serializer):
+    """
+    Sorting and filters of the file listing, all answered from File rows.
+    A ``content_type`` ending in "/" matches every subtype.
+    """
+
+    ORDERING_FIELDS = ["name", "uploaded_at", "size"]
+
+    ordering = serializers.ChoiceField(
+        choices=ORDERING_FIELDS + [f"-{field}" for field in ORDERING_FIELDS],
+        required=False,
+    )
+    content_type = serializers.CharField(required=False, max_length=255)
+    min_size = serializers.IntegerField(required=False, min_value=0)
+    max_size = serializers.IntegerField(required=False, min_value=0)
+
+    def filter(self, files):
+        data = self.validated_data
+        content_type = data.get("content_type")
+        if content_type and content_type.endswith("/"):
+            files = files.filter(content_type__startswith=content_type)
+        elif content_type:
+            files = files.filter(content_type=content_type)
+        if "min_size" in data:
+            files = files.filter(size__gte=data["min_size"])
+        if "max_size" in data:
+            files = files.filter(size__lte=data["max_size"])
+        if "ordering" in data:
+            files = files.order_by(data["ordering"], "pk")
+        return files
+
+
+class BulkDownloadSerializer(serializers.Serializer):
+    files = serializers.ListField(child=serializers.UUIDField(), allow_empty=False)
+
+    def validate_files(self, value):
+        limit = settings.FILE_ZIP_MAX_FILES
+        if len(value) > limit:
+            raise serializers.ValidationError(
+                f"At most {limit} files can be downloaded at once."
+            )
+        # Keep the requested order, without repeats
+        return list(dict.fromkeys(value))
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    part_size = serializers.IntegerField(required=False)
+    part_count = serializers.IntegerField(read_only=True)
+    parts = serializers.SerializerMethodField()
+    received_bytes = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadSession
+        fields = [
+            "id",
+            "name",
+            "description",
+            "size",
+            "part_size",
+            "part_count",
+            "parts",
+            "received_bytes",
+            "file",
+            "created_at",
+            "expires_at",
+        ]
+        read_only_fields = ["id", "file", "created_at", "expires_at"]
+
+    def get_parts(self, session):
+        return [
+            {"number": part.number, "size": part.size}
+            for part in session.parts.all()
+            if part.completed
+        ]
+
+    def get_received_bytes(self, session):
+        return sum(part["size"] for part in self.get_parts(session))
+
+    def validate_size(self, value):
+        if value < 0:
+            raise serializers.ValidationError("Size must not be negative.")
+        return value
+
+    def validate_part_size(self, value):
+        segment_size = settings.FILE_ENCRYPTION_SEGMENT_SIZE
+        if value <= 0 or value % segment_size:
+            raise serializers.ValidationError(
+                f"Part size must be a positive multiple of {segment_size} bytes."
+            )
+        if value > settings.FILE_UPLOAD_MAX_PART_SIZE:
+            raise serializers.ValidationError(
+                f"Part size must not exceed {settings.FILE_UPLOAD_MAX_PART_SIZE} bytes."
+            )
+        return value
+
+    def validate(self, attrs):
+        # Object stores reject multipart parts below a minimum size, except
+        # for the last one
+        part_size = attrs.get("part_size", settings.FILE_UPLOAD_PART_SIZE)
+        min_part_size = blob_storage.min_part_size
+        if part_size < min_part_size and attrs["size"] > part_size:
+            raise serializers.ValidationError(
+                {
+                    "part_size": f"Part size must be at least {min_part_size} "
+                    "bytes unless the upload fits in one part."
+                }
+            )
+        return attrs
+
+    def create(self, validated_data):
+        return UploadSession.start(
+            owner=self.context["request"].user,
+            name=validated_data["name"],
+            size=validated_data["size"],
+            part_size=validated_data.get("part_size", settings.FILE_UPLOAD_PART_SIZE),
+            description=validated_data.get("description"),
+            idempotency_key=self.context.get("idempotency_key"),
+        )
@@ -0,0 +1,415 @@
+import base64
+import os
+import re
+import secrets
+import zipfile
+from mimetypes import guess_type
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils import timezone
+from django.utils.http import http_date, parse_http_date_safe
+
+from core import crypto
+
+# Requests asking for more ranges than this are served in full
+MAX_RANGES = 16
+
+RANGE_SPEC_RE = re.compile(r"^\s*(\d*)\s*-\s*(\d*)\s*$")
+
+# Browsers may keep file content but must revalidate it on every use, since
+# access through a share can be revoked or expire at any time
+FILE_CACHE_CONTROL = "private, no-cache"
+
+
+def parse_range_header(header, size):
+    """
+    Parses a ``Range`` header against a representation of ``size`` bytes.
+
+    Returns a sorted list of merged inclusive ``(start, end)`` pairs, an
+    empty list when no range is satisfiable, or None when the header should
+    be ignored (malformed, not in bytes, or too many ranges).
+    """
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs:
+        return None
+    specs = specs.split(",")
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        match = RANGE_SPEC_RE.match(spec)
+        if not match or match.groups() == ("", ""):
+            return None
+        first, last = match.groups()
+        if first == "":
+            # Suffix range: the final N bytes
+            length = int(last)
+            if length == 0:
+                continue
+            start, end = max(size - length, 0), size - 1
+        else:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            end = min(int(last), size - 1) if last else size - 1
+        if start < size:
+            ranges.append((start, end))
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def if_range_matches(request, last_modified, etag=None):
+    """
+    Evaluates ``If-Range``: the range applies only if the validator still
+    identifies the current representation (strong comparison).
+    """
+    value = request.headers.get("If-Range")
+    if value is None:
+        return True
+    value = value.strip()
+    if value.startswith('"') or value.startswith("W/"):
+        return etag is not None and value == etag
+    return parse_http_date_safe(value) == int(last_modified)
+
+
+def accepts_encoding(request, encoding):
+    """
+    Returns True if ``Accept-Encoding`` allows the given content-coding.
+    """
+    for item in request.headers.get("Accept-Encoding", "").split(","):
+        token, _, params = item.partition(";")
+        if token.strip().lower() not in (encoding, "*"):
+            continue
+        _, _, q = params.partition("q=")
+        try:
+            return float(q) > 0 if q.strip() else True
+        except ValueError:
+            return False
+    return False
+
+
+def file_etag(file):
+    """
+    Returns the strong ETag of the decoded content of ``file``, derived from
+    the content digest recorded at upload, or None for files without one
+    (client-encrypted files and files stored before digests were kept).
+    """
+    if not file.content_digest:
+        return None
+    return f'"{file.content_digest}"'
+
+
+def _not_modified(request, etag, last_modified):
+    """
+    Evaluates the conditional request headers against the validators stored
+    on the File row alone, returning a 304 (or 412) response if they match
+    so that no key is unwrapped and no blob is read. Returns None otherwise.
+    """
+    response = get_conditional_response(
+        request, etag=etag, last_modified=int(last_modified)
+    )
+    if response is not None:
+        _cache_headers(response, etag, last_modified)
+    return response
+
+
+def _cache_headers(response, etag, last_modified):
+    if etag is not None:
+        response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    response["Cache-Control"] = FILE_CACHE_CONTROL
+
+
+def _encoded_etag(request, etag, codec):
+    """
+    Returns the weak form of ``etag`` if the content is sent compressed
+    with ``codec``, ``etag`` otherwise.
+    """
+    if etag is None or not codec:
+        return etag
+    if not accepts_encoding(request, crypto.CONTENT_ENCODINGS[codec]):
+        return etag
+    return f"W/{etag}"
+
+
+def _stream_layout(file):
+    """
+    Returns the codec of the blob, the length of the stream it decrypts to
+    (still compressed, for a compressed blob) and whether byte ranges can be
+    served. Taken from the row when recorded at upload; older files need
+    their blob header read.
+    """
+    if file.segment_count is not None:
+        tags = file.segment_count * crypto.TAG_SIZE
+        return file.codec, file.blob_size - crypto.HEADER_SIZE - tags, not file.codec
+    header = file.blob_header()
+    codec = header.codec if header is not None else crypto.CODEC_NONE
+    return codec, file.plaintext_size(header), header is not None and not codec
+
+
+def _multipart_ranges(file, ranges, size, content_type, boundary):
+    for start, end in ranges:
+        yield (
+            f"\r\n--{boundary}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+        ).encode()
+        yield from file.iter_decrypt(start, end)
+    yield f"\r\n--{boundary}--\r\n".encode()
+
+
+def _multipart_length(ranges, size, content_type, boundary):
+    length = len(f"\r\n--{boundary}--\r\n")
+    for start, end in ranges:
+        length += len(
+            f"\r\n--{boundary}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+        )
+        length += end - start + 1
+    return length
+
+
+def opaque_file_response(request, file, disposition="attachment"):
+    """
+    Delivers a client-encrypted blob as stored, without reading it in
+    Python: through ``X-Accel-Redirect`` when FILE_ACCEL_REDIRECT_LOCATION
+    names the internal nginx location serving the blob storage, and as a
+    ``FileResponse`` (which the WSGI server sends with ``sendfile``)
+    otherwise. The client-wrapped data key travels in ``X-Wrapped-Key``.
+    """
+    last_modified = file.uploaded_at.timestamp()
+    response = _not_modified(request, None, last_modified)
+    if response is not None:
+        return response
+
+    location = settings.FILE_ACCEL_REDIRECT_LOCATION
+    content_type = "application/octet-stream"
+    if location:
+        response = HttpResponse(content_type=content_type)
+        response["X-Accel-Redirect"] = f"{location.rstrip('/')}/{quote(file.file.name)}"
+    else:
+        response = FileResponse(
+            file.file.storage.open(file.file.name, "rb"), content_type=content_type
+        )
+        response["Accept-Ranges"] = "none"
+
+    response["X-Wrapped-Key"] = base64.b64encode(bytes(file.encrypted_key)).decode()
+    _cache_headers(response, None, last_modified)
+    response["Content-Disposition"] = f'{disposition}; filename="{file.name}"'
+    return response
+
+
+def encrypted_file_response(request, file, disposition="attachment"):
+    """
+    Streams the decrypted content of ``file`` segment by segment.
+
+    Honors ``Range``/``If-Range`` on uncompressed segmented blobs by
+    answering with ``206 Partial Content`` and decrypting only the segments
+    that cover the requested bytes. Compressed blobs are sent still
+    compressed, with ``Content-Encoding``, when the client accepts their
+    codec and are decompressed on the fly otherwise. The key is unwrapped
+    and the blob opened before the response is built, so missing blobs and
+    bad keys still fail before any header is sent.
+
+    ``If-None-Match`` and ``If-Modified-Since`` are checked first, against
+    the ETag and upload time on the row, and a match is answered with 304
+    without touching the key or the blob. Content sent still compressed is
+    a different byte sequence, so it only carries the weak form of the
+    ETag; the 304 carries the same ETag and ``Vary`` as the 200 it stands
+    for, except for files whose layout predates being recorded on the row,
+    which are answered with the strong ETag (If-None-Match compares them
+    weakly).
+
+    Client-encrypted files are handed off by ``opaque_file_response``.
+    """
+    if file.client_encrypted:
+        return opaque_file_response(request, file, disposition)
+
+    etag = file_etag(file)
+    last_modified = file.uploaded_at.timestamp()
+    # The codec of older files is in their blob header, left unread here
+    codec = file.codec if file.segment_count is not None else None
+    response = _not_modified(
+        request, _encoded_etag(request, etag, codec), last_modified
+    )
+    if response is not None:
+        if codec:
+            patch_vary_headers(response, ("Accept-Encoding",))
+        return response
+
+    codec, size, seekable = _stream_layout(file)
+    encoded = codec and accepts_encoding(request, crypto.CONTENT_ENCODINGS[codec])
+    etag = _encoded_etag(request, etag, codec)
+
+    content_type = (
+        file.content_type
+        or guess_type(file.name or file.file.name)[0]
+        or "application/octet-stream"
+    )
+
+    ranges = None
+    range_header = request.headers.get("Range")
+    if seekable and range_header and if_range_matches(request, last_modified, etag):
+        ranges = parse_range_header(range_header, size)
+
+    if codec:
+        if encoded:
+            response = StreamingHttpResponse(
+                file.iter_decrypt(decode=False), content_type=content_type
+            )
+            response["Content-Encoding"] = crypto.CONTENT_ENCODINGS[codec]
+            response["Content-Length"] = size
+        else:
+            response = StreamingHttpResponse(
+                file.iter_decrypt(), content_type=content_type
+            )
+            # Decompressed on the fly: the plaintext length recorded at
+            # upload, unknown for files stored before
+            if file.size is not None:
+                response["Content-Length"] = file.size
+        patch_vary_headers(response, ("Accept-Encoding",))
+    elif ranges == []:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{size}"
+    elif ranges and len(ranges) == 1:
+        start, end = ranges[0]
+        response = StreamingHttpResponse(
+            file.iter_decrypt(start, end), status=206, content_type=content_type
+        )
+        response["Content-Length"] = end - start + 1
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    elif ranges:
+        boundary = secrets.token_hex(16)
+        response = StreamingHttpResponse(
+            _multipart_ranges(file, ranges, size, content_type, boundary),
+            status=206,
+            content_type=f"multipart/byteranges; boundary={boundary}",
+        )
+        response["Content-Length"] = _multipart_length(
+            ranges, size, content_type, boundary
+        )
+    else:
+        response = StreamingHttpResponse(file.iter_decrypt(), content_type=content_type)
+        response["Content-Length"] = size
+
+    response["Accept-Ranges"] = "bytes" if seekable else "none"
+    _cache_headers(response, etag, last_modified)
+    response["Content-Disposition"] = f'{disposition}; filename="{file.name}"'
+    return response
+
+
+class _ZipSink:
+    """
+    Write-only, non-seekable target for ``zipfile``: collects what the
+    archive writes until it is drained into the response.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def archive_names(files):
+    """
+    Returns a member name for each file: its name (or the uploaded file
+    name) without path separators, numbered when it clashes with an earlier
+    one.
+    """
+    names, seen = [], set()
+    for file in files:
+        name = file.name or os.path.basename(file.file.name)
+        name = name.replace("/", "_").replace("\\", "_").strip() or str(file.pk)
+        stem, dot, ext = name.rpartition(".")
+        if not dot:
+            stem, ext = name, ""
+        candidate, n = name, 1
+        while candidate.lower() in seen:
+            candidate = f"{stem} ({n}){dot}{ext}"
+            n += 1
+        seen.add(candidate.lower())
+        names.append(candidate)
+    return names
+
+
+def _iter_zip(files):
+    sink = _ZipSink()
+    # Without tell() zipfile writes data descriptors after each member, so
+    # sizes and CRCs never have to be known up front
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for file, name in zip(files, archive_names(files)):
+            info = zipfile.ZipInfo(
+                name, timezone.localtime(file.uploaded_at).timetuple()[:6]
+            )
+            with archive.open(info, "w", force_zip64=True) as member:
+                for chunk in file.iter_decrypt():
+                    member.write(chunk)
+                    yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+
+def zip_archive_response(files, filename="files.zip"):
+    """
+    Streams ``files`` as a ZIP64 archive, decrypting one segment at a time
+    so memory use does not grow with the archive and the first bytes go out
+    as soon as the first segment is decrypted. Members are stored rather
+    than deflated, so no CPU is spent recompressing them.
+    """
+    response = StreamingHttpResponse(
+        (chunk for chunk in _iter_zip(files) if chunk),
+        content_type="application/zip",
+    )
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    response["Cache-Control"] = "private, no-store"
+    return response
+
+
+PREVIEW_KINDS = ("thumbnail", "page", "text")
+
+
+def preview_response(request, file, kind=None):
+    """
+    Serves the stored preview of ``file`` of the given kind (by default the
+    best one available), or returns None if there is none. Previews are
+    immutable per digest, so conditional requests are answered with 304
+    before anything is decrypted.
+    """
+    previews = {preview.kind: preview for preview in file.previews.defer("data")}
+    kinds = [kind] if kind else PREVIEW_KINDS
+    preview = next((previews[k] for k in kinds if k in previews), None)
+    if preview is None:
+        return None
+
+    etag = f'"{preview.digest}"'
+    last_modified = int(preview.created_at.timestamp())
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = HttpResponse(preview.decrypt(), content_type=preview.content_type)
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    response["Cache-Control"] = (
+        f"private, max-age={settings.FILE_PREVIEW_CACHE_SECONDS}"
+    )
+    return response
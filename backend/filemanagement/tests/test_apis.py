@@ -1,14 +1,43 @@
+import base64
+import hashlib
+import io
 import json
+import os
 import uuid
+import zipfile
+import zlib
+from unittest import mock
 
 import pyotp
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import DatabaseError
+from django.db.models import QuerySet
+from django.http import UnreadablePostError
+from django.test import override_settings
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date
 from rest_framework import status
 from rest_framework.test import APIClient, APITestCase
 
-from core.models import File, FileShare, User
+from core import crypto
+from core.fake_s3 import MIN_PART_SIZE, FakeS3Client
+from core.models import (
+    BLOB_PREFIX,
+    ContentBlob,
+    File,
+    FileShare,
+    StorageUsage,
+    UploadPart,
+    UploadSession,
+    User,
+)
+from core.storage import blob_storage
 from core.utils import send_email
+from filemanagement.serializers import FileSerializer
+from filemanagement.upload_handlers import EncryptingUploadHandler
 
 
 class FileManagementTests(APITestCase):
@@ -363,3 +392,891 @@ class FileManagementTests(APITestCase):
             )
         )
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_file_download_streams_plaintext(self):
+        """Test downloading a file streams the decrypted content."""
+        self.client.cookies['access'] = self.tokens_user1['access']
+        response = self.client.get(
+            reverse("file-download", args=[self.uploaded_file1["id"]])
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Length"], str(len(b"Test file content")))
+        self.assertEqual(b"".join(response.streaming_content), b"Test file content")
+
+    def test_file_view_streams_inline(self):
+        """Test viewing a file streams it inline."""
+        self.client.cookies['access'] = self.tokens_user1['access']
+        response = self.client.get(
+            reverse("file_view", args=[self.uploaded_file1["id"]])
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response["Content-Disposition"].startswith("inline"))
+        self.assertEqual(b"".join(response.streaming_content), b"Test file content")
+
+    @override_settings(FILE_ENCRYPTION_SEGMENT_SIZE=16)
+    def test_file_view_range_request(self):
+        """Test a Range request returns only the requested bytes."""
+        self.client.cookies['access'] = self.tokens_user1['access']
+        content = bytes(range(100))
+        file = File.objects.create(
+            owner=self.user1,
+            file=SimpleUploadedFile("video.mp4", content),
+            name="video.mp4",
+        )
+        file.encrypt_file()
+        response = self.client.get(
+            reverse("file_view", args=[file.id]), HTTP_RANGE="bytes=20-40"
+        )
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(response["Content-Range"], "bytes 20-40/100")
+        self.assertEqual(response["Content-Length"], "21")
+        self.assertEqual(b"".join(response.streaming_content), content[20:41])
+
+        response = self.client.get(
+            reverse("file_view", args=[file.id]), HTTP_RANGE="bytes=0-1,-2"
+        )
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertTrue(response["Content-Type"].startswith("multipart/byteranges"))
+        body = b"".join(response.streaming_content)
+        self.assertEqual(int(response["Content-Length"]), len(body))
+        self.assertIn(b"Content-Range: bytes 98-99/100\r\n\r\n" + content[98:], body)
+
+        response = self.client.get(
+            reverse("file_view", args=[file.id]), HTTP_RANGE="bytes=200-"
+        )
+        self.assertEqual(
+            response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+        )
+
+    def test_file_download_stale_if_range(self):
+        """Test a Range with a stale If-Range validator returns the full file."""
+        self.client.cookies['access'] = self.tokens_user1['access']
+        response = self.client.get(
+            reverse("file-download", args=[self.uploaded_file1["id"]]),
+            HTTP_RANGE="bytes=0-3",
+            HTTP_IF_RANGE=http_date(0),
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b"".join(response.streaming_content), b"Test file content")
+
+    def test_conditional_get_skips_decryption(self):
+        """Test matching validators get a 304 without reading the blob."""
+        self.client.cookies['access'] = self.tokens_user1['access']
+        file = File.objects.get(id=self.uploaded_file1["id"])
+        url = reverse("file-download", args=[file.id])
+        response = self.client.get(url)
+        etag = response["ETag"]
+        self.assertEqual(etag, f'"{file.content_digest}"')
+        self.assertEqual(response["Cache-Control"], "private, no-cache")
+
+        with mock.patch("core.models.decrypt_key") as decrypt_key, mock.patch.object(
+            File, "blob_header"
+        ) as blob_header:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(response["ETag"], etag)
+            response = self.client.get(
+                reverse("file_view", args=[file.id]),
+                HTTP_IF_MODIFIED_SINCE=response["Last-Modified"],
+            )
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            share = FileShare.objects.create(
+                file=file,
+                shared_by=self.user1,
+                shared_with=self.user2.email,
+                share_type="download",
+            )
+            self.client.cookies['access'] = self.tokens_user2['access']
+            response = self.client.get(
+                reverse(
+                    "access_shared_file_for_authenticated_users",
+                    args=[share.shared_link],
+                ),
+                HTTP_IF_NONE_MATCH=f'W/{etag}',
+            )
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        decrypt_key.assert_not_called()
+        blob_header.assert_not_called()
+
+        shared_url = reverse(
+            "access_shared_file_for_authenticated_users", args=[share.shared_link]
+        )
+        response = self.client.get(shared_url, HTTP_IF_NONE_MATCH='"stale"')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b"".join(response.streaming_content), b"Test file content")
+
+        # Nor for a file whose layout predates being recorded on the row
+        File.objects.filter(pk=file.pk).update(segment_count=None)
+        with mock.patch.object(File, "blob_header") as blob_header:
+            response = self.client.get(shared_url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(response["ETag"], etag)
+        blob_header.assert_not_called()
+
+        # Access checks still come first
+        self.client.cookies['access'] = self.tokens_user2['access']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_if_range_with_etag(self):
+        """Test If-Range accepts the current ETag."""
+        self.client.cookies['access'] = self.tokens_user1['access']
+        url = reverse("file-download", args=[self.uploaded_file1["id"]])
+        etag = self.client.get(url)["ETag"]
+        response = self.client.get(url, HTTP_RANGE="bytes=0-3", HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b"".join(response.streaming_content), b"Test")
+
+    @override_settings(FILE_ENCRYPTION_SEGMENT_SIZE=16)
+    def test_upload_records_metadata(self):
+        """Test uploads record sizes, checksum and sniffed type on the row."""
+        content = b"\x89PNG\r\n\x1a\n" + os.urandom(100)
+        self.client.cookies['access'] = self.tokens_user1['access']
+        response = self.client.post(
+            reverse("file-upload"),
+            {"file": SimpleUploadedFile("picture.dat", content)},
+            format="multipart",
+        )
+        self.assertEqual(response.data["size"], len(content))
+        self.assertEqual(response.data["content_type"], "image/png")
+        self.assertEqual(response.data["sha256"], hashlib.sha256(content).hexdigest())
+        file = File.objects.get(id=response.data["id"])
+        self.assertEqual(file.blob_size, os.path.getsize(file.file.path))
+        self.assertEqual(file.segment_count, 7)
+        self.assertEqual(file.codec, crypto.CODEC_NONE)
+
+        # Served from the row: the blob is only opened to stream it
+        with mock.patch.object(File, "blob_header") as blob_header:
+            response = self.client.get(
+                reverse("file-download", args=[file.id]), HTTP_RANGE="bytes=10-19"
+            )
+            self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+            self.assertEqual(response["Content-Range"], f"bytes 10-19/{len(content)}")
+            self.assertEqual(b"".join(response.streaming_content), content[10:20])
+            response = self.client.get(reverse("file_view", args=[file.id]))
+            self.assertEqual(response["Content-Type"], "image/png")
+            self.assertEqual(response["Content-Length"], str(len(content)))
+        blob_header.assert_not_called()
+
+    def test_list_files_sorted_and_filtered(self):
+        """Test the file listing sorts and filters on recorded metadata."""
+        self.client.cookies['access'] = self.tokens_user1['access']
+        for name, content in [
+            ("big.txt", b"x" * 300),
+            ("small.pdf", b"%PDF-1.7 tiny"),
+            ("medium.csv", b"a,b\n" * 20),
+        ]:
+            self.client.post(
+                reverse("file-upload"),
+                {"file": SimpleUploadedFile(name, content)},
+                format="multipart",
+            )
+        url = reverse("user-files")
+
+        response = self.client.get(url, {"ordering": "-size"})
+        self.assertEqual(
+            [f["name"] for f in response.data],
+            ["big.txt", "medium.csv", "testfile.txt", "small.pdf"],
+        )
+        response = self.client.get(url, {"content_type": "text/", "min_size": 50})
+        self.assertEqual(
+            sorted(f["name"] for f in response.data), ["big.txt", "medium.csv"]
+        )
+        response = self.client.get(url, {"content_type": "application/pdf"})
+        self.assertEqual([f["name"] for f in response.data], ["small.pdf"])
+        response = self.client.get(url, {"ordering": "owner"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_upload_is_encrypted_on_receive(self):
+        """Test an upload lands on disk only as a segmented blob."""
+        file = File.objects.get(id=self.uploaded_file1["id"])
+        with open(file.file.path, "rb") as f:
+            blob = f.read()
+        self.assertTrue(crypto.is_segmented(blob))
+        self.assertNotIn(b"Test file content", blob)
+        self.assertFalse(os.path.exists(file.file.path + ".part"))
+        self.assertEqual(file.decrypt_file(), b"Test file content")
+
+    def test_unencrypted_upload_is_refused(self):
+        """Test an upload that was not encrypted on receive is never stored."""
+        serializer = FileSerializer(
+            data={"file": SimpleUploadedFile("plain.txt", b"Plain content")},
+            context={"request": mock.Mock(user=self.user1)},
+        )
+        self.assertTrue(serializer.is_valid())
+        with self.assertRaises(ImproperlyConfigured):
+            serializer.save()
+        self.assertFalse(File.objects.filter(name="plain.txt").exists())
+
+    def test_rejected_upload_is_discarded(self):
+        """Test a blob written for an invalid upload is removed again."""
+        self.client.cookies['access'] = self.tokens_user1['access']
+        before = {name for name, _, _ in blob_storage.scan(BLOB_PREFIX)}
+        counts = (File.objects.count(), ContentBlob.objects.count())
+        response = self.client.post(
+            reverse("file-upload"),
+            {"file": SimpleUploadedFile("empty.txt", b"")},
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        after = {name for name, _, _ in blob_storage.scan(BLOB_PREFIX)}
+        self.assertEqual(after, before)
+        self.assertEqual((File.objects.count(), ContentBlob.objects.count()), counts)
+
+    def test_failed_upload_is_discarded(self):
+        """Test no blob is left behind when an upload fails part way."""
+        self.client.cookies['access'] = self.tokens_user1['access']
+        before = {name for name, _, _ in blob_storage.scan(BLOB_PREFIX)}
+        counts = (File.objects.count(), ContentBlob.objects.count())
+
+        # The connection drops in the second file, after the first was received
+        receive = EncryptingUploadHandler.receive_data_chunk
+
+        def disconnecting_receive(handler, raw_data, start):
+            if handler.file_name == "second.txt":
+                raise UnreadablePostError("connection reset")
+            return receive(handler, raw_data, start)
+
+        files = [
+            SimpleUploadedFile("first.txt", b"first file"),
+            SimpleUploadedFile("second.txt", b"second file"),
+        ]
+        with mock.patch.object(
+            EncryptingUploadHandler, "receive_data_chunk", disconnecting_receive
+        ):
+            with self.assertRaises(UnreadablePostError):
+                self.client.post(
+                    reverse("file-upload-batch"), {"files": files}, format="multipart"
+                )
+        after = {name for name, _, _ in blob_storage.scan(BLOB_PREFIX)}
+        self.assertEqual(after, before)
+
+        # The database fails once the upload was received
+        with mock.patch.object(
+            File.objects, "create_from_blob", side_effect=DatabaseError("gone")
+        ):
+            with self.assertRaises(DatabaseError):
+                self.client.post(
+                    reverse("file-upload"),
+                    {"file": SimpleUploadedFile("late.txt", b"late file")},
+                    format="multipart",
+                )
+        after = {name for name, _, _ in blob_storage.scan(BLOB_PREFIX)}
+        self.assertEqual(after, before)
+        self.assertEqual((File.objects.count(), ContentBlob.objects.count()), counts)
+
+    @override_settings(FILE_ENCRYPTION_SEGMENT_SIZE=16, FILE_ENCRYPTION_WORKERS=4)
+    def test_resumable_upload(self):
+        """Test uploading parts out of order and completing the session."""
+        self.client.cookies['access'] = self.tokens_user1['access']
+        content = os.urandom(80)
+        response = self.client.post(
+            reverse("upload-session-create"),
+            {"name": "big.bin", "size": len(content), "part_size": 32},
+            HTTP_IDEMPOTENCY_KEY="session-1",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        session_id = response.data["id"]
+        self.assertEqual(response.data["part_count"], 3)
+
+        retry = self.client.post(
+            reverse("upload-session-create"),
+            {"name": "big.bin", "size": len(content), "part_size": 32},
+            HTTP_IDEMPOTENCY_KEY="session-1",
+        )
+        self.assertEqual(retry.data["id"], session_id)
+
+        def put_part(number, data, key):
+            return self.client.put(
+                reverse("upload-part", args=[session_id, number]),
+                data=data,
+                content_type="application/octet-stream",
+                HTTP_IDEMPOTENCY_KEY=key,
+            )
+
+        self.assertEqual(put_part(3, content[64:], "p3").status_code, 201)
+        self.assertEqual(put_part(1, content[:32], "p1").status_code, 201)
+        self.assertEqual(put_part(1, content[:32], "p1").status_code, 200)
+        self.assertEqual(put_part(1, content[:32], "other").status_code, 409)
+        self.assertEqual(put_part(2, content[32:40], "p2").status_code, 400)
+
+        response = self.client.post(
+            reverse("upload-session-complete", args=[session_id])
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data["missing_parts"], [2])
+
+        self.assertEqual(put_part(2, content[32:64], "p2").status_code, 201)
+        response = self.client.get(reverse("upload-session", args=[session_id]))
+        self.assertEqual(response.data["received_bytes"], len(content))
+
+        response = self.client.post(
+            reverse("upload-session-complete", args=[session_id])
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        file = File.objects.get(id=response.data["id"])
+        self.assertEqual(file.decrypt_file(), content)
+        self.assertEqual(file.size, len(content))
+        self.assertEqual(file.blob_size, os.path.getsize(file.file.path))
+        self.assertEqual(file.segment_count, 5)
+        self.assertEqual(file.content_type, "application/octet-stream")
+
+    @override_settings(FILE_ENCRYPTION_SEGMENT_SIZE=16)
+    def test_resumable_upload_retry_races_first_attempt(self):
+        """Test a retry that missed the session being created gets it back."""
+        self.client.cookies['access'] = self.tokens_user1['access']
+        url = reverse("upload-session-create")
+        data = {"name": "big.bin", "size": 80, "part_size": 32}
+        response = self.client.post(url, data, HTTP_IDEMPOTENCY_KEY="session-1")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        before = {name for name, _, _ in blob_storage.scan(BLOB_PREFIX)}
+
+        # Looked the key up before the first attempt had committed its session
+        with mock.patch.object(QuerySet, "first", return_value=None):
+            retry = self.client.post(url, data, HTTP_IDEMPOTENCY_KEY="session-1")
+        self.assertEqual(retry.status_code, status.HTTP_200_OK)
+        self.assertEqual(retry.data["id"], response.data["id"])
+        self.assertEqual(UploadSession.objects.filter(owner=self.user1).count(), 1)
+        after = {name for name, _, _ in blob_storage.scan(BLOB_PREFIX)}
+        self.assertEqual(after, before)
+
+    @override_settings(FILE_ENCRYPTION_SEGMENT_SIZE=16, FILE_ENCRYPTION_WORKERS=1)
+    def test_resumable_upload_retries_interrupted_part(self):
+        """Test a part is sent again after the client went away mid-upload."""
+        self.client.cookies['access'] = self.tokens_user1['access']
+        content = os.urandom(256)
+        response = self.client.post(
+            reverse("upload-session-create"),
+            {"name": "big.bin", "size": len(content), "part_size": 128},
+        )
+        session_id = response.data["id"]
+
+        def put_part(number, data, **headers):
+            return self.client.put(
+                reverse("upload-part", args=[session_id, number]),
+                data=data,
+                content_type="application/octet-stream",
+                **headers,
+            )
+
+        # The connection drops after the first batch of 4 segments was sealed
+        read_exact = crypto.read_exact
+        reads = []
+
+        def disconnecting_read(src, size):
+            reads.append(size)
+            if len(reads) == 6:
+                raise UnreadablePostError("connection reset")
+            return read_exact(src, size)
+
+        with mock.patch("core.crypto.read_exact", disconnecting_read):
+            with self.assertRaises(UnreadablePostError):
+                put_part(1, content[:128], HTTP_IDEMPOTENCY_KEY="first")
+        part = UploadPart.objects.get(session_id=session_id, number=1)
+        self.assertFalse(part.completed)
+        self.assertIsNone(part.writer)
+        self.assertEqual(len(part.segment_digests), 4 * 32)
+
+        # Sealing other content under the same segment nonces is refused
+        changed = bytes([content[0] ^ 1]) + content[1:128]
+        response = put_part(1, changed, HTTP_IDEMPOTENCY_KEY="second")
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(put_part(1, content[:128]).status_code, 201)
+
+        # Only one request writes a part at a time, unless it stalled
+        part = UploadPart.objects.create(session_id=session_id, number=2)
+        self.assertTrue(part.claim())
+        response = put_part(2, content[128:])
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        UploadPart.objects.filter(pk=part.pk).update(
+            writing_since=timezone.now() - settings.FILE_UPLOAD_PART_TIMEOUT * 2
+        )
+        self.assertEqual(put_part(2, content[128:]).status_code, 201)
+
+        response = self.client.post(
+            reverse("upload-session-complete", args=[session_id])
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        file = File.objects.get(id=response.data["id"])
+        self.assertEqual(file.decrypt_file(), content)
+
+    def test_duplicate_upload_shares_blob(self):
+        """Test re-uploading identical content references the existing blob."""
+        self.client.cookies['access'] = self.tokens_user1['access']
+        response = self.client.post(
+            reverse("file-upload"),
+            {"file": SimpleUploadedFile("copy.txt", b"Test file content")},
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        original = File.objects.get(id=self.uploaded_file1["id"])
+        duplicate = File.objects.get(id=response.data["id"])
+        self.assertEqual(duplicate.file.name, original.file.name)
+        self.assertEqual(duplicate.decrypt_file(), b"Test file content")
+        blob = ContentBlob.objects.get(owner=self.user1)
+        self.assertEqual(blob.ref_count, 2)
+
+        # The other owner's identical upload is stored separately
+        other = File.objects.get(id=self.uploaded_file2["id"])
+        self.assertNotEqual(other.content_digest, original.content_digest)
+
+        path = original.file.path
+        with self.captureOnCommitCallbacks(execute=True):
+            original.delete()
+        self.assertTrue(os.path.exists(path))
+        with self.captureOnCommitCallbacks(execute=True):
+            duplicate.delete()
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(ContentBlob.objects.filter(owner=self.user1).exists())
+
+    def test_uploads_are_not_compressed_by_default(self):
+        """Test compression is left to operators to turn on."""
+        self.client.cookies['access'] = self.tokens_user1['access']
+        response = self.client.post(
+            reverse("file-upload"),
+            {"file": SimpleUploadedFile("data.csv", b"a,b,c\n" * 20000)},
+            format="multipart",
+        )
+        file = File.objects.get(id=response.data["id"])
+        self.assertEqual(file.blob_header().codec, crypto.CODEC_NONE)
+        response = self.client.get(
+            reverse("file-download", args=[file.id]), HTTP_RANGE="bytes=0-9"
+        )
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+
+    @override_settings(FILE_COMPRESSION="zlib")
+    def test_compressible_upload_is_compressed(self):
+        """Test compressible uploads are stored and served compressed."""
+        content = b"a,b,c\n" * 20000
+        self.client.cookies['access'] = self.tokens_user1['access']
+        response = self.client.post(
+            reverse("file-upload"),
+            {"file": SimpleUploadedFile("data.csv", content)},
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        file = File.objects.get(id=response.data["id"])
+        self.assertEqual(file.blob_header().codec, crypto.CODEC_ZLIB)
+        self.assertLess(os.path.getsize(file.file.path), len(content))
+
+        url = reverse("file-download", args=[file.id])
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(response["Content-Encoding"], "deflate")
+        self.assertEqual(response["Accept-Ranges"], "none")
+        self.assertIn("Accept-Encoding", response["Vary"])
+        body = b"".join(response.streaming_content)
+        self.assertEqual(response["Content-Length"], str(len(body)))
+        self.assertEqual(zlib.decompress(body), content)
+        self.assertEqual(response["ETag"], f'W/"{file.content_digest}"')
+
+        response = self.client.get(
+            url, HTTP_ACCEPT_ENCODING="deflate", HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response["ETag"], f'W/"{file.content_digest}"')
+        self.assertIn("Accept-Encoding", response["Vary"])
+
+        response = self.client.get(url, HTTP_RANGE="bytes=0-9")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(response["Content-Length"], str(len(content)))
+        self.assertEqual(b"".join(response.streaming_content), content)
+
+    @override_settings(FILE_ENCRYPTION_SEGMENT_SIZE=16)
+    def test_uploads_to_object_storage(self):
+        """Test both upload paths commit their blobs to an S3 backend."""
+        client = FakeS3Client()
+        storages = {
+            **settings.STORAGES,
+            "blobs": {
+                "BACKEND": "core.storage.S3BlobStorage",
+                "OPTIONS": {
+                    "bucket": "blobs",
+                    "client": client,
+                    "min_part_size": 0,
+                },
+            },
+        }
+        self.client.cookies['access'] = self.tokens_user1['access']
+        with override_settings(STORAGES=storages):
+            content = os.urandom(40)
+            response = self.client.post(
+                reverse("file-upload"),
+                {"file": SimpleUploadedFile("direct.bin", content)},
+                format="multipart",
+            )
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            file = File.objects.get(id=response.data["id"])
+            self.assertIn(("blobs", file.file.name), client.objects)
+            self.assertEqual(file.decrypt_file(), content)
+
+            response = self.client.post(
+                reverse("upload-session-create"),
+                {"name": "parts.bin", "size": 80, "part_size": 32},
+            )
+            session_id = response.data["id"]
+            content = os.urandom(80)
+            for number, start in ((2, 32), (1, 0), (3, 64)):
+                response = self.client.put(
+                    reverse("upload-part", args=[session_id, number]),
+                    data=content[start : start + 32],
+                    content_type="application/octet-stream",
+                )
+                self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            response = self.client.post(
+                reverse("upload-session-complete", args=[session_id])
+            )
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(client.uploads, {})
+
+            response = self.client.get(
+                reverse("file-download", args=[response.data["id"]]),
+                HTTP_RANGE="bytes=20-50",
+            )
+            self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+            self.assertEqual(b"".join(response.streaming_content), content[20:51])
+
+    def test_upload_parts_meet_object_storage_minimum(self):
+        """Test sessions cannot use parts S3 would reject on completion."""
+        client = FakeS3Client(min_part_size=MIN_PART_SIZE)
+        storages = {
+            **settings.STORAGES,
+            "blobs": {
+                "BACKEND": "core.storage.S3BlobStorage",
+                "OPTIONS": {"bucket": "blobs", "client": client},
+            },
+        }
+        self.client.cookies['access'] = self.tokens_user1['access']
+        segment_size = settings.FILE_ENCRYPTION_SEGMENT_SIZE
+        with override_settings(STORAGES=storages):
+            response = self.client.post(
+                reverse("upload-session-create"),
+                {
+                    "name": "parts.bin",
+                    "size": 3 * segment_size,
+                    "part_size": segment_size,
+                },
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn("part_size", response.data)
+
+            content = os.urandom(MIN_PART_SIZE + 100)
+            response = self.client.post(
+                reverse("upload-session-create"),
+                {
+                    "name": "parts.bin",
+                    "size": len(content),
+                    "part_size": MIN_PART_SIZE,
+                },
+            )
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            session_id = response.data["id"]
+            for number, start in ((2, MIN_PART_SIZE), (1, 0)):
+                response = self.client.put(
+                    reverse("upload-part", args=[session_id, number]),
+                    data=content[start : start + MIN_PART_SIZE],
+                    content_type="application/octet-stream",
+                )
+                self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            response = self.client.post(
+                reverse("upload-session-complete", args=[session_id])
+            )
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            file = File.objects.get(id=response.data["id"])
+            self.assertEqual(file.decrypt_file(), content)
+
+    def test_client_encrypted_upload_is_served_untouched(self):
+        """Test client-encrypted blobs are stored and delivered as received."""
+        ciphertext = os.urandom(300)
+        wrapped_key = os.urandom(60)
+        self.client.cookies['access'] = self.tokens_user1['access']
+        response = self.client.post(
+            reverse("file-upload-client-encrypted"),
+            {
+                "file": SimpleUploadedFile("secret.bin", ciphertext),
+                "wrapped_key": base64.b64encode(wrapped_key).decode(),
+            },
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(response.data["client_encrypted"])
+        file = File.objects.get(id=response.data["id"])
+        with open(file.file.path, "rb") as f:
+            self.assertEqual(f.read(), ciphertext)
+        self.assertEqual(bytes(file.encrypted_key), wrapped_key)
+        self.assertEqual(file.key_id, "")
+        with self.assertRaises(ValueError):
+            file.decrypt_file()
+
+        url = reverse("file-download", args=[file.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b"".join(response.streaming_content), ciphertext)
+        self.assertEqual(base64.b64decode(response["X-Wrapped-Key"]), wrapped_key)
+
+        with override_settings(FILE_ACCEL_REDIRECT_LOCATION="/protected/blobs/"):
+            response = self.client.get(url)
+        self.assertEqual(
+            response["X-Accel-Redirect"], f"/protected/blobs/{file.file.name}"
+        )
+        self.assertEqual(response.content, b"")
+
+        # Access checks still apply
+        self.client.cookies['access'] = self.tokens_user2['access']
+        response = self.client.get(url)
+        self.assertNotEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_client_encrypted_upload_requires_wrapped_key(self):
+        """Test a client-encrypted upload without a valid key is rejected."""
+        self.client.cookies['access'] = self.tokens_user1['access']
+        response = self.client.post(
+            reverse("file-upload-client-encrypted"),
+            {
+                "file": SimpleUploadedFile("secret.bin", b"opaque"),
+                "wrapped_key": "not base64!",
+            },
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("wrapped_key", response.data)
+
+    @override_settings(FILE_PREVIEW_ASYNC=False)
+    def test_preview_is_generated_and_cached(self):
+        """Test a text upload gets an encrypted preview served with an ETag."""
+        content = "préview ".encode() * 1000
+        self.client.cookies['access'] = self.tokens_user1['access']
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse("file-upload"),
+                {"file": SimpleUploadedFile("notes.txt", content)},
+                format="multipart",
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        file = File.objects.get(id=response.data["id"])
+        preview = file.previews.get()
+        self.assertEqual(preview.kind, "text")
+        self.assertNotIn(b"pr\xc3\xa9view", bytes(preview.data))
+
+        url = reverse("file-preview", args=[file.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response["Cache-Control"].startswith("private"))
+        self.assertEqual(response["Content-Type"], "text/plain; charset=utf-8")
+        text = response.content.decode()
+        self.assertLessEqual(len(response.content), settings.FILE_PREVIEW_TEXT_BYTES)
+        self.assertTrue(content.decode().startswith(text))
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(
+            self.client.get(url, {"kind": "bogus"}).status_code,
+            status.HTTP_400_BAD_REQUEST,
+        )
+        self.assertEqual(
+            self.client.get(url, {"kind": "thumbnail"}).status_code,
+            status.HTTP_404_NOT_FOUND,
+        )
+
+        # Only the owner and share recipients may see it
+        self.client.cookies['access'] = self.tokens_user2['access']
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+        share = FileShare.objects.create(
+            file=file,
+            shared_by=self.user1,
+            shared_with=self.user2.email,
+            share_type="view",
+        )
+        response = self.client.get(
+            reverse("shared-file-preview", args=[share.shared_link])
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.content.decode(), text)
+
+    @override_settings(FILE_PREVIEW_ASYNC=False)
+    def test_no_preview_for_unsupported_type(self):
+        """Test files without a renderer get no preview."""
+        self.client.cookies['access'] = self.tokens_user1['access']
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse("file-upload"),
+                {"file": SimpleUploadedFile("data.bin", os.urandom(100))},
+                format="multipart",
+            )
+        response = self.client.get(reverse("file-preview", args=[response.data["id"]]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(FILE_ENCRYPTION_SEGMENT_SIZE=16)
+    def test_bulk_download_streams_zip(self):
+        """Test several owned and shared files download as one ZIP archive."""
+        compressible = b"a,b,c\n" * 2000
+        self.client.cookies['access'] = self.tokens_user1['access']
+        ids = []
+        for name, content in [
+            ("report.txt", b"first report"),
+            ("report.txt", b"second report"),
+            ("data.csv", compressible),
+        ]:
+            response = self.client.post(
+                reverse("file-upload"),
+                {"file": SimpleUploadedFile(name, content)},
+                format="multipart",
+            )
+            ids.append(response.data["id"])
+        FileShare.objects.create(
+            file=File.objects.get(id=self.uploaded_file2["id"]),
+            shared_by=self.user2,
+            shared_with=self.user1.email,
+            share_type="download",
+        )
+        ids.append(self.uploaded_file2["id"])
+
+        response = self.client.post(
+            reverse("file-bulk-download"), {"files": ids}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "application/zip")
+        archive = zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+        self.assertEqual(
+            archive.namelist(),
+            ["report.txt", "report (1).txt", "data.csv", "testfile.txt"],
+        )
+        self.assertIsNone(archive.testzip())
+        for info in archive.infolist():
+            self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(archive.read("report (1).txt"), b"second report")
+        self.assertEqual(archive.read("data.csv"), compressible)
+        self.assertEqual(archive.read("testfile.txt"), b"Test file content")
+
+    def test_bulk_download_requires_access(self):
+        """Test files that are neither owned nor shared for download are refused."""
+        share = FileShare.objects.create(
+            file=File.objects.get(id=self.uploaded_file2["id"]),
+            shared_by=self.user2,
+            shared_with=self.user1.email,
+            share_type="view",
+        )
+        self.client.cookies['access'] = self.tokens_user1['access']
+        url = reverse("file-bulk-download")
+        ids = [self.uploaded_file1["id"], str(share.file_id)]
+        response = self.client.post(url, {"files": ids}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.post(url, {"files": []}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(FILE_PREVIEW_ASYNC=False)
+    def test_batch_upload(self):
+        """Test a batch upload stores every valid file and reports each one."""
+        self.client.cookies['access'] = self.tokens_user1['access']
+        files = [
+            SimpleUploadedFile("a.txt", b"alpha"),
+            SimpleUploadedFile("empty.txt", b""),
+            SimpleUploadedFile("b.bin", os.urandom(100)),
+            SimpleUploadedFile("a-copy.txt", b"alpha"),
+            SimpleUploadedFile("c.txt", b"Test file content"),
+        ]
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse("file-upload-batch"), {"files": files}, format="multipart"
+            )
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        results = response.data["results"]
+        self.assertEqual(
+            [(r["name"], r["status"]) for r in results],
+            [
+                ("a.txt", 201),
+                ("empty.txt", 400),
+                ("b.bin", 201),
+                ("a-copy.txt", 201),
+                ("c.txt", 201),
+            ],
+        )
+
+        stored = {
+            r["name"]: File.objects.get(id=r["file"]["id"]) for r in results[::2]
+        }
+        self.assertEqual(stored["b.bin"].name, "b.bin")
+        self.assertEqual(stored["c.txt"].decrypt_file(), b"Test file content")
+        copy = File.objects.get(id=results[3]["file"]["id"])
+        self.assertEqual(copy.file.name, stored["a.txt"].file.name)
+        self.assertEqual(copy.decrypt_file(), b"alpha")
+        self.assertEqual(
+            ContentBlob.objects.get(digest=copy.content_digest).ref_count, 2
+        )
+        # Same content as the file uploaded in setUp
+        existing = File.objects.get(id=self.uploaded_file1["id"])
+        self.assertEqual(stored["c.txt"].file.name, existing.file.name)
+        # post_save receivers still run for bulk-created files
+        self.assertTrue(stored["a.txt"].previews.exists())
+
+        response = self.client.post(
+            reverse("file-upload-batch"),
+            {"files": [SimpleUploadedFile("d.txt", b"delta")]},
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_upload_quota(self):
+        """Test uploads beyond the storage quota are refused and usage is counted."""
+        self.client.cookies['access'] = self.tokens_user1['access']
+        usage = StorageUsage.for_user(self.user1.pk)
+        self.assertEqual((usage.bytes, usage.files), (17, 1))
+
+        self.user1.storage_quota = 100
+        self.user1.save()
+        response = self.client.post(
+            reverse("file-upload"),
+            {"file": SimpleUploadedFile("fits.bin", os.urandom(80))},
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        usage.refresh_from_db()
+        self.assertEqual((usage.bytes, usage.files), (97, 2))
+
+        # Rejected after the body is read: the blob is not kept
+        blobs = ContentBlob.objects.count()
+        response = self.client.post(
+            reverse("file-upload"),
+            {"file": SimpleUploadedFile("over.bin", os.urandom(10))},
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(ContentBlob.objects.count(), blobs)
+
+        # Rejected from Content-Length alone
+        with mock.patch("core.storage.FileSystemBlobStorage.writer") as writer:
+            response = self.client.post(
+                reverse("file-upload"),
+                {"file": SimpleUploadedFile("big.bin", os.urandom(100_000))},
+                format="multipart",
+            )
+        self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        writer.assert_not_called()
+
+        # Batches keep the files that fit, in order
+        response = self.client.post(
+            reverse("file-upload-batch"),
+            {
+                "files": [
+                    SimpleUploadedFile("a.bin", os.urandom(2)),
+                    SimpleUploadedFile("b.bin", os.urandom(5)),
+                    SimpleUploadedFile("c.bin", os.urandom(1)),
+                ]
+            },
+            format="multipart",
+        )
+        self.assertEqual(
+            [r["status"] for r in response.data["results"]], [201, 413, 201]
+        )
+
+        response = self.client.post(
+            reverse("upload-session-create"),
+            {"name": "big.bin", "size": 1000},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        File.objects.filter(owner=self.user1, name="fits.bin").delete()
+        usage.refresh_from_db()
+        self.assertEqual((usage.bytes, usage.files), (20, 3))
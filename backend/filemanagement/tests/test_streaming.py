@@ -0,0 +1,31 @@
+from django.test import SimpleTestCase
+
+from filemanagement.streaming import parse_range_header
+
+
+class ParseRangeHeaderTestCase(SimpleTestCase):
+    def test_single_range(self):
+        self.assertEqual(parse_range_header("bytes=0-9", 100), [(0, 9)])
+
+    def test_open_and_suffix_ranges(self):
+        self.assertEqual(parse_range_header("bytes=90-", 100), [(90, 99)])
+        self.assertEqual(parse_range_header("bytes=-10", 100), [(90, 99)])
+        self.assertEqual(parse_range_header("bytes=-500", 100), [(0, 99)])
+
+    def test_end_is_clamped(self):
+        self.assertEqual(parse_range_header("bytes=50-500", 100), [(50, 99)])
+
+    def test_overlapping_ranges_are_merged(self):
+        self.assertEqual(
+            parse_range_header("bytes=20-30, 0-9, 25-40, 10-12", 100),
+            [(0, 12), (20, 40)],
+        )
+
+    def test_unsatisfiable(self):
+        self.assertEqual(parse_range_header("bytes=100-200", 100), [])
+
+    def test_malformed_headers_are_ignored(self):
+        self.assertIsNone(parse_range_header("items=0-9", 100))
+        self.assertIsNone(parse_range_header("bytes=9-0", 100))
+        self.assertIsNone(parse_range_header("bytes=abc", 100))
+        self.assertIsNone(parse_range_header("bytes=-", 100))
@@ -0,0 +1,201 @@
+import os
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+
+from core import crypto
+from core.models import (
+    File,
+    UploadMetadata,
+    choose_upload_codec,
+    content_digest_secret,
+    current_master_key_id,
+    encrypt_key,
+    encryption_batch,
+    encryption_executor,
+)
+from core.storage import blob_storage
+
+
+class EncryptedUploadedFile(UploadedFile):
+    """
+    An upload that was encrypted while it was received (by the server, or
+    by the client before sending it). The blob stays uncommitted in
+    ``blob`` until the File is created.
+    """
+
+    def __init__(
+        self,
+        name,
+        blob,
+        encrypted_key,
+        key_id,
+        content_digest,
+        size,
+        content_type=None,
+        charset=None,
+        content_type_extra=None,
+        metadata=None,
+    ):
+        super().__init__(
+            file=None,
+            name=name,
+            content_type=content_type,
+            size=size,
+            charset=charset,
+            content_type_extra=content_type_extra,
+        )
+        self.blob = blob
+        self.encrypted_key = encrypted_key
+        self.key_id = key_id
+        self.content_digest = content_digest
+        # File fields recorded while the upload was received
+        self.metadata = metadata or {}
+
+    def discard(self):
+        """
+        Removes the uncommitted blob, e.g. when the upload fails validation.
+        Does nothing once the blob has been committed.
+        """
+        self.blob.abort()
+
+    def close(self):
+        # There is no file to close; called by Django when the request ends
+        self.discard()
+
+
+class BlobUploadHandler(FileUploadHandler):
+    """
+    Streams uploaded files unchanged into uncommitted blobs.
+
+    Used for client-encrypted uploads, whose content is already opaque to
+    the server; ``File.objects.create_from_blob`` commits them.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.owner = request.user
+        self.blob = None
+        # Every upload handed to the parser, kept in case it never returns them
+        self.uploads = []
+
+    def new_file(self, field_name, file_name, *args, **kwargs):
+        super().new_file(field_name, file_name, *args, **kwargs)
+        self.blob = blob_storage.writer(File.generate_blob_name(self.owner, file_name))
+
+    def receive_data_chunk(self, raw_data, start):
+        self.blob.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        return self._uploaded_file(
+            file_size, encrypted_key=None, key_id="", metadata={"blob_size": file_size}
+        )
+
+    def _uploaded_file(self, file_size, **kwargs):
+        # A batch holds all its uploads until they are stored
+        self.blob.close()
+        blob, self.blob = self.blob, None
+        upload = EncryptedUploadedFile(
+            name=self.file_name,
+            blob=blob,
+            content_digest=kwargs.pop("content_digest", None),
+            size=file_size,
+            content_type=self.content_type,
+            charset=self.charset,
+            content_type_extra=self.content_type_extra,
+            **kwargs,
+        )
+        self.uploads.append(upload)
+        return upload
+
+    def upload_interrupted(self):
+        self._discard_blob()
+
+    def upload_complete(self):
+        # A blob still held here never reached file_complete
+        self._discard_blob()
+
+    def _discard_blob(self):
+        if self.blob is not None:
+            self.blob.abort()
+            self.blob = None
+
+    def discard(self):
+        """
+        Removes every blob this handler received that was not committed,
+        including those the parser lost when the body failed part way.
+        """
+        self._discard_blob()
+        for upload in self.uploads:
+            upload.discard()
+
+
+class EncryptingUploadHandler(BlobUploadHandler):
+    """
+    Encrypts uploaded files chunk by chunk as they come off the socket.
+
+    Ciphertext goes to an uncommitted blob writer, which
+    ``File.objects.create_from_blob`` commits (or drops in favour of an
+    identical blob), so plaintext never touches storage and a partially
+    received upload is never visible. The keyed content digest is computed
+    in the same pass. The first chunk is held in memory until the
+    compression codec has been chosen from it.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        # Large enough chunks to keep the encryption pool busy
+        self.chunk_size = max(
+            self.chunk_size, settings.FILE_ENCRYPTION_SEGMENT_SIZE * encryption_batch()
+        )
+
+    def new_file(self, field_name, file_name, *args, **kwargs):
+        super().new_file(field_name, file_name, *args, **kwargs)
+        self.key = os.urandom(32)
+        self.digest = crypto.ContentDigest(
+            content_digest_secret(self.owner), settings.FILE_ENCRYPTION_SEGMENT_SIZE
+        )
+        self.encryptor = None
+        self.sample = bytearray()
+        self.metadata = UploadMetadata(file_name)
+
+    def _start_encryptor(self):
+        codec = choose_upload_codec(bytes(self.sample))
+        self.encryptor = crypto.SegmentEncryptor(
+            self.key,
+            settings.FILE_ENCRYPTION_SEGMENT_SIZE,
+            codec,
+            executor=encryption_executor(),
+        )
+        self.blob.write(
+            self.metadata.ciphertext(self.encryptor.update(bytes(self.sample)))
+        )
+        self.sample = None
+
+    def receive_data_chunk(self, raw_data, start):
+        self.digest.update(raw_data)
+        self.metadata.plaintext(raw_data)
+        if self.encryptor is not None:
+            self.blob.write(self.metadata.ciphertext(self.encryptor.update(raw_data)))
+        else:
+            self.sample += raw_data
+            if len(self.sample) >= settings.FILE_COMPRESSION_SAMPLE_SIZE:
+                self._start_encryptor()
+        # Swallow the chunk: no other handler should see the plaintext
+        return None
+
+    def file_complete(self, file_size):
+        if self.encryptor is None:
+            self._start_encryptor()
+        self.blob.write(self.metadata.ciphertext(self.encryptor.finalize()))
+        return self._uploaded_file(
+            file_size,
+            encrypted_key=encrypt_key(self.key),
+            key_id=current_master_key_id(),
+            content_digest=self.digest.hexdigest(),
+            metadata=self.metadata.fields(
+                self.encryptor.header.codec, settings.FILE_ENCRYPTION_SEGMENT_SIZE
+            ),
+        )
@@ -3,19 +3,55 @@ from django.urls import path
 from .views import (
     AccessSharedFileForAuthenticatedUsers,
     AccessSharedFileForPublicUsers,
+    BatchUploadView,
+    BulkDownloadView,
+    ClientEncryptedUploadView,
     FileDownloadView,
+    FilePreviewView,
     FileUploadView,
     FileViewView,
     GetPublicShareDetails,
     PublicShareFileView,
     SendEmailView,
+    SharedFilePreviewView,
     SharedFilesListView,
     ShareFileView,
+    UploadPartView,
+    UploadSessionCompleteView,
+    UploadSessionCreateView,
+    UploadSessionView,
     UserFilesView,
 )
 
 urlpatterns = [
     path("upload/", FileUploadView.as_view(), name="file-upload"),
+    path("upload/batch/", BatchUploadView.as_view(), name="file-upload-batch"),
+    path(
+        "upload/client-encrypted/",
+        ClientEncryptedUploadView.as_view(),
+        name="file-upload-client-encrypted",
+    ),
+    path(
+        "upload/sessions/",
+        UploadSessionCreateView.as_view(),
+        name="upload-session-create",
+    ),
+    path(
+        "upload/sessions/<uuid:session_id>/",
+        UploadSessionView.as_view(),
+        name="upload-session",
+    ),
+    path(
+        "upload/sessions/<uuid:session_id>/parts/<int:part_number>/",
+        UploadPartView.as_view(),
+        name="upload-part",
+    ),
+    path(
+        "upload/sessions/<uuid:session_id>/complete/",
+        UploadSessionCompleteView.as_view(),
+        name="upload-session-complete",
+    ),
+    path("download/", BulkDownloadView.as_view(), name="file-bulk-download"),
     path("download/<str:file_id>/", FileDownloadView.as_view(), name="file-download"),
     path("my-files/", UserFilesView.as_view(), name="user-files"),
     path("share/", ShareFileView.as_view(), name="share_file"),
@@ -31,11 +67,17 @@ urlpatterns = [
         AccessSharedFileForAuthenticatedUsers.as_view(),
         name="access_shared_file_for_authenticated_users",
     ),
+    path(
+        "shared/<uuid:shared_link>/preview/",
+        SharedFilePreviewView.as_view(),
+        name="shared-file-preview",
+    ),
     path(
         "shared/public/<str:shared_link>/<str:passphrase>/",
         AccessSharedFileForPublicUsers.as_view(),
         name="access_shared_file_for_public_users",
     ),
     path("view/<str:file_id>/", FileViewView.as_view(), name="file_view"),
+    path("preview/<uuid:file_id>/", FilePreviewView.as_view(), name="file-preview"),
     path("send-email/", SendEmailView.as_view(), name="send_email"),
 ]
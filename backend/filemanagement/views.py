@@ -1,22 +1,90 @@
 import datetime
 import secrets
 import string
-from mimetypes import guess_type
+from io import BytesIO
 
 from django.conf import settings
-from django.http import FileResponse, Http404
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.http import Http404
 from django.shortcuts import get_object_or_404, render
 from django.utils import timezone
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
 from rest_framework.parsers import MultiPartParser
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from core.models import File, FileShare
+from core.models import (
+    File,
+    FileShare,
+    UploadPart,
+    UploadPartConflict,
+    UploadSession,
+)
+from core.quotas import QuotaExceeded, check_quota, quota_reservation
 from core.utils import send_email
 
-from .serializers import FileSerializer
+from .serializers import (
+    BulkDownloadSerializer,
+    ClientEncryptedFileSerializer,
+    FileListQuerySerializer,
+    FileSerializer,
+    UploadSessionSerializer,
+)
+from .streaming import (
+    PREVIEW_KINDS,
+    encrypted_file_response,
+    preview_response,
+    zip_archive_response,
+)
+from .upload_handlers import (
+    BlobUploadHandler,
+    EncryptingUploadHandler,
+)
+
+
+# Allowance for the multipart framing counted in Content-Length
+MULTIPART_OVERHEAD = 16 * 1024
+
+
+def quota_exceeded(e):
+    return Response(
+        {"error": "Storage quota exceeded.", "quota": e.quota, "usage": e.usage},
+        status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+    )
+
+
+def check_request_quota(request):
+    """
+    Turns away an upload whose body cannot fit in the user's quota before
+    any of it is read. Returns an error response, or None.
+    """
+    try:
+        length = int(request.META.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        length = 0
+    try:
+        check_quota(request.user, max(length - MULTIPART_OVERHEAD, 0))
+    except QuotaExceeded as e:
+        return quota_exceeded(e)
+    return None
+
+
+def save_upload(serializer, request):
+    """
+    Saves a validated upload serializer if the file fits in the quota, and
+    returns the response.
+    """
+    upload = serializer.validated_data["file"]
+    try:
+        with quota_reservation(request.user) as reservation:
+            reservation.take(upload.size)
+            serializer.save()
+    except QuotaExceeded as e:
+        return quota_exceeded(e)
+    return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
 class FileUploadView(APIView):
@@ -24,15 +92,322 @@ class FileUploadView(APIView):
     parser_classes = [MultiPartParser]
 
     def post(self, request, *args, **kwargs):
+        rejected = check_request_quota(request)
+        if rejected:
+            return rejected
+
+        # Encrypt uploads as they are received, before the body is parsed
+        handler = EncryptingUploadHandler(request)
+        request.upload_handlers = [handler]
+        try:
+            file_serializer = FileSerializer(
+                data=request.data, context={"request": request}
+            )
+            if file_serializer.is_valid():
+                return save_upload(file_serializer, request)
+            return Response(file_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        finally:
+            # Whatever was not stored, however the request ended
+            handler.discard()
+
+
+class BatchUploadView(APIView):
+    """
+    Upload many files in one multipart body, all under the ``files`` field.
+
+    Each file is encrypted as it is received, like a single upload; the
+    blobs are then stored concurrently and the File rows inserted together.
+    Every file gets its own result, so one invalid or failed file does not
+    fail the others: the response is 201 if all were stored and 207 (Multi
+    Status) otherwise.
+    """
+
+    permission_classes = [IsAuthenticated]
+    parser_classes = [MultiPartParser]
+
+    def post(self, request, *args, **kwargs):
+        rejected = check_request_quota(request)
+        if rejected:
+            return rejected
+
+        handler = EncryptingUploadHandler(request)
+        request.upload_handlers = [handler]
+        try:
+            uploads = request.FILES.getlist("files")
+            if not uploads:
+                return Response(
+                    {"files": ["No files were submitted."]},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+            field = FileSerializer().fields["file"]
+            results = [None] * len(uploads)
+            accepted = []
+            for i, upload in enumerate(uploads):
+                try:
+                    field.run_validation(upload)
+                except ValidationError as e:
+                    upload.discard()
+                    results[i] = self.item(
+                        upload, status.HTTP_400_BAD_REQUEST, errors=e.detail
+                    )
+                    continue
+                accepted.append(i)
+
+            with quota_reservation(request.user) as reservation:
+                # Files are admitted in order for as long as they fit
+                fitting = []
+                for i in accepted:
+                    if reservation.fits(uploads[i].size):
+                        reservation.take(uploads[i].size)
+                        fitting.append(i)
+                    else:
+                        uploads[i].discard()
+                        results[i] = self.item(
+                            uploads[i],
+                            status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            errors=["Storage quota exceeded."],
+                        )
+                accepted = fitting
+                created = File.objects.create_from_blobs(
+                    request.user,
+                    [
+                        {
+                            "pending": uploads[i].blob,
+                            "encrypted_key": uploads[i].encrypted_key,
+                            "key_id": uploads[i].key_id,
+                            "content_digest": uploads[i].content_digest,
+                            "name": uploads[i].name,
+                            **uploads[i].metadata,
+                        }
+                        for i in accepted
+                    ],
+                    workers=settings.FILE_BATCH_UPLOAD_WORKERS,
+                )
+            for i, file in zip(accepted, created):
+                if isinstance(file, Exception):
+                    results[i] = self.item(
+                        uploads[i],
+                        status.HTTP_500_INTERNAL_SERVER_ERROR,
+                        errors=["The file could not be stored."],
+                    )
+                else:
+                    results[i] = self.item(
+                        uploads[i],
+                        status.HTTP_201_CREATED,
+                        file=FileSerializer(file).data,
+                    )
+
+            failed = any(
+                result["status"] != status.HTTP_201_CREATED for result in results
+            )
+            return Response(
+                {"results": results},
+                status=(
+                    status.HTTP_207_MULTI_STATUS if failed else status.HTTP_201_CREATED
+                ),
+            )
+        finally:
+            handler.discard()
+
+    @staticmethod
+    def item(upload, code, **details):
+        return {"name": upload.name, "status": code, **details}
+
+
+class ClientEncryptedUploadView(APIView):
+    """
+    Upload a file the client has already encrypted. The blob is stored as
+    received and served back untouched by the front end server.
+    """
+
+    permission_classes = [IsAuthenticated]
+    parser_classes = [MultiPartParser]
+
+    def post(self, request, *args, **kwargs):
+        rejected = check_request_quota(request)
+        if rejected:
+            return rejected
+
+        handler = BlobUploadHandler(request)
+        request.upload_handlers = [handler]
+        try:
+            file_serializer = ClientEncryptedFileSerializer(
+                data=request.data, context={"request": request}
+            )
+            if file_serializer.is_valid():
+                return save_upload(file_serializer, request)
+            return Response(file_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        finally:
+            handler.discard()
+
+
+class UploadSessionCreateView(APIView):
+    """
+    Start a resumable upload. Retrying with the same ``Idempotency-Key``
+    returns the session created by the first attempt.
+    """
+
+    permission_classes = [IsAuthenticated]
 
-        file_serializer = FileSerializer(
-            data=request.data, context={"request": request}
+    def post(self, request):
+        idempotency_key = request.headers.get("Idempotency-Key")
+        if idempotency_key:
+            session = UploadSession.objects.filter(
+                owner=request.user, idempotency_key=idempotency_key
+            ).first()
+            if session:
+                return Response(UploadSessionSerializer(session).data)
+
+        serializer = UploadSessionSerializer(
+            data=request.data,
+            context={"request": request, "idempotency_key": idempotency_key},
         )
-        if file_serializer.is_valid():
-            file_instance = file_serializer.save()
-            file_instance.encrypt_file()
-            return Response(file_serializer.data, status=status.HTTP_201_CREATED)
-        return Response(file_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        if serializer.is_valid():
+            try:
+                check_quota(request.user, serializer.validated_data["size"])
+            except QuotaExceeded as e:
+                return quota_exceeded(e)
+            try:
+                with transaction.atomic():
+                    serializer.save()
+            except IntegrityError:
+                if not idempotency_key:
+                    raise
+                # A concurrent retry with the same key created it first
+                session = UploadSession.objects.get(
+                    owner=request.user, idempotency_key=idempotency_key
+                )
+                return Response(UploadSessionSerializer(session).data)
+            return Response(serializer.data, status=status.HTTP_201_CREATED)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class UploadSessionView(APIView):
+    """
+    Report the parts received so far, or abort the upload.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, session_id):
+        session = get_object_or_404(UploadSession, id=session_id, owner=request.user)
+        return Response(UploadSessionSerializer(session).data)
+
+    def delete(self, request, session_id):
+        session = get_object_or_404(UploadSession, id=session_id, owner=request.user)
+        if session.file_id:
+            return Response(
+                {"error": "Upload is already complete."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        session.abort()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class UploadPartView(APIView):
+    """
+    Receive one numbered part of a resumable upload as the raw request body.
+    Parts may arrive in any order and in parallel, but each part is written
+    by one request at a time. A part that was already stored is only
+    acknowledged again for the same ``Idempotency-Key``. A part whose upload
+    failed may be sent again, with the same content: its segment nonces
+    cannot be reused for other data.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def put(self, request, session_id, part_number):
+        session = get_object_or_404(UploadSession, id=session_id, owner=request.user)
+        if session.file_id:
+            return Response(
+                {"error": "Upload is already complete."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if session.is_expired():
+            return Response(
+                {"error": "Upload session has expired."}, status=status.HTTP_410_GONE
+            )
+        if not 1 <= part_number <= session.part_count:
+            return Response(
+                {"error": f"Part number must be between 1 and {session.part_count}."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        idempotency_key = request.headers.get("Idempotency-Key")
+        part, _ = UploadPart.objects.get_or_create(
+            session=session,
+            number=part_number,
+            defaults={"idempotency_key": idempotency_key},
+        )
+        if part.completed:
+            if idempotency_key and part.idempotency_key == idempotency_key:
+                return Response({"number": part.number, "size": part.size})
+            return Response(
+                {"error": "Part has already been received."},
+                status=status.HTTP_409_CONFLICT,
+            )
+        if not part.claim():
+            return Response(
+                {"error": "Part is being received by another request."},
+                status=status.HTTP_409_CONFLICT,
+            )
+
+        try:
+            written = session.write_part(part, request.stream or BytesIO())
+            part.complete(*written, idempotency_key)
+        except UploadPartConflict as e:
+            part.release()
+            return Response({"error": str(e)}, status=status.HTTP_409_CONFLICT)
+        except ValueError as e:
+            part.release()
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception:
+            # E.g. the client went away: the part may be sent again
+            part.release()
+            raise
+        return Response(
+            {"number": part.number, "size": part.size}, status=status.HTTP_201_CREATED
+        )
+
+
+class UploadSessionCompleteView(APIView):
+    """
+    Commit a resumable upload once every part has been received.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, session_id):
+        with transaction.atomic():
+            session = get_object_or_404(
+                UploadSession.objects.select_for_update(),
+                id=session_id,
+                owner=request.user,
+            )
+            if session.file_id:
+                return Response(FileSerializer(session.file).data)
+
+            received = set(
+                session.parts.filter(completed=True).values_list("number", flat=True)
+            )
+            missing = [
+                number
+                for number in range(1, session.part_count + 1)
+                if number not in received
+            ]
+            if missing:
+                return Response(
+                    {"error": "Upload is missing parts.", "missing_parts": missing},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            try:
+                with quota_reservation(request.user) as reservation:
+                    reservation.take(session.size)
+                    file = session.finalize()
+            except QuotaExceeded as e:
+                return quota_exceeded(e)
+        return Response(FileSerializer(file).data, status=status.HTTP_201_CREATED)
 
 
 class FileDownloadView(APIView):
@@ -41,20 +416,43 @@ class FileDownloadView(APIView):
     def get(self, request, file_id, *args, **kwargs):
         try:
             file = File.objects.get(id=file_id, owner=request.user)
-            file_path = file.file.path
+            return encrypted_file_response(request, file, "attachment")
+        except File.DoesNotExist:
+            raise Http404("File not found or access denied.")
 
-            decrypted_content = file.decrypt_file()
-            mime_type, _ = guess_type(file_path)
-            content_type = mime_type or "application/octet-stream"
 
-            response = FileResponse(
-                iter([decrypted_content]),
-                content_type=content_type,
-            )
-            response["Content-Disposition"] = f'attachment; filename="{file.name}"'
-            return response
-        except File.DoesNotExist:
+class BulkDownloadView(APIView):
+    """
+    Download several files, owned by or shared for download with the
+    current user, as one streamed ZIP archive.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        serializer = BulkDownloadSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        ids = serializer.validated_data["files"]
+
+        shared = FileShare.objects.filter(
+            Q(expires_at__isnull=True) | Q(expires_at__gt=timezone.now()),
+            shared_with=request.user.email,
+            share_type="download",
+            public=False,
+        )
+        files = File.objects.filter(
+            Q(owner=request.user) | Q(id__in=shared.values("file_id")), id__in=ids
+        )
+        files = {file.id: file for file in files}
+        if len(files) != len(ids):
             raise Http404("File not found or access denied.")
+        if any(file.client_encrypted for file in files.values()):
+            return Response(
+                {"error": "Client-encrypted files must be downloaded one by one."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        return zip_archive_response([files[id] for id in ids])
 
 
 class FileViewView(APIView):
@@ -67,20 +465,9 @@ class FileViewView(APIView):
     def get(self, request, file_id, *args, **kwargs):
         try:
             file = get_object_or_404(File, id=file_id, owner=request.user)
-            file_path = file.file.path
 
-            # Decrypt the file content
-            decrypted_content = file.decrypt_file()
-            mime_type, _ = guess_type(file_path)
-            content_type = mime_type or "application/octet-stream"
-
-            # Stream the file content inline
-            response = FileResponse(
-                iter([decrypted_content]),
-                content_type=content_type,
-            )
-            response["Content-Disposition"] = f'inline; filename="{file.name}"'
-            return response
+            # Stream the decrypted file content inline
+            return encrypted_file_response(request, file, "inline")
 
         except Http404:
             raise Http404("File not found or access denied.")
@@ -90,12 +477,29 @@ class FileViewView(APIView):
             )
 
 
+class FilePreviewView(APIView):
+    """
+    Serve a small preview of a file (thumbnail, first page render or text
+    excerpt) without decrypting the file itself. ``?kind=`` picks one.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, file_id, *args, **kwargs):
+        file = get_object_or_404(File, id=file_id, owner=request.user)
+        return serve_preview(request, file)
+
+
 class UserFilesView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, *args, **kwargs):
+        query = FileListQuerySerializer(data=request.query_params)
+        if not query.is_valid():
+            return Response(query.errors, status=status.HTTP_400_BAD_REQUEST)
+
         # Retrieve files owned by the logged-in user
-        user_files = File.objects.filter(owner=request.user)
+        user_files = query.filter(File.objects.filter(owner=request.user))
         serializer = FileSerializer(user_files, many=True)
         return Response(serializer.data)
 
@@ -319,40 +723,51 @@ class AccessSharedFileForAuthenticatedUsers(APIView):
 
         # Handle share_type
         if share.share_type == "view":
-            # Stream file content for viewing in the frontend
-            file_path = share.file.file.path
-            decrypted_content = share.file.decrypt_file()
-            mime_type, _ = guess_type(file_path)
-            content_type = mime_type or "application/octet-stream"
-
-            response = FileResponse(
-                iter([decrypted_content]),
-                content_type=content_type,
-            )
-            response["Content-Disposition"] = (
-                f'inline; filename="{share.file.name}"'  # Ensure "inline" for viewing
-            )
-            return response
+            # Stream file content inline for viewing in the frontend
+            return encrypted_file_response(request, share.file, "inline")
 
         elif share.share_type == "download":
             # Allow file download
-            file_path = share.file.file.path
-            decrypted_content = share.file.decrypt_file()
-            mime_type, _ = guess_type(file_path)
-            content_type = mime_type or "application/octet-stream"
-
-            response = FileResponse(
-                iter([decrypted_content]),
-                content_type=content_type,
+            return encrypted_file_response(request, share.file, "attachment")
+
+        return Response(
+            {"error": "Invalid share type."}, status=status.HTTP_400_BAD_REQUEST
+        )
+
+
+class SharedFilePreviewView(APIView):
+    """
+    Serve the preview of a file shared with the current user.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, shared_link):
+        share = get_object_or_404(FileShare, shared_link=shared_link)
+        if share.is_expired():
+            return Response(
+                {"error": "This link has expired."}, status=status.HTTP_400_BAD_REQUEST
             )
-            response["Content-Disposition"] = (
-                f'attachment; filename="{share.file.name}"'  # Allow "attachment" for download
+        if share.public or request.user.email != share.shared_with:
+            return Response(
+                {"error": "Access denied."}, status=status.HTTP_403_FORBIDDEN
             )
-            return response
+        return serve_preview(request, share.file)
+
 
+def serve_preview(request, file):
+    kind = request.query_params.get("kind")
+    if kind is not None and kind not in PREVIEW_KINDS:
         return Response(
-            {"error": "Invalid share type."}, status=status.HTTP_400_BAD_REQUEST
+            {"error": f"Preview kind must be one of {', '.join(PREVIEW_KINDS)}."},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    response = preview_response(request, file, kind)
+    if response is None:
+        return Response(
+            {"error": "No preview available."}, status=status.HTTP_404_NOT_FOUND
         )
+    return response
 
 
 class AccessSharedFileForPublicUsers(APIView):
@@ -383,36 +798,12 @@ class AccessSharedFileForPublicUsers(APIView):
 
             # Handle share_type
             if share.share_type == "view":
-                # Stream file content for viewing in the frontend
-                file_path = share.file.file.path
-                decrypted_content = share.file.decrypt_file()
-                mime_type, _ = guess_type(file_path)
-                content_type = mime_type or "application/octet-stream"
-
-                response = FileResponse(
-                    iter([decrypted_content]),
-                    content_type=content_type,
-                )
-                response["Content-Disposition"] = (
-                    f'inline; filename="{share.file.name}"'  # Ensure "inline" for viewing
-                )
-                return response
+                # Stream file content inline for viewing in the frontend
+                return encrypted_file_response(request, share.file, "inline")
 
             elif share.share_type == "download":
                 # Allow file download
-                file_path = share.file.file.path
-                decrypted_content = share.file.decrypt_file()
-                mime_type, _ = guess_type(file_path)
-                content_type = mime_type or "application/octet-stream"
-
-                response = FileResponse(
-                    iter([decrypted_content]),
-                    content_type=content_type,
-                )
-                response["Content-Disposition"] = (
-                    f'attachment; filename="{share.file.name}"'  # Allow "attachment" for download
-                )
-                return response
+                return encrypted_file_response(request, share.file, "attachment")
 
         except Http404:
             raise Http404("File not found or access denied.")
@@ -1,7 +1,6 @@
-from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
 from django.utils.deprecation import MiddlewareMixin
 from django.contrib.auth.models import AnonymousUser
-from core.models import User
+from core.authentication import authenticate_cookies
 import logging
 
 logger = logging.getLogger(__name__)
@@ -29,33 +28,6 @@ class CookieJWTMiddleware(MiddlewareMixin):
         return response
     
     def process_request(self, request):
-        access_token = request.COOKIES.get("access")
-        refresh_token = request.COOKIES.get("refresh")
-
-        request.user = AnonymousUser()
-
-        if access_token:
-            try:
-                token = AccessToken(access_token)
-                user_id = token["user_id"]
-                request.user = User.objects.get(id=user_id)
-                return  # Valid access token, no further action needed
-            except Exception as e:
-                pass
-
-        if refresh_token:
-            try:
-                refresh = RefreshToken(refresh_token)
-                user_id = refresh["user_id"]
-                user = User.objects.get(id=user_id)
-
-                # Set the authenticated user
-                request.user = user
-
-                # Generate a new access token
-                new_access_token = refresh.access_token
-                # Attach the new access token as a cookie
-                request.new_access_token = str(new_access_token)
-
-            except Exception as e:
-                request.user = AnonymousUser()
+        # DRF's CookieJWTAuthentication reuses this result
+        user, _ = authenticate_cookies(request)
+        request.user = user or AnonymousUser()
@@ -1,5 +1,7 @@
 from rest_framework import serializers
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
 
+from core.authentication import FilteredRefreshToken
 from core.models import User
 
 
@@ -13,3 +15,7 @@ class UserSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         user = User.objects.create_user(**validated_data)
         return user
+
+
+class CookieTokenRefreshSerializer(TokenRefreshSerializer):
+    token_class = FilteredRefreshToken
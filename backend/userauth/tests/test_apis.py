@@ -1,16 +1,26 @@
+from datetime import timedelta
+from unittest import mock
+
 import pyotp
 from django.contrib.auth.tokens import default_token_generator
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils.encoding import force_bytes
 from django.utils.http import urlsafe_base64_encode
 from rest_framework import status
 from rest_framework.test import APIClient, APITestCase
+from rest_framework_simplejwt.backends import TokenBackend
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
 
-from core.models import User
+from core.authentication import set_user_claims
+from core.models import User, UserRole
 
 
 class UserAuthAPITestCase(APITestCase):
     def setUp(self):
+        cache.clear()
         self.client = APIClient()
         # Pre-generate an MFA secret
         self.secret = pyotp.random_base32()
@@ -198,6 +208,124 @@ class UserAuthAPITestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data["email"], self.user.email)
 
+    def user_queries(self, queries):
+        return [q for q in queries if 'FROM "core_user"' in q["sql"]]
+
+    def test_cookie_authentication_loads_user_once(self):
+        refresh = set_user_claims(RefreshToken.for_user(self.user), self.user)
+        user_queries = self.user_queries
+
+        self.client.cookies["access"] = str(refresh.access_token)
+        # The first request caches the token version
+        self.client.get(reverse("user"))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("user"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["email"], self.user.email)
+        self.assertEqual(len(user_queries(queries)), 1)
+
+        # Without a valid access token, one is minted from the refresh token
+        self.client.cookies["access"] = "expired"
+        self.client.cookies["refresh"] = str(refresh)
+        with mock.patch.object(
+            RefreshToken,
+            "access_token",
+            new_callable=mock.PropertyMock,
+            return_value=mock.MagicMock(**{"__str__.return_value": "minted"}),
+        ) as access_token, CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("user"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.cookies["access"].value, "minted")
+        access_token.assert_called_once()
+        self.assertEqual(len(user_queries(queries)), 1)
+
+    def test_claims_authorize_without_loading_user(self):
+        refresh = set_user_claims(RefreshToken.for_user(self.user), self.user)
+        self.client.cookies["access"] = str(refresh.access_token)
+        self.client.get(reverse("user-files"))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("user-files"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.user_queries(queries), [])
+
+    def test_concurrent_refreshes_sign_one_token(self):
+        refresh = set_user_claims(RefreshToken.for_user(self.user), self.user)
+        self.client.cookies["refresh"] = str(refresh)
+        encode = TokenBackend.encode
+        minted = set()
+        with mock.patch.object(
+            TokenBackend, "encode", autospec=True, side_effect=encode
+        ) as signed:
+            # Requests sent before the browser stores the renewed cookie
+            for _ in range(10):
+                self.client.cookies["access"] = "expired"
+                response = self.client.get(reverse("user-files"))
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                minted.add(response.cookies["access"].value)
+        self.assertEqual(signed.call_count, 1)
+        self.assertEqual(len(minted), 1)
+
+    def test_logout_stops_cached_renewals(self):
+        refresh = set_user_claims(RefreshToken.for_user(self.user), self.user)
+        self.client.cookies["refresh"] = str(refresh)
+        self.client.cookies["access"] = "expired"
+        response = self.client.get(reverse("user-files"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.client.cookies["access"] = response.cookies["access"].value
+        response = self.client.post(reverse("logout"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # The same refresh cookie, replayed after logout
+        self.client.cookies["refresh"] = str(refresh)
+        self.client.cookies["access"] = "expired"
+        response = self.client.get(reverse("user-files"))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertNotIn("access", response.cookies)
+        response = self.client.post(reverse("token_refresh"))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_access_token_renewed_before_expiry(self):
+        refresh = set_user_claims(RefreshToken.for_user(self.user), self.user)
+        self.client.cookies["refresh"] = str(refresh)
+        access = refresh.access_token
+        self.client.cookies["access"] = str(access)
+        response = self.client.get(reverse("user-files"))
+        self.assertNotIn("access", response.cookies)
+
+        access.set_exp(lifetime=timedelta(seconds=5))
+        self.client.cookies["access"] = str(access)
+        response = self.client.get(reverse("user-files"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        renewed = AccessToken(response.cookies["access"].value)
+        self.assertGreater(renewed["exp"], access["exp"])
+
+    def test_claim_change_forces_token_refresh(self):
+        refresh = set_user_claims(RefreshToken.for_user(self.user), self.user)
+        self.client.cookies["access"] = str(refresh.access_token)
+        self.client.cookies["refresh"] = str(refresh)
+        response = self.client.get(reverse("user-files"))
+        self.assertNotIn("access", response.cookies)
+
+        version = self.user.token_version
+        self.user.role = UserRole.ADMIN.value
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+        self.assertEqual(self.user.token_version, version + 1)
+        response = self.client.get(reverse("user-files"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        access = AccessToken(response.cookies["access"].value)
+        self.assertEqual(access["role"], UserRole.ADMIN.value)
+        self.assertEqual(access["ver"], version + 1)
+
+        # A deactivated user cannot refresh either
+        self.user.is_active = False
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save(update_fields=["is_active"])
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.token_version, version + 2)
+        response = self.client.get(reverse("user-files"))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
     def test_load_user_data_unauthenticated(self):
         response = self.client.get(reverse("user"))
         # Fix This
@@ -9,14 +9,14 @@ from rest_framework import status
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.views import TokenRefreshView
 from rest_framework_simplejwt.exceptions import InvalidToken
 
 from backend.django_settings import EMAIL_HOST_USER
+from core.authentication import FilteredRefreshToken, set_user_claims
 from core.models import User, UserRole
 
-from .serializers import UserSerializer
+from .serializers import CookieTokenRefreshSerializer, UserSerializer
 
 # Create your views here.
 
@@ -129,7 +129,7 @@ class LogoutView(APIView):
                 )
 
             # Blacklist the token
-            token = RefreshToken(refresh_token)
+            token = FilteredRefreshToken(refresh_token)
             token.blacklist()
 
             response = Response({"message": "Logged out successfully"}, status=status.HTTP_200_OK)
@@ -299,7 +299,7 @@ class LoginStepTwoView(APIView):
             )
 
         # Generate JWT tokens upon successful login
-        refresh = RefreshToken.for_user(user)
+        refresh = set_user_claims(FilteredRefreshToken.for_user(user), user)
 
         # Clear session data after successful login
         request.session.flush()
@@ -343,6 +343,8 @@ class DebugSessionView(APIView):
         )
 
 class CookieTokenRefreshView(TokenRefreshView):
+    serializer_class = CookieTokenRefreshSerializer
+
     def post(self, request, *args, **kwargs):
         # Retrieve refresh token from cookies
         refresh_token = request.COOKIES.get("refresh")